@@ -0,0 +1,275 @@
+# pylint: skip-file
+'''
+    Bitboard - mask based representation of the 32 dark squares of a board.
+
+    Only dark squares can ever hold a piece, so every position is packed into
+    three 32-bit masks (player 1 pieces, player 2 pieces and kings). The dark
+    square index of a board position (0-63) is simply pos >> 1:
+
+        idx = row * 4 + column // 2
+
+    Neighbour and jump landing squares are precomputed once per direction,
+    which lets move generation for every piece of a side happen at once with
+    a handful of shifts instead of a per-square scan.
+'''
+
+UP_LEFT = 0
+UP_RIGHT = 1
+DOWN_LEFT = 2
+DOWN_RIGHT = 3
+
+# Same order the Board used to try moves in, so results stay identical.
+DIRECTIONS = (UP_LEFT, UP_RIGHT, DOWN_LEFT, DOWN_RIGHT)
+OPPOSITE = (DOWN_RIGHT, DOWN_LEFT, UP_RIGHT, UP_LEFT)
+OFFSETS = (-9, -7, 7, 9)
+
+SIDE_P1 = 1
+SIDE_P2 = 2
+
+# Directions an uncrowned piece may move in, indexed by side.
+FORWARD = (None, (UP_LEFT, UP_RIGHT), (DOWN_LEFT, DOWN_RIGHT))
+
+FULL = 0xFFFFFFFF
+NO_SQUARE = -1
+
+# Squares on which the men of a side are crowned, indexed by side.
+CROWN = (0, 0x0000000F, 0xF0000000)
+
+
+def toIndex(pos):
+    ''' toIndex - dark square index (0-31) of a board position (0-63) '''
+    return pos >> 1
+
+
+def toPos(idx):
+    ''' toPos - board position (0-63) of a dark square index (0-31) '''
+    row = idx >> 2
+    return row * 8 + 2 * (idx & 3) + (1 - (row & 1))
+
+
+def _step(pos, direction):
+    row, col = pos // 8, pos % 8
+    drow = -1 if direction in (UP_LEFT, UP_RIGHT) else 1
+    dcol = -1 if direction in (UP_LEFT, DOWN_LEFT) else 1
+    row, col = row + drow, col + dcol
+    if 0 <= row <= 7 and 0 <= col <= 7:
+        return row * 8 + col
+    return NO_SQUARE
+
+
+def _buildTables():
+    neighbour = [[NO_SQUARE] * 32 for _ in DIRECTIONS]
+    jump = [[NO_SQUARE] * 32 for _ in DIRECTIONS]
+    for direction in DIRECTIONS:
+        for idx in range(32):
+            over = _step(toPos(idx), direction)
+            if over == NO_SQUARE:
+                continue
+            neighbour[direction][idx] = toIndex(over)
+            land = _step(over, direction)
+            if land != NO_SQUARE:
+                jump[direction][idx] = toIndex(land)
+    return (tuple(tuple(t) for t in neighbour),
+            tuple(tuple(t) for t in jump))
+
+
+# NEIGHBOUR[direction][idx] / JUMP[direction][idx] -> idx or NO_SQUARE
+NEIGHBOUR, JUMP = _buildTables()
+
+BIT = tuple(1 << idx for idx in range(32))
+
+
+def _buildAround():
+    '''
+        A piece's moves only depend on the two squares next to it in each
+        direction, so a change on idx can only alter the moves of pieces up
+        to two diagonal steps away (and of the piece on idx itself).
+    '''
+    around = []
+    for idx in range(32):
+        mask = BIT[idx]
+        for direction in DIRECTIONS:
+            for table in (NEIGHBOUR, JUMP):
+                if table[direction][idx] != NO_SQUARE:
+                    mask |= BIT[table[direction][idx]]
+        around.append(mask)
+    return tuple(around)
+
+
+# AROUND[idx] -> mask of the squares whose moves a change on idx can affect
+AROUND = _buildAround()
+
+
+def _buildShifts(table):
+    '''
+        Groups squares of one direction by index delta. Within a row parity
+        the delta is constant, so a direction becomes at most two
+        (delta, source mask) pairs.
+    '''
+    shifts = []
+    for direction in DIRECTIONS:
+        groups = {}
+        for idx, target in enumerate(table[direction]):
+            if target != NO_SQUARE:
+                delta = target - idx
+                groups[delta] = groups.get(delta, 0) | BIT[idx]
+        shifts.append(tuple(sorted(groups.items())))
+    return tuple(shifts)
+
+
+STEP_SHIFTS = _buildShifts(NEIGHBOUR)
+
+
+def shift(mask, direction):
+    ''' shift - moves every square in mask one step in direction '''
+    result = 0
+    for delta, source in STEP_SHIFTS[direction]:
+        if delta > 0:
+            result |= (mask & source) << delta
+        else:
+            result |= (mask & source) >> -delta
+    return result
+
+
+def bits(mask):
+    ''' bits - yields the indices of the set bits of mask in ascending order '''
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class Bitboard:
+    def __init__(self, p1=0, p2=0, kings=0):
+        self.p1 = p1
+        self.p2 = p2
+        self.kings = kings
+
+    def side(self, idx):
+        '''
+            side: returns SIDE_P1, SIDE_P2 or 0 for an empty square
+        '''
+        bit = BIT[idx]
+        if self.p1 & bit:
+            return SIDE_P1
+        if self.p2 & bit:
+            return SIDE_P2
+        return 0
+
+    def king(self, idx):
+        return bool(self.kings & BIT[idx])
+
+    def occupied(self):
+        return self.p1 | self.p2
+
+    def tryMove(self, idx, direction, chainOnly):
+        '''
+            tryMove: destination of the piece on idx in one direction.
+            Args:
+                idx: Integer from 0-31
+                direction: one of DIRECTIONS
+                chainOnly: only jumps are allowed (continuing a chain)
+            Returns:
+                idx of the destination or NO_SQUARE
+        '''
+        bit = BIT[idx]
+        if self.p1 & bit:
+            own, opp = self.p1, self.p2
+            side = SIDE_P1
+        elif self.p2 & bit:
+            own, opp = self.p2, self.p1
+            side = SIDE_P2
+        else:
+            return NO_SQUARE
+
+        if direction not in FORWARD[side] and not self.kings & bit:
+            return NO_SQUARE
+
+        over = NEIGHBOUR[direction][idx]
+        if over == NO_SQUARE:
+            return NO_SQUARE
+
+        overBit = BIT[over]
+        if not (own | opp) & overBit:
+            return NO_SQUARE if chainOnly else over
+
+        land = JUMP[direction][idx]
+        if (opp & overBit and land != NO_SQUARE and
+                not (own | opp) & BIT[land]):
+            return land
+        return NO_SQUARE
+
+    def moves(self, idx, chainOnly):
+        '''
+            moves: list of destination indices for the piece on idx, in
+                DIRECTIONS order.
+        '''
+        result = []
+        for direction in DIRECTIONS:
+            dest = self.tryMove(idx, direction, chainOnly)
+            if dest != NO_SQUARE:
+                result.append(dest)
+        return result
+
+    def movableMask(self, side, chainOnly):
+        '''
+            movableMask: mask of every piece of side that has at least one
+                legal move (or jump, when chainOnly is set).
+        '''
+        if side == SIDE_P1:
+            own, opp = self.p1, self.p2
+        else:
+            own, opp = self.p2, self.p1
+        empty = ~(own | opp) & FULL
+        ownKings = own & self.kings
+
+        result = 0
+        for direction in DIRECTIONS:
+            pieces = own if direction in FORWARD[side] else ownKings
+            if not pieces:
+                continue
+            back = OPPOSITE[direction]
+            # Squares whose neighbour in direction is empty...
+            canStep = shift(empty, back)
+            if not chainOnly:
+                result |= pieces & canStep
+            # ...and squares whose neighbour is an opponent with an empty
+            # square behind it.
+            result |= pieces & shift(opp & canStep, back)
+        return result
+
+    def move(self, src, dest):
+        '''
+            move: relocates the piece on src to dest, keeping its king flag.
+        '''
+        srcBit, destBit = BIT[src], BIT[dest]
+        both = srcBit | destBit
+        if self.p1 & srcBit:
+            self.p1 ^= both
+        else:
+            self.p2 ^= both
+        if self.kings & srcBit:
+            self.kings ^= both
+
+    def remove(self, idx):
+        clear = ~BIT[idx]
+        self.p1 &= clear
+        self.p2 &= clear
+        self.kings &= clear
+
+    def crown(self, idx):
+        self.kings |= BIT[idx]
+
+    def uncrown(self, idx):
+        self.kings &= ~BIT[idx]
+
+    def put(self, idx, side, king):
+        '''
+            put: places a piece of side on the empty square idx.
+        '''
+        if side == SIDE_P1:
+            self.p1 |= BIT[idx]
+        else:
+            self.p2 |= BIT[idx]
+        if king:
+            self.kings |= BIT[idx]
@@ -1,41 +1,87 @@
 # pylint: skip-file
-import copy
+import os
+import random
+
+from Bitboard import (AROUND, BIT, Bitboard, CROWN, DIRECTIONS, DOWN_LEFT,
+                      DOWN_RIGHT, FORWARD, FULL, JUMP, NEIGHBOUR, NO_SQUARE,
+                      SIDE_P1, SIDE_P2, UP_LEFT, UP_RIGHT, bits, toIndex,
+                      toPos)
+
+
+# Square encoding for Board.board, one byte per square. The side bits match
+# the Bitboard sides so a code can index per-side tables directly.
+EMPTY = 0
+P1 = SIDE_P1
+P2 = SIDE_P2
+KING = 4
+SIDE_MASK = P1 | P2
+
+# Labels used by the client, indexed by square code.
+LABELS = {EMPTY: "BLANK", P1: "P1", P2: "P2",
+          P1 | KING: "P1_KING", P2 | KING: "P2_KING"}
+
+# Compact encoding, one character per dark square, indexed by square code.
+COMPACT = {EMPTY: ".", P1: "a", P2: "b", P1 | KING: "A", P2 | KING: "B"}
+FROM_COMPACT = {char: code for code, char in COMPACT.items()}
+
+# Zobrist keys: one random 64 bit number per piece code and dark square, a
+# position hashes to the XOR of the keys of its pieces. The seed is fixed so
+# every process (and every worker sharing a room store) agrees on hashes.
+_zobristRandom = random.Random(0x4b696e674d65)
+ZOBRIST = {code: [_zobristRandom.getrandbits(64) for _ in range(32)]
+           for code in [P1, P2, P1 | KING, P2 | KING]}
+# Folded in by State for player 2 to move, and for the piece that has to
+# continue a jump chain
+ZOBRIST_P2_TURN = _zobristRandom.getrandbits(64)
+ZOBRIST_CHAIN = [_zobristRandom.getrandbits(64) for _ in range(32)]
 
 
 class Board:
+    # Check the incremental move cache against a full recompute after every
+    # move. Slow, only meant for tests and debugging.
+    debugMoveCache = os.environ.get("KINGME_DEBUG_MOVES") == "1"
+
     def __init__(self, player1, player2):
         self.player1 = player1
         self.player2 = player2
-        self.board = [None] * 64
+        self.board = bytearray(64)
 
         self.player1_count = 12
         self.player2_count = 12
 
-        self.board[1] = Piece(1, player2, False)
-        self.board[3] = Piece(3, player2, False)
-        self.board[5] = Piece(5, player2, False)
-        self.board[7] = Piece(7, player2, False)
-        self.board[8] = Piece(8, player2, False)
-        self.board[10] = Piece(10, player2, False)
-        self.board[12] = Piece(12, player2, False)
-        self.board[14] = Piece(14, player2, False)
-        self.board[17] = Piece(17, player2, False)
-        self.board[19] = Piece(19, player2, False)
-        self.board[21] = Piece(21, player2, False)
-        self.board[23] = Piece(23, player2, False)
-
-        self.board[40] = Piece(40, player1, False)
-        self.board[42] = Piece(42, player1, False)
-        self.board[44] = Piece(44, player1, False)
-        self.board[46] = Piece(46, player1, False)
-        self.board[49] = Piece(49, player1, False)
-        self.board[51] = Piece(51, player1, False)
-        self.board[53] = Piece(51, player1, False)
-        self.board[55] = Piece(51, player1, False)
-        self.board[56] = Piece(56, player1, False)
-        self.board[58] = Piece(56, player1, False)
-        self.board[60] = Piece(60, player1, False)
-        self.board[62] = Piece(62, player1, False)
+        # Move generation runs on the dark square masks, self.board mirrors
+        # them for per-square lookups.
+        self.bitboard = Bitboard()
+
+        # Player 2 fills the dark squares of the top three rows and player 1
+        # those of the bottom three.
+        for pos in list(range(0, 24)) + list(range(40, 64)):
+            if (pos // 8 + pos % 8) % 2 == 1:
+                if pos < 24:
+                    self.board[pos] = P2
+                    self.bitboard.p2 |= BIT[toIndex(pos)]
+                else:
+                    self.board[pos] = P1
+                    self.bitboard.p1 |= BIT[toIndex(pos)]
+
+        # Legal moves of every movable piece, by side and then position.
+        # makeMove only refreshes the squares around the ones it changed.
+        self.moveCache = {SIDE_P1: {}, SIDE_P2: {}}
+        self.refreshMoves(FULL)
+
+        # Zobrist hash of the pieces, updated by makeMove
+        self.hash = self.computeHash()
+
+        # Serialized forms of the position, cleared whenever it changes
+        self.jsonCache = None
+        self.compactCache = None
+
+        # Squares changed and pieces captured since the last takeChanges()
+        self.changedSquares = set()
+        self.capturedSquares = []
+
+        # Undo records of the moves made through push(), see pop()
+        self.undoStack = []
 
         # Board return results. All CONST.
         self.NO_MOVE_EXISTS = -1
@@ -47,23 +93,91 @@ class Board:
         '''
             toJSON - returns an array of all of the board pieces.
                 This array can easily be incorporated into a JSON schema result.
+                The array is cached until the next move and shared between
+                callers, so it must not be modified.
         '''
-        result = []
-        board = self.board
-        for i in range(0, 64):
-            if board[i] is None:
-                result.append("BLANK")
-            elif self.player(i) == self.player1:
-                if self.king(i):
-                    result.append("P1_KING")
-                else:
-                    result.append("P1")
-            elif self.player(i) == self.player2:
-                if self.king(i):
-                    result.append("P2_KING")
-                else:
-                    result.append("P2")
-        return result
+        if self.jsonCache is None:
+            self.jsonCache = [LABELS[code] for code in self.board]
+        return self.jsonCache
+
+    def toCompact(self):
+        '''
+            toCompact - returns the board as a 32 character string, one
+                character per dark square in Bitboard index order:
+                    '.' empty, 'a'/'A' player 1 piece/king,
+                    'b'/'B' player 2 piece/king
+                Cached until the next move like toJSON.
+        '''
+        if self.compactCache is None:
+            self.compactCache = "".join(
+                COMPACT[self.board[toPos(idx)]] for idx in range(32))
+        return self.compactCache
+
+    def loadCompact(self, compact):
+        '''
+            loadCompact - replaces the whole position with one produced by
+                toCompact. Changes are not tracked, clients need a full
+                snapshot afterwards.
+            Args:
+                compact: String of 32 characters
+        '''
+        if len(compact) != 32:
+            raise ValueError("ERROR: compact boards have 32 squares!")
+        self.board = bytearray(64)
+        self.bitboard = Bitboard()
+        for idx, char in enumerate(compact):
+            code = FROM_COMPACT[char]
+            self.board[toPos(idx)] = code
+            if code & SIDE_MASK == P1:
+                self.bitboard.p1 |= BIT[idx]
+            elif code & SIDE_MASK == P2:
+                self.bitboard.p2 |= BIT[idx]
+            if code & KING:
+                self.bitboard.kings |= BIT[idx]
+
+        self.player1_count = bin(self.bitboard.p1).count("1")
+        self.player2_count = bin(self.bitboard.p2).count("1")
+        self.moveCache = {SIDE_P1: {}, SIDE_P2: {}}
+        self.refreshMoves(FULL)
+        self.hash = self.computeHash()
+        self.jsonCache = None
+        self.compactCache = None
+        self.undoStack = []
+
+    def computeHash(self):
+        '''
+            computeHash - Zobrist hash of the pieces on the board, computed
+                from scratch. makeMove keeps self.hash equal to it.
+            Returns:
+                Integer below 2**64
+        '''
+        value = 0
+        for idx in range(32):
+            code = self.board[toPos(idx)]
+            if code != EMPTY:
+                value ^= ZOBRIST[code][idx]
+        return value
+
+    def label(self, pos, compact=False):
+        '''
+            label - returns the toJSON (or toCompact) label of a single square.
+        '''
+        if compact:
+            return COMPACT[self.board[pos]]
+        return LABELS[self.board[pos]]
+
+    def takeChanges(self):
+        '''
+            takeChanges - returns the squares changed and the pieces captured
+                since the last call, and starts tracking again.
+            Returns:
+                (Array of changed positions, Array of captured positions)
+        '''
+        squares = sorted(self.changedSquares)
+        captured = self.capturedSquares
+        self.changedSquares = set()
+        self.capturedSquares = []
+        return squares, captured
 
     def movablePieces(self, player, prevChainJmp):
         '''
@@ -77,16 +191,96 @@ class Board:
         result = []
 
         if prevChainJmp is not None:
-            if not (self.board[prevChainJmp] is not None and self.player(
+            if not (self.board[prevChainJmp] != EMPTY and self.player(
                     prevChainJmp) == player):
                 raise ValueError("ERROR implementing prevChainJmp")
             return [prevChainJmp]
 
-        for i in range(0, 64):
-            if self.board[i] is not None and self.player(i) == player:
-                if self.canMove(i, prevChainJmp):
-                    result.append(i)
+        side = self.side(player)
+        if side:
+            result = sorted(self.moveCache[side])
+
+        return result
+
+    def hasMoves(self, player):
+        '''
+            hasMoves: whether player has any movable piece left.
+        '''
+        side = self.side(player)
+        return bool(side and self.moveCache[side])
+
+    def moveSequences(self, player, prevChainJmp, mandatoryCapture):
+        '''
+            moveSequences: every way player can play a whole turn, found
+                with a depth first search over the bitboard masks.
+            Args:
+                player: Integer
+                prevChainJmp: Integer from 0-63, the piece that has to
+                    continue a jump chain, or None
+                mandatoryCapture: Boolean, when set a player who can jump
+                    has to, and jump chains have to be finished
+            Returns:
+                Array of tuples of positions (0-63): the piece, then every
+                square it lands on. A step has one landing square, a jump
+                chain one per jump. Without mandatoryCapture, a chain can be
+                stopped after any jump so every prefix is included.
+                Sequences start in DIRECTIONS order from each piece, pieces
+                in ascending order.
+        '''
+        side = self.side(player)
+        if not side:
+            return []
+        own = self.bitboard.p1 if side == SIDE_P1 else self.bitboard.p2
+        opp = self.bitboard.occupied() & ~own
+        kings = self.bitboard.kings
+        crown = CROWN[side]
+        forward = FORWARD[side]
+        chainOnly = prevChainJmp is not None
+        pieces = BIT[toIndex(prevChainJmp)] if chainOnly else own
 
+        result = []
+        # The piece and its landing squares so far, shared by the whole
+        # search and copied only when a sequence is recorded
+        path = []
+
+        def jump(idx, direction, own, opp, king):
+            # Follows the jump from idx in direction, if there is one, and
+            # every chain it continues into
+            over = NEIGHBOUR[direction][idx]
+            land = JUMP[direction][idx]
+            if (land == NO_SQUARE or not opp & BIT[over] or
+                    (own | opp) & BIT[land]):
+                return False
+            path.append(toPos(land))
+            if not mandatoryCapture:
+                result.append(tuple(path))
+            own ^= BIT[idx] | BIT[land]
+            opp ^= BIT[over]
+            king = king or bool(crown & BIT[land])
+            more = False
+            for direction in (DIRECTIONS if king else forward):
+                more = jump(land, direction, own, opp, king) or more
+            if mandatoryCapture and not more:
+                result.append(tuple(path))
+            path.pop()
+            return True
+
+        anyJump = False
+        for idx in bits(pieces):
+            king = bool(kings & BIT[idx])
+            path.append(toPos(idx))
+            for direction in (DIRECTIONS if king else forward):
+                over = NEIGHBOUR[direction][idx]
+                if over != NO_SQUARE and not (own | opp) & BIT[over]:
+                    if not chainOnly:
+                        result.append((path[0], toPos(over)))
+                elif jump(idx, direction, own, opp, king):
+                    anyJump = True
+            path.pop()
+
+        if mandatoryCapture and anyJump:
+            return [sequence for sequence in result
+                    if self.isJump(sequence[0], sequence[1])]
         return result
 
     def makeMove(self, src, dest, prevChainJmp):
@@ -104,31 +298,156 @@ class Board:
             return self.MOVE_FAILED_ILLEGAL
 
         result = self.MOVE_NO_JUMP
+        changed = AROUND[toIndex(src)] | AROUND[toIndex(dest)]
 
         if self.isJump(src, dest):
             otherPosDir = (dest - src) // 2
             if otherPosDir not in [9, -9, 7, -7]:
                 raise ValueError("Whoops! Bad jump " + str(otherPosDir) + "!")
 
-            if self.board[src + otherPosDir].player == self.player1:
+            if self.board[src + otherPosDir] & SIDE_MASK == P1:
                 self.player1_count -= 1
             else:
                 self.player2_count -= 1
 
-            self.board[src + otherPosDir] = None
+            self.hash ^= ZOBRIST[self.board[src + otherPosDir]][
+                toIndex(src + otherPosDir)]
+            self.board[src + otherPosDir] = EMPTY
+            self.bitboard.remove(toIndex(src + otherPosDir))
+            changed |= AROUND[toIndex(src + otherPosDir)]
+            self.changedSquares.add(src + otherPosDir)
+            self.capturedSquares.append(src + otherPosDir)
 
             result = self.MOVE_JUMP
 
         # Regular move
-        self.board[dest] = copy.deepcopy(self.board[src])
-        self.board[dest].pos = dest
-        self.board[src] = None
+        self.hash ^= ZOBRIST[self.board[src]][toIndex(src)]
+        self.board[dest] = self.board[src]
+        self.board[src] = EMPTY
+        self.bitboard.move(toIndex(src), toIndex(dest))
+        self.changedSquares.add(src)
+        self.changedSquares.add(dest)
 
         if self.shouldKing(dest):
-            self.board[dest].king = True
+            self.board[dest] |= KING
+            self.bitboard.crown(toIndex(dest))
+        self.hash ^= ZOBRIST[self.board[dest]][toIndex(dest)]
+
+        self.refreshMoves(changed)
+        self.jsonCache = None
+        self.compactCache = None
+        if self.debugMoveCache:
+            self.checkMoveCache()
+
+        return result
 
+    def push(self, src, dest, prevChainJmp):
+        '''
+            push: makeMove, remembering how to take the move back with pop.
+                The undo record is a tuple of ints:
+                    (src, dest, captured position or -1, captured square code,
+                     promoted, player1_count, player2_count, prevChainJmp)
+            Returns:
+                Same as makeMove
+        '''
+        code = self.board[src]
+        captured = -1
+        capturedCode = EMPTY
+        if self.isJump(src, dest):
+            captured = (src + dest) // 2
+            capturedCode = self.board[captured]
+        counts = (self.player1_count, self.player2_count)
+        result = self.makeMove(src, dest, prevChainJmp)
+        if result != self.MOVE_FAILED_ILLEGAL:
+            self.undoStack.append((src, dest, captured, capturedCode,
+                                   self.board[dest] != code) + counts +
+                                  (prevChainJmp,))
         return result
 
+    def pop(self):
+        '''
+            pop: takes back the last move made with push. The move cache,
+                hash and counts are restored incrementally, and the squares
+                count as changed for the next takeChanges().
+            Returns:
+                The prevChainJmp the move was made with
+        '''
+        if not self.undoStack:
+            raise ValueError("ERROR: No move to undo!")
+        (src, dest, captured, capturedCode, promoted, player1_count,
+         player2_count, prevChainJmp) = self.undoStack.pop()
+
+        code = self.board[dest]
+        self.hash ^= ZOBRIST[code][toIndex(dest)]
+        self.board[dest] = EMPTY
+        self.bitboard.move(toIndex(dest), toIndex(src))
+        if promoted:
+            code &= ~KING
+            self.bitboard.uncrown(toIndex(src))
+        self.board[src] = code
+        self.hash ^= ZOBRIST[code][toIndex(src)]
+        self.changedSquares.add(src)
+        self.changedSquares.add(dest)
+        changed = AROUND[toIndex(src)] | AROUND[toIndex(dest)]
+
+        if captured != -1:
+            self.board[captured] = capturedCode
+            self.bitboard.put(toIndex(captured), capturedCode & SIDE_MASK,
+                              capturedCode & KING)
+            self.hash ^= ZOBRIST[capturedCode][toIndex(captured)]
+            self.changedSquares.add(captured)
+            changed |= AROUND[toIndex(captured)]
+            # A capture nobody was told about yet is simply forgotten
+            if self.capturedSquares and self.capturedSquares[-1] == captured:
+                self.capturedSquares.pop()
+
+        self.player1_count = player1_count
+        self.player2_count = player2_count
+        self.refreshMoves(changed)
+        self.jsonCache = None
+        self.compactCache = None
+        if self.debugMoveCache:
+            self.checkMoveCache()
+        return prevChainJmp
+
+    def refreshMoves(self, mask):
+        '''
+            refreshMoves: recomputes the cached moves of the pieces on the
+                dark squares in mask.
+            Args:
+                mask: Integer, a Bitboard mask of dark squares
+        '''
+        bitboard = self.bitboard
+        p1Moves = self.moveCache[SIDE_P1]
+        p2Moves = self.moveCache[SIDE_P2]
+        for idx in bits(mask):
+            pos = toPos(idx)
+            p1Moves.pop(pos, None)
+            p2Moves.pop(pos, None)
+            side = bitboard.side(idx)
+            if side:
+                moves = bitboard.moves(idx, False)
+                if moves:
+                    self.moveCache[side][pos] = [toPos(m) for m in moves]
+
+    def checkMoveCache(self):
+        '''
+            checkMoveCache: compares the incremental move cache and hash
+                against a full recompute of every piece.
+            Raises:
+                ValueError if they differ
+        '''
+        for side in [SIDE_P1, SIDE_P2]:
+            expected = {}
+            for idx in bits(self.bitboard.movableMask(side, False)):
+                expected[toPos(idx)] = [toPos(m) for m in
+                                        self.bitboard.moves(idx, False)]
+            if expected != self.moveCache[side]:
+                raise ValueError("ERROR: move cache out of sync for side " +
+                                 str(side) + "!")
+        if self.hash != self.computeHash():
+            raise ValueError("ERROR: position hash out of sync!")
+
     def isJump(self, src, dest):
         return dest in [src + 18, src - 18, src + 14, src - 14]
 
@@ -143,88 +462,55 @@ class Board:
 
     # conditions - player is an integer for comparison
     def getMoves(self, pos, prevChainJmp):
-        if self.board[pos] is None:
+        if not self.onBoard(pos) or self.board[pos] == EMPTY:
             return []
-        return [p for p in [self.tryMoveUpLeft(pos, prevChainJmp),
-                            self.tryMoveUpRight(pos, prevChainJmp),
-                            self.tryMoveDownLeft(pos, prevChainJmp),
-                            self.tryMoveDownRight(pos, prevChainJmp)]
-                if p != self.NO_MOVE_EXISTS]
+        moves = self.moveCache[self.board[pos] & SIDE_MASK].get(pos)
+        if moves is None:
+            return []
+        if prevChainJmp is not None:
+            return [dest for dest in moves if self.isJump(pos, dest)]
+        return list(moves)
 
     def tryMoveDownLeft(self, pos, prevChainJmp):
-        if ((self.player(pos) == self.player2 or self.king(pos)) and
-                self.onBoard(pos + 7) and
-                self.column(pos) > 0):
-
-            other = self.board[pos + 7]
-
-            if other is None:
-                if prevChainJmp is None:
-                    return pos + 7
-
-            elif (self.player(pos) != other.player and
-                    self.onBoard(pos + 14) and
-                    self.column(pos) > 1 and
-                    self.board[pos + 14] is None):
-                return pos + 14
-
-        # All other test cases fail
-        return self.NO_MOVE_EXISTS
+        return self.tryMove(pos, DOWN_LEFT, prevChainJmp)
 
     def tryMoveDownRight(self, pos, prevChainJmp):
-        if ((self.player(pos) == self.player2 or self.king(pos)) and
-                self.onBoard(pos + 9) and
-                self.column(pos) < 7):
-            other = self.board[pos + 9]
-            #Try and move
-            if other is None:
-                if prevChainJmp is None:
-                    return pos + 9
-
-            elif (self.player(pos) != other.player and
-                    self.onBoard(pos + 18) and
-                    self.column(pos) < 6 and
-                    self.board[pos + 18] is None):
-                return pos + 18
-
-        return self.NO_MOVE_EXISTS
+        return self.tryMove(pos, DOWN_RIGHT, prevChainJmp)
 
     def tryMoveUpLeft(self, pos, prevChainJmp):
-        if ((self.player(pos) == self.player1 or self.king(pos)) and
-                self.onBoard(pos - 9) and
-                self.column(pos) > 0):
-            # See if the piece is occupied
-            other = self.board[pos - 9]
-            if other is None:
-                if prevChainJmp is None:
-                    return pos - 9
-
-            # If so, attempt a jump
-            elif (self.player(pos) != other.player and
-                    self.onBoard(pos - 18) and
-                    self.column(pos) > 1 and
-                    self.board[pos - 18] is None):
-                return pos - 18
-
-        # All cases fail
-        return self.NO_MOVE_EXISTS
+        return self.tryMove(pos, UP_LEFT, prevChainJmp)
 
     def tryMoveUpRight(self, pos, prevChainJmp):
-        if ((self.player(pos) == self.player1 or self.king(pos)) and
-                self.onBoard(pos - 7) and
-                self.column(pos) < 7):
-            other = self.board[pos - 7]
-            if other is None:
-                if prevChainJmp is None:
-                    return pos - 7
-            elif (self.player(pos) != other.player and
-                  self.onBoard(pos - 14) and
-                  self.column(pos) < 6 and
-                  self.board[pos - 14] is None):
-                return pos - 14
-
-        # All cases fail
-        return self.NO_MOVE_EXISTS
+        return self.tryMove(pos, UP_RIGHT, prevChainJmp)
+
+    def tryMove(self, pos, direction, prevChainJmp):
+        ''' tryMove - destination of the piece on pos in one direction
+            Args:
+                pos - Integer from 0-63
+                direction - one of the Bitboard directions
+            Returns:
+                Integer from 0-63, or self.NO_MOVE_EXISTS
+        '''
+        if not self.onBoard(pos) or pos % 2 == (pos // 8) % 2:
+            return self.NO_MOVE_EXISTS
+        dest = self.bitboard.tryMove(toIndex(pos), direction,
+                                     prevChainJmp is not None)
+        if dest == NO_SQUARE:
+            return self.NO_MOVE_EXISTS
+        return toPos(dest)
+
+    def side(self, player):
+        ''' side - maps a player id onto its Bitboard side
+            Args:
+                player - Integer
+            Returns:
+                SIDE_P1, SIDE_P2 or 0 for an unknown player
+        '''
+        if player == self.player1:
+            return SIDE_P1
+        if player == self.player2:
+            return SIDE_P2
+        return 0
 
     def onBoard(self, pos):
         ''' onBoard - helper function that determines whether a position is
@@ -237,10 +523,26 @@ class Board:
         return (pos > 0) and (pos <= 63)
 
     def king(self, pos):
-        return self.board[pos].king
+        return bool(self.board[pos] & KING)
 
     def player(self, pos):
-        return self.board[pos].player
+        side = self.board[pos] & SIDE_MASK
+        if side == P1:
+            return self.player1
+        if side == P2:
+            return self.player2
+        return None
+
+    def piece(self, pos):
+        ''' piece - helper function that builds a Piece for a square
+            Args:
+                pos - Integer
+            Returns:
+                Piece, or None for an empty square
+        '''
+        if self.board[pos] == EMPTY:
+            return None
+        return Piece(pos, self.player(pos), self.king(pos))
 
     def column(self, pos):
         ''' column - helper function that determines the column of a piece
@@ -262,6 +564,8 @@ class Board:
 
 
 class Piece:
+    __slots__ = ('pos', 'player', 'king')
+
     def __init__(self, pos, player, king):
         self.pos = pos
         self.player = player
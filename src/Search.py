@@ -0,0 +1,380 @@
+# pylint: skip-file
+'''
+    Search - move search for the computer player.
+
+    Iterative deepening alpha-beta (negamax) with a transposition table,
+    over the same rules as State: a ply is a single hop, a player who just
+    jumped and can jump again may continue the chain or stop it, and the
+    side to move loses when it has no moves left.
+
+    Positions are searched as plain Bitboard masks, (p1, p2, kings, side,
+    chain). Masks are immutable ints, so making a move builds the child's
+    masks and unmaking it is simply going back to the parent's locals; no
+    Board is copied or modified. Hashes are the same Zobrist keys Board and
+    State use, so a State and its searched position hash equal.
+'''
+import time
+
+from Bitboard import (BIT, CROWN, DIRECTIONS, FORWARD, JUMP, NEIGHBOUR,
+                      NO_SQUARE, SIDE_P1, SIDE_P2, bits, toIndex, toPos)
+from Board import KING, ZOBRIST, ZOBRIST_CHAIN, ZOBRIST_P2_TURN
+
+# Move standing for stopping a jump chain (makeMove with makeMove: false)
+CANCEL = 'cancel'
+
+WIN = 100000
+MAN_VALUE = 100
+KING_VALUE = 160
+
+# Transposition table entry bounds
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+OTHER = (0, SIDE_P2, SIDE_P1)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def position(state):
+    '''
+        position - the searched form of a State:
+            (p1, p2, kings, side to move, chain square or NO_SQUARE)
+    '''
+    board = state.board
+    chain = NO_SQUARE
+    if state.prevChainJmp is not None:
+        chain = toIndex(state.prevChainJmp)
+    return (board.bitboard.p1, board.bitboard.p2, board.bitboard.kings,
+            board.side(state.playerTurn), chain)
+
+
+def pieceHash(p1, p2, kings):
+    ''' pieceHash - Board.computeHash() of a set of masks '''
+    value = 0
+    for idx in bits(p1):
+        value ^= ZOBRIST[SIDE_P1 | KING if kings & BIT[idx] else SIDE_P1][idx]
+    for idx in bits(p2):
+        value ^= ZOBRIST[SIDE_P2 | KING if kings & BIT[idx] else SIDE_P2][idx]
+    return value
+
+
+def generate(p1, p2, kings, side, chain, mandatoryCapture=False):
+    '''
+        generate - legal hops of side, split into jumps and steps.
+            Every hop is (src, dest, captured square or NO_SQUARE), in dark
+            square indices. A chain only allows jumps of the chain piece,
+            and mandatoryCapture drops the steps when there is a jump.
+    '''
+    own, opp = (p1, p2) if side == SIDE_P1 else (p2, p1)
+    occupied = p1 | p2
+    jumps = []
+    steps = []
+    pieces = own if chain == NO_SQUARE else BIT[chain]
+    for src in bits(pieces):
+        for direction in (DIRECTIONS if kings & BIT[src] else FORWARD[side]):
+            over = NEIGHBOUR[direction][src]
+            if over == NO_SQUARE:
+                continue
+            if not occupied & BIT[over]:
+                if chain == NO_SQUARE:
+                    steps.append((src, over, NO_SQUARE))
+            elif opp & BIT[over]:
+                land = JUMP[direction][src]
+                if land != NO_SQUARE and not occupied & BIT[land]:
+                    jumps.append((src, land, over))
+    if mandatoryCapture and jumps:
+        return jumps, []
+    return jumps, steps
+
+
+def canJump(own, opp, kings, side, idx):
+    ''' canJump - whether the piece of side on idx has a jump '''
+    occupied = own | opp
+    for direction in (DIRECTIONS if kings & BIT[idx] else FORWARD[side]):
+        over = NEIGHBOUR[direction][idx]
+        land = JUMP[direction][idx]
+        if (land != NO_SQUARE and opp & BIT[over] and
+                not occupied & BIT[land]):
+            return True
+    return False
+
+
+def play(p1, p2, kings, side, hashed, move):
+    '''
+        play - the position after side plays move, like State.makeMove (or
+            cancelMove for CANCEL).
+        Args:
+            hashed: pieceHash() of the masks, updated incrementally
+        Returns:
+            (p1, p2, kings, side to move, chain square, hashed)
+    '''
+    if move == CANCEL:
+        return p1, p2, kings, OTHER[side], NO_SQUARE, hashed
+
+    src, dest, over = move
+    srcBit = BIT[src]
+    destBit = BIT[dest]
+    code = side | KING if kings & srcBit else side
+    hashed ^= ZOBRIST[code][src]
+    if side == SIDE_P1:
+        p1 ^= srcBit | destBit
+    else:
+        p2 ^= srcBit | destBit
+    if kings & srcBit:
+        kings ^= srcBit | destBit
+
+    if over != NO_SQUARE:
+        overBit = BIT[over]
+        other = OTHER[side]
+        hashed ^= ZOBRIST[other | KING if kings & overBit else other][over]
+        p1 &= ~overBit
+        p2 &= ~overBit
+        kings &= ~overBit
+
+    if not kings & destBit and CROWN[side] & destBit:
+        kings |= destBit
+        code = side | KING
+    hashed ^= ZOBRIST[code][dest]
+
+    own, opp = (p1, p2) if side == SIDE_P1 else (p2, p1)
+    if over != NO_SQUARE and canJump(own, opp, kings, side, dest):
+        return p1, p2, kings, side, dest, hashed
+    return p1, p2, kings, OTHER[side], NO_SQUARE, hashed
+
+
+def evaluate(p1, p2, kings, side):
+    '''
+        evaluate - static score of a position for side: material, plus a
+            small bonus for men close to being crowned.
+    '''
+    score = (MAN_VALUE * bin(p1 & ~kings).count("1") +
+             KING_VALUE * bin(p1 & kings).count("1") -
+             MAN_VALUE * bin(p2 & ~kings).count("1") -
+             KING_VALUE * bin(p2 & kings).count("1"))
+    for idx in bits(p1 & ~kings):
+        score += 7 - (idx >> 2)
+    for idx in bits(p2 & ~kings):
+        score -= idx >> 2
+    return score if side == SIDE_P1 else -score
+
+
+class Search:
+    def __init__(self, timeBudget=1.0, maxDepth=64, tableSize=1 << 20,
+                 mandatoryCapture=False):
+        '''
+            Args:
+                timeBudget: seconds to search for, the deepest completed
+                    iteration is used
+                maxDepth: plies to search at most
+                tableSize: transposition table entries kept before it is
+                    cleared
+                mandatoryCapture: play by State.mandatoryCapture rules
+        '''
+        self.timeBudget = timeBudget
+        self.maxDepth = maxDepth
+        self.tableSize = tableSize
+        self.mandatoryCapture = mandatoryCapture
+        self.table = {}
+        self.nodes = 0
+        self.depth = 0
+        self.deadline = None
+
+    def bestMove(self, pos):
+        '''
+            bestMove - searches a position for the side to move.
+            Args:
+                pos: tuple returned by position()
+            Returns:
+                (src, dest) board positions (0-63), CANCEL to stop a jump
+                chain, or None when the side to move has no moves
+        '''
+        p1, p2, kings, side, chain = pos
+        jumps, steps = generate(p1, p2, kings, side, chain,
+                                self.mandatoryCapture)
+        moves = jumps + steps
+        if chain != NO_SQUARE and not self.mandatoryCapture:
+            moves.append(CANCEL)
+        if not moves:
+            return None
+
+        best = moves[0]
+        if len(moves) > 1:
+            self.nodes = 0
+            self.deadline = time.perf_counter() + self.timeBudget
+            hashed = pieceHash(p1, p2, kings)
+            try:
+                for depth in range(1, self.maxDepth + 1):
+                    _, move = self.root(p1, p2, kings, side, chain, hashed,
+                                        depth)
+                    best = move
+                    self.depth = depth
+            except SearchTimeout:
+                pass
+
+        if best == CANCEL:
+            return CANCEL
+        return toPos(best[0]), toPos(best[1])
+
+    def root(self, p1, p2, kings, side, chain, hashed, depth):
+        '''
+            root - one iteration at the root, returns (score, move)
+        '''
+        alpha = -WIN - 1
+        best = None
+        for move in self.ordered(p1, p2, kings, side, chain, hashed):
+            score = self.child(p1, p2, kings, side, hashed, move, depth,
+                               alpha, WIN + 1, 0)
+            if best is None or score > alpha:
+                alpha = score
+                best = move
+        self.store(p1, p2, kings, side, chain, hashed, depth, alpha, EXACT,
+                   best)
+        return alpha, best
+
+    def negamax(self, p1, p2, kings, side, chain, hashed, depth, alpha, beta,
+                ply):
+        '''
+            negamax - score of a position for side, within (alpha, beta)
+        '''
+        self.nodes += 1
+        if not self.nodes & 1023 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+        key = self.key(side, chain, hashed)
+        entry = self.table.get(key)
+        if entry is not None and entry[0] >= depth:
+            _, value, bound, _ = entry
+            if bound == EXACT:
+                return value
+            if bound == LOWER and value >= beta:
+                return value
+            if bound == UPPER and value <= alpha:
+                return value
+
+        jumps, steps = generate(p1, p2, kings, side, chain,
+                                self.mandatoryCapture)
+        if not jumps and not steps:
+            return -WIN + ply
+        if depth <= 0:
+            return self.quiesce(p1, p2, kings, side, chain, hashed, jumps,
+                                alpha, beta, ply)
+
+        start = alpha
+        bestScore = -WIN - 1
+        bestMove = None
+        for move in self.ordered(p1, p2, kings, side, chain, hashed,
+                                 jumps, steps, entry):
+            score = self.child(p1, p2, kings, side, hashed, move, depth,
+                               alpha, beta, ply)
+            if score > bestScore:
+                bestScore = score
+                bestMove = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if bestScore <= start:
+            bound = UPPER
+        elif bestScore >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.store(p1, p2, kings, side, chain, hashed, depth, bestScore,
+                   bound, bestMove)
+        return bestScore
+
+    def quiesce(self, p1, p2, kings, side, chain, hashed, jumps, alpha, beta,
+                ply):
+        '''
+            quiesce - resolves pending jumps past the search horizon, so
+                positions are not scored in the middle of an exchange.
+                Unless mandatoryCapture is set, jumps are not forced, so the
+                static score stands for every other move (and for stopping
+                a chain).
+        '''
+        score = evaluate(p1, p2, kings, side)
+        if not jumps:
+            return score
+        if self.mandatoryCapture:
+            score = -WIN - 1
+        elif score >= beta:
+            return score
+        alpha = max(alpha, score)
+        for move in jumps:
+            value = self.child(p1, p2, kings, side, hashed, move, 0, alpha,
+                               beta, ply)
+            if value > score:
+                score = value
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        break
+        return score
+
+    def child(self, p1, p2, kings, side, hashed, move, depth, alpha, beta,
+              ply):
+        '''
+            child - makes move and searches the resulting position, returns
+                its score for side. The parent's masks are left untouched,
+                which is all unmaking takes.
+        '''
+        p1, p2, kings, nextSide, chain, hashed = play(p1, p2, kings, side,
+                                                      hashed, move)
+        if not (p2 if side == SIDE_P1 else p1):
+            # Captured the last piece of the opponent
+            return WIN - ply - 1
+        if nextSide == side:
+            # The chain continues: same side to move, same perspective
+            return self.negamax(p1, p2, kings, side, chain, hashed,
+                                depth - 1, alpha, beta, ply + 1)
+        return -self.negamax(p1, p2, kings, nextSide, chain, hashed,
+                             depth - 1, -beta, -alpha, ply + 1)
+
+    def ordered(self, p1, p2, kings, side, chain, hashed, jumps=None,
+                steps=None, entry=None):
+        '''
+            ordered - hops to try, best first: the transposition table move,
+                then jumps, then steps, then stopping a chain.
+        '''
+        if jumps is None:
+            jumps, steps = generate(p1, p2, kings, side, chain,
+                                    self.mandatoryCapture)
+            entry = self.table.get(self.key(side, chain, hashed))
+        moves = jumps + steps
+        if chain != NO_SQUARE and not self.mandatoryCapture:
+            moves.append(CANCEL)
+        if entry is not None and entry[3] in moves and entry[3] != moves[0]:
+            moves.remove(entry[3])
+            moves.insert(0, entry[3])
+        return moves
+
+    def key(self, side, chain, hashed):
+        ''' key - State.positionHash() of a searched position '''
+        if side == SIDE_P2:
+            hashed ^= ZOBRIST_P2_TURN
+        if chain != NO_SQUARE:
+            hashed ^= ZOBRIST_CHAIN[chain]
+        return hashed
+
+    def store(self, p1, p2, kings, side, chain, hashed, depth, value, bound,
+              move):
+        '''
+            store - records a search result in the transposition table.
+                The table is simply emptied once it holds tableSize entries.
+        '''
+        if len(self.table) >= self.tableSize:
+            self.table.clear()
+        self.table[self.key(side, chain, hashed)] = (depth, value, bound, move)
+
+
+def findMove(pos, timeBudget, mandatoryCapture=False):
+    '''
+        findMove - Search(...).bestMove(pos), as a plain function so that it
+            can run in a worker process.
+    '''
+    return Search(timeBudget,
+                  mandatoryCapture=mandatoryCapture).bestMove(pos)
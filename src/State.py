@@ -1,5 +1,6 @@
 # pylint: skip-file
-from Board import Board, Piece
+from Board import Board, Piece, ZOBRIST_CHAIN, ZOBRIST_P2_TURN
+from Bitboard import toIndex
 '''
     Possible states:
         P1_TURN, P2_TURN, WAITING, P1_WIN, P2_WIN,
@@ -15,9 +16,12 @@ P2_WIN = "P2_WIN"
 P1_DISCONNECT = "P1_DISCONNECT"
 P2_DISCONNECT = "P2_DISCONNECT"
 
+# Version of the update/update_delta payloads sent to clients
+PROTOCOL_VERSION = 1
+
 
 class State:
-    def __init__(self, player1):
+    def __init__(self, player1, mandatoryCapture=False):
         self.player1 = player1
         self.player2 = None
         self.board = Board(self.player1, -1)
@@ -25,6 +29,29 @@ class State:
         self.done = False
         self.playerTurn = player1
         self.prevChainJmp = None
+        # (playerTurn, prevChainJmp, state, board move made) before every
+        # move and cancelled chain, for undo
+        self.history = []
+        # Sequence number of the last published update, and the squares and
+        # captures it changed
+        self.seq = 0
+        self.lastChanges = ([], [])
+        # Time of the last event on this game, kept by the server
+        self.lastActivity = None
+        # Time the game was first listed in the lobby, kept by the server
+        self.created = None
+        # Player ID of the computer opponent, if any
+        self.aiPlayer = None
+        # Player ID -> time by which a player whose connection dropped has
+        # to resume, kept by the server
+        self.dropped = {}
+        # Number of spectators following the game, kept by the server
+        self.watchers = 0
+        # Whether a player who can jump has to, and finish the chain
+        self.mandatoryCapture = mandatoryCapture
+        # (positionHash, sequences, first hops by piece) of the turn being
+        # played, see turnMoves
+        self.sequenceCache = None
 
     def changeTurn(self):
         if self.playerTurn == self.player1:
@@ -33,6 +60,10 @@ class State:
             self.playerTurn = self.player1
 
     def cancelMove(self):
+        if self.mandatoryCapture:
+            raise ValueError("ERROR: Jump chains have to be finished!")
+        self.history.append((self.playerTurn, self.prevChainJmp, self.state,
+                             False))
         self.changeTurn()
         self.prevChainJmp = None
 
@@ -50,9 +81,13 @@ class State:
                 0  - Board move succeeded, no jump (Board.MOVE_NO_JUMP)
                 1  - Board move succeeded, jump (Board.MOVE_JUMP)
         '''
-        result = self.board.makeMove(src, dest, self.prevChainJmp)
+        if dest not in self.turnMoves().get(src, ()):
+            raise ValueError("ERROR: Illegal move attempted!")
+        before = (self.playerTurn, self.prevChainJmp, self.state, True)
+        result = self.board.push(src, dest, self.prevChainJmp)
         if result == self.board.MOVE_FAILED_ILLEGAL:
             raise ValueError("ERROR: Illegal move attempted!")
+        self.history.append(before)
 
         if self.board.player1_count == 0:
             self.state = P2_WIN
@@ -70,35 +105,187 @@ class State:
             self.prevChainJmp = dest
         return result
 
+    def positionHash(self):
+        '''
+        positionHash - 64 bit Zobrist hash of the position: the pieces, whose
+            turn it is and the piece that has to continue a jump chain.
+            Equal positions hash equal, whatever moves led to them.
+        '''
+        value = self.board.hash
+        if self.playerTurn == self.player2:
+            value ^= ZOBRIST_P2_TURN
+        if self.prevChainJmp is not None:
+            value ^= ZOBRIST_CHAIN[toIndex(self.prevChainJmp)]
+        return value
+
+    def makeMoveSequence(self, path):
+        '''
+        makeMoveSequence - plays a whole turn at once, checked against
+            moveSequences before anything moves. A jump chain the path
+            stops early is ended like cancelMove.
+
+        Args:
+            path: Array of positions, the piece then every landing square
+
+        Returns:
+            The makeMove result of the last hop
+
+        Raises:
+            ValueError if path is not a legal sequence
+        '''
+        path = tuple(path)
+        if path not in self.moveSequences():
+            raise ValueError("ERROR: Illegal move sequence attempted!")
+        for src, dest in zip(path, path[1:]):
+            result = self.makeMove(src, dest)
+        if self.prevChainJmp is not None and not self.isFinished():
+            self.cancelMove()
+        return result
+
+    def undo(self):
+        '''
+        undo - takes back the last move, or the last stopped chain, and
+            gives the turn back. Takebacks run it once per ply.
+
+        Raises:
+            ValueError if there is nothing to undo or the game was ended
+        '''
+        if self.done or not self.history:
+            raise ValueError("ERROR: Nothing to undo!")
+        self.playerTurn, self.prevChainJmp, self.state, moved = \
+            self.history.pop()
+        if moved:
+            self.board.pop()
+
+    def moveSequences(self):
+        '''
+        moveSequences - every complete way the player to move can play the
+            rest of their turn, see Board.moveSequences. Computed once per
+            turn.
+        '''
+        self.turnMoves()
+        return self.sequenceCache[1]
+
+    def turnMoves(self):
+        '''
+        turnMoves - legal next hops of the turn being played, by piece,
+            derived from moveSequences. The cache is keyed by the position
+            hash, so any change to the board or turn invalidates it.
+
+        Returns:
+            Dict of position -> Array of destinations, must not be modified
+        '''
+        key = self.positionHash()
+        if self.sequenceCache is None or self.sequenceCache[0] != key:
+            sequences = self.board.moveSequences(
+                self.playerTurn, self.prevChainJmp, self.mandatoryCapture)
+            moves = {}
+            for sequence in sequences:
+                dests = moves.setdefault(sequence[0], [])
+                if sequence[1] not in dests:
+                    dests.append(sequence[1])
+            self.sequenceCache = (key, sequences, moves)
+        return self.sequenceCache[2]
+
     def getMoves(self, pos):
-        return self.board.getMoves(pos, self.prevChainJmp)
+        return list(self.turnMoves().get(pos, []))
 
-    def toJSON(self):
+    def toJSON(self, compact=False):
+        '''
+        toJSON - full snapshot of the game, tagged with the sequence number
+            of the last published delta.
+
+        Args:
+            compact: send the board as Board.toCompact() instead of labels
+        '''
         return {
+            'v': PROTOCOL_VERSION,
+            'seq': self.seq,
             'playerTurn': self.playerTurn,
             'secondMove': self.prevChainJmp,
             'players': [self.player1, self.player2],
-            'board': self.board.toJSON(),
+            'board': self.board.toCompact() if compact else self.board.toJSON(),
             'movablePieces': self.getMovablePieces(),
             'state': self.state,
         }
 
+    def publish(self):
+        '''
+        publish - starts a new update: bumps the sequence number and takes
+            the squares changed since the previous one. Every format of the
+            update is then built with toDelta.
+        '''
+        self.seq += 1
+        self.lastChanges = self.board.takeChanges()
+
+    def toDelta(self, compact=False):
+        '''
+        toDelta - the last published update as a delta against the previous
+            one: the squares changed and pieces captured since then, plus
+            the turn and state.
+
+        Args:
+            compact: label squares like Board.toCompact()
+        '''
+        squares, captured = self.lastChanges
+        movablePieces = self.getMovablePieces()
+        return {
+            'v': PROTOCOL_VERSION,
+            'seq': self.seq,
+            'playerTurn': self.playerTurn,
+            'secondMove': self.prevChainJmp,
+            'squares': [[pos, self.board.label(pos, compact)]
+                        for pos in squares],
+            'captured': captured,
+            'movablePieces': movablePieces,
+            'state': self.state,
+        }
+
     def getMovablePieces(self):
         if self.state not in [P1_TURN, P2_TURN]:
             return []
-        result = self.board.movablePieces(self.playerTurn, self.prevChainJmp)
-        if len(result) == 0:
+        if not self.board.hasMoves(self.playerTurn):
             if self.playerTurn == self.player1:
                 self.state = P2_WIN
             else:
                 self.state = P1_WIN
+            return []
 
-        return result
+        return sorted(self.turnMoves())
 
     def join(self, player2):
         self.player2 = player2
         self.board = Board(self.player1, self.player2)
         self.state = P1_TURN
+        self.history = []
+
+    def joinComputer(self, player2):
+        '''
+        joinComputer - joins player2 as the computer opponent, the server
+            plays its moves.
+        '''
+        self.join(player2)
+        self.aiPlayer = player2
+
+    def isComputerTurn(self):
+        return (self.aiPlayer is not None and not self.isFinished() and
+                self.playerTurn == self.aiPlayer)
+
+    def disconnect(self, player):
+        '''
+        disconnect - ends the game because player left, the other player
+            wins by forfeit. Does nothing once the game is over.
+        '''
+        if self.isFinished():
+            return
+        if player == self.player1:
+            self.end(P1_DISCONNECT)
+        elif player == self.player2:
+            self.end(P2_DISCONNECT)
+
+    def isFinished(self):
+        return self.done or self.state in [P1_WIN, P2_WIN,
+                                           P1_DISCONNECT, P2_DISCONNECT]
 
     def end(self, reason):
         self.done = True
@@ -0,0 +1,379 @@
+""" Load generator
+    Simulates many client pairs playing full games through the Socket.IO
+    protocol (create -> join -> getMoves/makeMove until the game ends, with
+    random legal moves) and reports throughput, latency, bytes per update
+    and server memory.
+
+    Usage:
+        python src/bench/load.py [--pairs N] [--concurrency C] [--seed S]
+        python src/bench/load.py --socket [--server asgi|flask] [--url URL]
+
+    The default mode drives the Flask-SocketIO test client in this process.
+    --socket connects real Socket.IO clients to a server, starting a local
+    one unless --url is given.
+
+    C0413 is disabled because we require the sys.path.insert before importing
+"""
+# pylint: disable=C0413
+import argparse
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+sys.path.insert(0, 'src/flask')
+sys.path.insert(0, 'src/')
+
+# States in which a game is over
+FINISHED = ['P1_WIN', 'P2_WIN', 'P1_DISCONNECT', 'P2_DISCONNECT']
+
+
+class InProcessConnection:
+    """ A player connected through the Flask-SocketIO test client """
+
+    def __init__(self, handler):
+        self.client = handler.socketio.test_client(handler.app)
+        self.pending = []
+
+    def send(self, event, data=None):
+        """ Emits an event to the server """
+        if data is None:
+            self.client.emit(event)
+        else:
+            self.client.emit(event, data)
+
+    def receive(self, timeout):
+        """ Returns the next (event, data) received, handlers run
+        synchronously so everything is already there """
+        if not self.pending:
+            self.pending = [(item['name'], item['args'][0] if item['args']
+                             else None)
+                            for item in self.client.get_received()]
+        if not self.pending:
+            raise queue.Empty
+        return self.pending.pop(0)
+
+    def close(self):
+        """ Disconnects from the server """
+        self.client.disconnect()
+
+
+class SocketConnection:
+    """ A player connected through a real Socket.IO client """
+
+    def __init__(self, url):
+        import socketio  # pylint: disable=C0415
+        self.received = queue.Queue()
+        self.client = socketio.Client()
+        self.client.on('*', lambda event, data=None:
+                       self.received.put((event, data)))
+        self.client.connect(url, transports=['websocket'])
+
+    def send(self, event, data=None):
+        """ Emits an event to the server """
+        self.client.emit(event, data)
+
+    def receive(self, timeout):
+        """ Returns the next (event, data) received """
+        return self.received.get(timeout=timeout)
+
+    def close(self):
+        """ Disconnects from the server """
+        self.client.disconnect()
+
+
+class Stats:
+    """ Measurements shared by every simulated pair """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.update_bytes = []
+        self.moves = 0
+        self.games = 0
+        self.errors = 0
+
+    def latency(self, event, seconds):
+        """ Records the latency of one request """
+        with self.lock:
+            self.latencies.setdefault(event, []).append(seconds)
+
+    def update(self, data):
+        """ Records the size of one update received by a client """
+        size = len(json.dumps(data, separators=(',', ':')))
+        with self.lock:
+            self.update_bytes.append(size)
+
+
+class Player:
+    """ One side of a simulated game """
+
+    def __init__(self, connection, stats, timeout):
+        self.connection = connection
+        self.stats = stats
+        self.timeout = timeout
+
+    def request(self, event, data, reply):
+        """ Sends an event and waits for the reply event, recording the
+        latency. Returns the reply data """
+        start = time.perf_counter()
+        self.connection.send(event, data)
+        result = self.wait_for(reply)
+        self.stats.latency(event, time.perf_counter() - start)
+        return result
+
+    def wait_for(self, reply):
+        """ Handles received events until one named reply arrives """
+        while True:
+            event, data = self.connection.receive(self.timeout)
+            if event in ['update', 'update_delta']:
+                self.stats.update(data)
+            if event == 'error':
+                raise RuntimeError(data['error'])
+            if event == reply:
+                return data
+
+    def drain(self):
+        """ Handles everything received so far """
+        try:
+            while True:
+                event, data = self.connection.receive(0)
+                if event in ['update', 'update_delta']:
+                    self.stats.update(data)
+        except queue.Empty:
+            pass
+
+
+def merge(view, data):
+    """ Keeps the parts of an update the players need to pick moves """
+    view = dict(view or {})
+    for key in ['seq', 'playerTurn', 'secondMove', 'movablePieces', 'state']:
+        view[key] = data[key]
+    return view
+
+
+def play_pair(connect, stats, rnd, max_plies, timeout):
+    """ Plays one full game between two new players """
+    player1 = Player(connect(), stats, timeout)
+    player2 = Player(connect(), stats, timeout)
+    try:
+        info = player1.request('create', None, 'join_room')
+        room_id = info['room_id']
+        players = {info['player_id']: player1}
+        player1.wait_for('update')
+        info = player2.request('join', {'room_id': room_id}, 'join_room')
+        players[info['player_id']] = player2
+        # The mover's own replies always carry the latest state
+        view = merge(None, player2.wait_for('update'))
+
+        for _ in range(max_plies):
+            if view['state'] in FINISHED or not view['movablePieces']:
+                break
+            mover = players[view['playerTurn']]
+            # Count the broadcasts received since the mover's last turn
+            mover.drain()
+
+            if view['secondMove'] is not None and rnd.random() < 0.25:
+                delta = mover.request('makeMove', {'makeMove': False,
+                                                   'room_id': room_id},
+                                      'update_delta')
+            else:
+                piece = rnd.choice(view['movablePieces'])
+                moves = mover.request('getMoves', {
+                    'pieceToMove': piece, 'room_id': room_id,
+                    'player_id': view['playerTurn']}, 'sendMoves')
+                delta = mover.request('makeMove', {
+                    'makeMove': True, 'room_id': room_id,
+                    'pieceToMove': piece,
+                    'moveToLocation': rnd.choice(moves['pieces'])},
+                                      'update_delta')
+                with stats.lock:
+                    stats.moves += 1
+            # Skip a broadcast of the previous move that arrived late
+            while delta['seq'] <= view['seq']:
+                delta = mover.wait_for('update_delta')
+            view = merge(view, delta)
+        player1.drain()
+        player2.drain()
+        with stats.lock:
+            stats.games += 1
+    except (RuntimeError, queue.Empty, KeyError, IndexError):
+        with stats.lock:
+            stats.errors += 1
+    finally:
+        player1.connection.close()
+        player2.connection.close()
+
+
+def run(connect, pairs, concurrency, seed, max_plies, timeout):
+    """ Plays pairs games, concurrency at a time. Returns the Stats and the
+    elapsed wall time """
+    stats = Stats()
+    games = queue.Queue()
+    for i in range(pairs):
+        games.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = games.get_nowait()
+            except queue.Empty:
+                return
+            play_pair(connect, stats, random.Random(seed + i), max_plies,
+                      timeout)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a list of numbers """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def rss_bytes(pid=None):
+    """ Resident set size of a process, from /proc """
+    path = '/proc/%s/statm' % (pid or 'self')
+    try:
+        with open(path) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def report(stats, elapsed, rss):
+    """ Summary of a run as a dict """
+    latency = {}
+    for event, values in sorted(stats.latencies.items()):
+        latency[event] = {
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'count': len(values),
+        }
+    updates = stats.update_bytes
+    return {
+        'games': stats.games,
+        'errors': stats.errors,
+        'moves': stats.moves,
+        'seconds': round(elapsed, 3),
+        'moves_per_second': round(stats.moves / elapsed, 1) if elapsed else 0,
+        'latency': latency,
+        'bytes_per_update': round(sum(updates) / len(updates), 1)
+                            if updates else 0,
+        'server_rss_bytes': rss,
+    }
+
+
+def start_server(kind, port):
+    """ Starts a local server process and waits until it listens """
+    script = 'src/flask/asgi.py' if kind == 'asgi' else 'src/bench/load.py'
+    args = [sys.executable, script]
+    if kind != 'asgi':
+        args += ['--serve', str(port)]
+    # Simulated players move far faster than the rate limit allows
+    server = subprocess.Popen(args, env=dict(os.environ,
+                                             KINGME_PORT=str(port),
+                                             KINGME_RATE_LIMIT='0'),
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('Server did not start on port %d' % port)
+
+
+def serve_flask(port):
+    """ Runs the Flask-SocketIO server without the debug reloader """
+    from app import get_handler  # pylint: disable=C0415
+    handler = get_handler()
+    handler.socketio.run(handler.app, host='127.0.0.1', port=port,
+                         allow_unsafe_werkzeug=True)
+
+
+def main():
+    """ Parses arguments and runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--pairs', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-plies', type=int, default=300)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--socket', action='store_true')
+    parser.add_argument('--server', choices=['asgi', 'flask'], default='asgi')
+    parser.add_argument('--url')
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--server-pid', type=int)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_flask(args.serve)
+        return
+
+    server = None
+    if args.socket:
+        url = args.url
+        server_pid = args.server_pid
+        if url is None:
+            server = start_server(args.server, args.port)
+            url = 'http://127.0.0.1:%d' % args.port
+            server_pid = server.pid
+
+        def connect():
+            return SocketConnection(url)
+    else:
+        from app import get_handler  # pylint: disable=C0415
+        handler = get_handler()
+        handler.limiter.rate = 0
+        server_pid = None
+
+        def connect():
+            return InProcessConnection(handler)
+
+    try:
+        stats, elapsed = run(connect, args.pairs, args.concurrency,
+                             args.seed, args.max_plies, args.timeout)
+        rss = rss_bytes(server_pid) if server_pid or not args.socket \
+            else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = report(stats, elapsed, rss)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+
+    print('games: %(games)d (errors: %(errors)d), moves: %(moves)d in '
+          '%(seconds).2fs -> %(moves_per_second).1f moves/s' % result)
+    for event, values in result['latency'].items():
+        print('  %-16s p50 %.3fms  p95 %.3fms  p99 %.3fms  (%d)' % (
+            event, values['p50_ms'], values['p95_ms'], values['p99_ms'],
+            values['count']))
+    print('bytes per update: %.1f' % result['bytes_per_update'])
+    if rss is not None:
+        print('server RSS: %.1f MiB' % (rss / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
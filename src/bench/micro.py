@@ -0,0 +1,226 @@
+""" Micro-benchmarks
+    Times Board move generation and State transitions over a fixed corpus
+    of positions and prints the results as JSON.
+
+    Usage:
+        python src/bench/micro.py [--save results.json]
+        python src/bench/micro.py --compare baseline.json [--threshold 0.1]
+
+    Every result has the operations per second (best of several repeats)
+    and the peak bytes allocated by a single call, measured with
+    tracemalloc. --compare exits with status 1 when any benchmark got
+    slower than the baseline by more than the threshold.
+
+    C0413 is disabled because we require the sys.path.insert before importing
+"""
+# pylint: disable=C0413
+import argparse
+import json
+import pickle
+import platform
+import sys
+import time
+import tracemalloc
+sys.path.insert(0, 'src/')
+
+from State import State, P1_TURN, P2_TURN
+
+# Bumped whenever benchmarks change in a way that makes old results
+# incomparable
+FORMAT_VERSION = 1
+
+PLAYER1 = 1
+PLAYER2 = 2
+
+# name -> (Board.toCompact() position, side to move)
+CORPUS = {
+    'opening': ('bbbbbbbbbbbb........aaaaaaaaaaaa', PLAYER1),
+    'midgame': ('.b.babbb..ab..b.b.ba.aaaaa.aa.a.', PLAYER1),
+    'kings': ('A......B..A..b....B.A.......B..a', PLAYER1),
+    # Player 1 on square 62 can jump 62 -> 44 -> 26 -> 8
+    'chain': ('.bb.....b........b........b.aa.a', PLAYER1),
+}
+
+
+def make_state(position):
+    """ A State in progress on one of the corpus positions """
+    compact, turn = CORPUS[position]
+    state = State(PLAYER1)
+    state.join(PLAYER2)
+    state.board.loadCompact(compact)
+    state.playerTurn = turn
+    state.state = P1_TURN if turn == PLAYER1 else P2_TURN
+    return state
+
+
+def first_move(state):
+    """ The first legal (src, dest) for the side to move, jumps first """
+    board = state.board
+    moves = [(src, dest)
+             for src in board.movablePieces(state.playerTurn, None)
+             for dest in board.getMoves(src, None)]
+    jumps = [move for move in moves if board.isJump(*move)]
+    return (jumps or moves)[0]
+
+
+def cold(board):
+    """ Drops the serialized forms cached on a board """
+    board.jsonCache = None
+    board.compactCache = None
+
+
+def benchmarks(position):
+    """ Returns name -> (setup, call) for one position. setup() builds the
+    argument passed to call(), outside of the timed section """
+    state = make_state(position)
+    board = state.board
+    player = state.playerTurn
+    src, dest = first_move(state)
+    movable = board.movablePieces(player, None)
+    frozen = pickle.dumps(state)
+
+    def fresh_state():
+        return pickle.loads(frozen)
+
+    def fresh_board():
+        return pickle.loads(frozen).board
+
+    def get_moves(_):
+        for pos in movable:
+            board.getMoves(pos, None)
+
+    def push_pop(_):
+        board.push(src, dest, None)
+        board.pop()
+
+    def to_json(target):
+        cold(target)
+        target.toJSON()
+
+    def state_to_json(target):
+        cold(target.board)
+        target.toJSON()
+
+    return {
+        'Board.getMoves': (lambda: None, get_moves),
+        'Board.movablePieces':
+            (lambda: None, lambda _: board.movablePieces(player, None)),
+        'Board.makeMove':
+            (fresh_board, lambda target: target.makeMove(src, dest, None)),
+        'Board.push+pop': (lambda: None, push_pop),
+        'Board.toJSON': (lambda: board, to_json),
+        'State.makeMove':
+            (fresh_state, lambda target: target.makeMove(src, dest)),
+        'State.toJSON': (lambda: state, state_to_json),
+    }
+
+
+def time_call(setup, call, repeats, duration):
+    """ Best operations per second over repeats runs of about duration
+    seconds each """
+    best = 0.0
+    for _ in range(repeats):
+        # Setup runs outside of the timed section, in batches
+        args = [setup() for _ in range(256)]
+        calls = 0
+        elapsed = 0.0
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            for arg in args:
+                call(arg)
+            elapsed += time.perf_counter() - start
+            calls += len(args)
+            args = [setup() for _ in range(256)]
+        best = max(best, calls / elapsed)
+    return best
+
+
+def peak_allocation(setup, call):
+    """ Peak bytes allocated while running one call """
+    arg = setup()
+    call(setup())
+    tracemalloc.start()
+    try:
+        # reset_peak is Python 3.9+. Before it, the peak of a tracing just
+        # started is already fresh, each sample starts its own
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        call(arg)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def run(repeats=5, duration=0.2, only=None):
+    """ Runs every benchmark over the corpus, returns the results dict """
+    results = {}
+    for position in CORPUS:
+        for name, (setup, call) in benchmarks(position).items():
+            key = '%s/%s' % (position, name)
+            if only and only not in key:
+                continue
+            results[key] = {
+                'ops_per_sec': round(time_call(setup, call, repeats,
+                                               duration), 1),
+                'peak_alloc_bytes': peak_allocation(setup, call),
+            }
+    return {
+        'version': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """ Returns the benchmarks that got slower than baseline by more than
+    threshold, as (name, baseline ops, current ops) """
+    if baseline.get('version') != current['version']:
+        raise ValueError('Baseline has format version %s, expected %s' %
+                         (baseline.get('version'), current['version']))
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if result['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, before['ops_per_sec'],
+                                result['ops_per_sec']))
+    return regressions
+
+
+def main():
+    """ Parses arguments and runs the benchmarks """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=0.2,
+                        help='seconds per repeat')
+    parser.add_argument('--only', help='run benchmarks containing this')
+    parser.add_argument('--save', help='write results to this file')
+    parser.add_argument('--compare', help='baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown before flagging, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    current = run(args.repeats, args.duration, args.only)
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(current, output, indent=2, sort_keys=True)
+            output.write('\n')
+    print(json.dumps(current, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(current, baseline, args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION %s: %.1f -> %.1f ops/sec (%.1f%%)' % (
+                name, before, after, (after / before - 1) * 100),
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
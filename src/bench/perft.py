@@ -0,0 +1,167 @@
+""" Perft
+    Counts every position reachable from a start position in exactly N
+    plies, using the same rules as the server. A ply is anything a player
+    can send with makeMove: moving a piece to one of its legal squares, or
+    stopping a jump chain early (makeMove with makeMove: false).
+
+    Usage:
+        python src/bench/perft.py [--depth N] [--workers W] [--divide]
+        python src/bench/perft.py --position COMPACT --turn 2
+
+    --workers splits the root moves across processes. Repeated subtrees
+    are counted once per process through a transposition cache, disable
+    it with --no-cache to check the cache itself.
+
+    C0413 is disabled because we require the sys.path.insert before importing
+"""
+# pylint: disable=C0413
+import argparse
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, 'src/')
+
+from State import State, P1_TURN, P2_TURN
+
+PLAYER1 = 1
+PLAYER2 = 2
+
+# Root move standing for stopping a jump chain
+CANCEL = 'cancel'
+
+
+def start_state(compact=None, turn=PLAYER1):
+    """ A State in progress, on the initial board unless compact is given """
+    state = State(PLAYER1)
+    state.join(PLAYER2)
+    if compact is not None:
+        state.board.loadCompact(compact)
+        state.playerTurn = turn
+        state.state = P1_TURN if turn == PLAYER1 else P2_TURN
+    return state
+
+
+def clone(state):
+    """ An independent copy of a State """
+    return pickle.loads(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+
+def children(state):
+    """ Yields (move, state after move) for every ply from state, move is
+    (src, dest) or CANCEL. The same State is played forward for each child
+    and taken back with State.undo() when the next one is asked for """
+    for src in state.getMovablePieces():
+        for dest in state.getMoves(src):
+            state.makeMove(src, dest)
+            yield (src, dest), state
+            state.undo()
+    if (state.prevChainJmp is not None and not state.mandatoryCapture and
+            not state.isFinished()):
+        state.cancelMove()
+        yield CANCEL, state
+        state.undo()
+
+
+def count_plies(state):
+    """ Number of plies from state, without making them """
+    count = sum(len(state.getMoves(src))
+                for src in state.getMovablePieces())
+    if (state.prevChainJmp is not None and not state.mandatoryCapture and
+            not state.isFinished()):
+        count += 1
+    return count
+
+
+def perft(state, depth, cache=None):
+    """ Returns (leaf positions at depth, positions expanded) below state.
+    Results are stored in cache, a dict, when given """
+    if depth == 0:
+        return 1, 0
+    if cache is not None:
+        key = (state.positionHash(), depth)
+        if key in cache:
+            return cache[key], 0
+    if depth == 1:
+        # Leaves do not need to be made, only counted
+        return count_plies(state), 1
+
+    leaves = 0
+    expanded = 1
+    for _, child in children(state):
+        count, below = perft(child, depth - 1, cache)
+        leaves += count
+        expanded += below
+
+    if cache is not None:
+        cache[key] = leaves
+    return leaves, expanded
+
+
+def perft_subtree(args):
+    """ perft() of one root move, for a worker process """
+    state, depth, use_cache = args
+    return perft(state, depth, {} if use_cache else None)
+
+
+def divide(state, depth, workers=1, use_cache=True):
+    """ Splits perft(state, depth) by root move. Returns a list of
+    (move, leaves) and the total positions expanded """
+    if depth == 0:
+        return [], 0
+    moves = []
+    jobs = []
+    for move, child in children(state):
+        moves.append(move)
+        jobs.append((clone(child), depth - 1, use_cache))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(perft_subtree, jobs))
+    else:
+        # One cache shared by every root move
+        cache = {} if use_cache else None
+        results = [perft(child, subdepth, cache)
+                   for child, subdepth, _ in jobs]
+
+    counts = [(move, leaves) for move, (leaves, _) in zip(moves, results)]
+    return counts, 1 + sum(expanded for _, expanded in results)
+
+
+def move_name(move):
+    """ Printable form of a root move """
+    return move if move == CANCEL else '%d-%d' % move
+
+
+def main():
+    """ Parses arguments and runs perft """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--position', help='Board.toCompact() string')
+    parser.add_argument('--turn', type=int, choices=[PLAYER1, PLAYER2],
+                        default=PLAYER1)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--divide', action='store_true',
+                        help='print the count below every root move')
+    args = parser.parse_args()
+
+    state = start_state(args.position, args.turn)
+    start = time.perf_counter()
+    counts, expanded = divide(state, args.depth, args.workers,
+                              not args.no_cache)
+    elapsed = time.perf_counter() - start
+
+    if args.divide:
+        for move, leaves in counts:
+            print('%-8s %d' % (move_name(move), leaves))
+    total = sum(leaves for _, leaves in counts) if args.depth else 1
+    print('perft(%d) = %d' % (args.depth, total))
+    print('%d positions expanded in %.2fs (%.0f/s) with %d workers' % (
+        expanded, elapsed, expanded / elapsed if elapsed else 0,
+        args.workers))
+
+
+if __name__ == '__main__':
+    main()
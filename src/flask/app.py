@@ -1,147 +1,895 @@
 """ app.py
     Contains the logic behind connecting the client and the server
 """
+import heapq
+import json
+import logging
+import multiprocessing
 import os
+import random
+import threading
 import sys
-from flask_socketio import SocketIO, emit, join_room
-from flask import Flask, render_template
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, Response, jsonify, render_template, request
 sys.path.insert(0, 'src/')
 
 try:
-    from State import State
+    from State import State, WAITING
+    from Search import CANCEL, findMove, position
 except ImportError:
     print('Failed to import Board.py')
     sys.exit()
 
+from rooms import open_room_store
+from lifecycle import RoomLifecycle
+from gamelog import open_game_log
+from spectators import SpectatorFeed
+from metrics import REGISTRY, count_sent, instrument_board
+from profiler import SamplingProfiler
+from resume import DeltaBuffer, ResumeTokens
+from matchmaking import MatchQueue
+from lobby import OPEN, STATUSES, LobbyIndex
+from assets import IMMUTABLE, asset_url_function, open_assets
+from validation import (SCHEMAS, RateLimiter, ILLEGAL_MOVE, NO_SUCH_ROOM,
+                        NOT_IN_ROOM, NOT_YOUR_TURN, RATE_LIMITED, BAD_SQUARE,
+                        WRONG_PLAYER, ROOM_FULL, BAD_TOKEN, NOT_STARTED,
+                        GAME_OVER)
+
+# Socket.IO event -> Handler method. Payloads are decoded by the event's
+# Schema before the method runs, see guard()
+EVENTS = {
+    'create': 'create',
+    'join': 'join',
+    'watch': 'watch',
+    'exit': 'disconnect',
+    'getMoves': 'get_moves',
+    'makeMove': 'make_move',
+    'makeMoveSequence': 'make_move_sequence',
+    'requestSnapshot': 'request_snapshot',
+    'resume': 'resume',
+    'queue': 'queue',
+    'unqueue': 'unqueue',
+    'lobby': 'list_rooms',
+    'leaveLobby': 'leave_lobby',
+}
+
+LOGGER = logging.getLogger('kingme.app')
+
+# Move handed to apply_ai when the search failed, see ai_failed()
+FALLBACK = 'fallback'
+# Seconds between checks on a computer search, see wait_ai()
+AI_POLL = 0.02
+
+# Socket.IO room of the clients following lobby changes
+LOBBY = 'lobby'
+# Rooms in a lobby page when the client does not say
+LOBBY_PAGE = 20
+
+# Handlers timed in the kingme_handler_seconds histograms
+INSTRUMENTED = ['create', 'join', 'watch', 'disconnect', 'get_moves',
+                'make_move', 'make_move_sequence', 'request_snapshot',
+                'resume', 'queue', 'unqueue', 'match_players', 'list_rooms',
+                'update', 'update_delta']
+
 
 class Handler:
     """ Class for the flask app object """
     template_dir = os.path.abspath('./src/templates/')
     static_dir = os.path.abspath('./src/static/')
+    # Output of src/flask/assets.py, served under /assets/ when built
+    assets_dir = os.path.abspath(os.environ.get('KINGME_ASSETS',
+                                                './src/dist/'))
     app = Flask(__name__, template_folder=template_dir,
                 static_url_path="", static_folder=static_dir)
-    socketio = SocketIO(app)
+    # Workers sharing rooms must also share broadcasts, through a message
+    # queue such as redis://localhost:6379/0
+    socketio = SocketIO(app, message_queue=os.environ.get('KINGME_MESSAGE_QUEUE'))
 
     def __init__(self):
-        """ Initialize handler by initializing room tracking data structure"""
-        self.game_handler = UniqueIDGenerator()
-        self.player_handler = UniqueIDGenerator()
-        self.rooms = {}
+        """ Initialize handler by initializing room tracking data structure
+            KINGME_ROOM_STORE selects where rooms live, see open_room_store
+            """
+        self.rooms = open_room_store(os.environ.get('KINGME_ROOM_STORE'))
+        # Room and player IDs are allocated by the store
+        self.player_handler = self.rooms.player_ids
+        # Finished and idle rooms are evicted after these many seconds
+        self.lifecycle = RoomLifecycle(
+            self.rooms,
+            idle_ttl=float(os.environ.get('KINGME_IDLE_TTL', 3600)),
+            finished_ttl=float(os.environ.get('KINGME_FINISHED_TTL', 300)))
+        # Socket.IO session id -> (room_id, player_id) of connected players
+        self.sessions = {}
+        # Computer moves are searched in worker processes, for this many
+        # seconds each
+        self.ai_time = float(os.environ.get('KINGME_AI_TIME', 1.0))
+        self.ai_workers = int(os.environ.get('KINGME_AI_WORKERS', 0)) or None
+        self.ai_executor = None
+        # Rooms that can be joined or watched, see list_rooms
+        self.lobby = LobbyIndex()
+        # Every game change is recorded in KINGME_GAME_LOG, if set, and the
+        # games it holds are recovered on startup
+        self.log = open_game_log(
+            os.environ.get('KINGME_GAME_LOG'), self.rooms,
+            fsync_interval=float(os.environ.get('KINGME_LOG_FSYNC', 1.0)),
+            compact_interval=float(os.environ.get('KINGME_LOG_COMPACT', 300)))
+        # Recovered rooms waiting for a computer move, see resume_ai()
+        self.recovered_ai = []
+        for room_id in self.log.recover():
+            with self.rooms.checkout(room_id) as game:
+                self.lifecycle.touch(room_id, game)
+                self.lobby.track(room_id, game)
+                if game.isComputerTurn():
+                    self.recovered_ai.append(room_id)
+        # Spectators get at most this many frames per second of a room
+        self.spectators = SpectatorFeed(
+            float(os.environ.get('KINGME_SPECTATOR_FPS', 4)))
+        # Players whose connection drops keep their seat for this many
+        # seconds, see dropped() and resume()
+        self.tokens = ResumeTokens(os.environ.get('KINGME_RESUME_SECRET'))
+        self.resume_grace = float(os.environ.get('KINGME_RESUME_GRACE', 30))
+        self.deltas = DeltaBuffer(int(os.environ.get('KINGME_RESUME_DELTAS',
+                                                     32)))
+        # (deadline, room_id, player_id) of the dropped players
+        self.drops = []
+        self.drops_lock = threading.Lock()
+        # Clients waiting for an opponent, paired every match_interval
+        # seconds by players' rating in buckets of KINGME_MATCH_BUCKET points
+        self.matchmaking = MatchQueue(
+            int(os.environ.get('KINGME_MATCH_BUCKET', 200)),
+            float(os.environ.get('KINGME_MATCH_WIDEN', 10)))
+        self.match_interval = float(os.environ.get('KINGME_MATCH_INTERVAL',
+                                                   0.5))
+        # Events a second each client may send on average, and in a burst
+        self.limiter = RateLimiter(
+            float(os.environ.get('KINGME_RATE_LIMIT', 20)),
+            int(os.environ.get('KINGME_RATE_BURST', 40)))
+        self.guard()
+        self.instrument()
+        # Built static assets, if any, and the index page rendered with them
+        self.assets = open_assets(self.assets_dir)
+        self.app.jinja_env.globals['asset_url'] = \
+            asset_url_function(self.assets)
+        self.index_html = None
+        # Sampling profiler driven through /profile, when KINGME_PROFILER
+        # is set
+        self.profiler = SamplingProfiler() \
+            if os.environ.get('KINGME_PROFILER') else None
+
+    def guard(self):
+        """ Puts every event method behind its Schema and the rate limit.
+        The methods then get the decoded payload, a dict of checked values,
+        and bad events are answered with an error without raising """
+        for event, name in EVENTS.items():
+            setattr(self, name, self.guarded(SCHEMAS[event],
+                                             getattr(self, name)))
+
+    def guarded(self, schema, method):
+        """ Wraps one event method, see guard() """
+        def guarded_method(data=None):
+            if schema.limited and not self.limiter.allow(self.sid()):
+                self.emit_error(RATE_LIMITED, 'Too many requests')
+                return
+            values, error = schema.decode(data)
+            if error is not None:
+                self.emit_error(*error)
+                return
+            method(values)
+        return guarded_method
+
+    def emit_error(self, code, message):
+        """ Sends an 'error' event to the current client """
+        self.emit('error', {'error': message, 'code': code})
+
+    def seated_player(self, room_id, claimed=None):
+        """ Returns the player ID of the current client if it plays in
+        room_id, otherwise tells it why it may not act there and returns
+        None. claimed is a player_id the client sent, which must be its own
+        """
+        session = self.sessions.get(self.sid())
+        if session is None or session[0] != room_id:
+            self.emit_error(NOT_IN_ROOM, 'You are not playing in this room')
+            return None
+        if claimed is not None and claimed != session[1]:
+            self.emit_error(WRONG_PLAYER, 'That player_id is not yours')
+            return None
+        if room_id not in self.rooms:
+            self.emit_error(NO_SUCH_ROOM, 'Room does not exist')
+            return None
+        return session[1]
+
+    def instrument(self):
+        """ Times the handlers and registers the gauges on /metrics.
+        Board methods are only timed when KINGME_METRICS_BOARD is set """
+        self.metrics = REGISTRY
+        for name in INSTRUMENTED:
+            setattr(self, name, self.metrics.timed(
+                'kingme_handler_seconds', 'handler', name,
+                getattr(self, name)))
+        if os.environ.get('KINGME_METRICS_BOARD'):
+            instrument_board(self.metrics)
+        count_sent(self.engineio(), self.metrics)
+        self.metrics.gauge('kingme_rooms', lambda: len(self.rooms))
+        self.metrics.gauge('kingme_connected_sockets',
+                           lambda: len(self.engineio().sockets))
 
     # pylint: disable=R0201
     def index(self):
-        """ Returns the index page"""
-        return render_template('index.html')
+        """ Returns the index page, rendered once """
+        if self.index_html is None:
+            self.index_html = render_template('index.html')
+        return self.index_html
+
+    def asset(self, path):
+        """ Returns a built asset in the best precompressed encoding the
+        client accepts. Its URL changes with its content, so clients may
+        cache it for good """
+        found = None if self.assets is None else self.assets.lookup(
+            path, request.headers.get('Accept-Encoding', ''))
+        if found is None:
+            return Response('Not Found', status=404, mimetype='text/plain')
+        content_type, encoding, body = found
+        response = Response(body, content_type=content_type)
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    # Transport hooks. Everything that talks to Socket.IO goes through these
+    # so that other servers (see asgi.py) can reuse the handlers.
+    def emit(self, event, data, room=None):
+        """ Sends an event to the current client, or to everyone in room.
+        Room broadcasts also work outside of an event handler """
+        if room is None:
+            emit(event, data)
+        else:
+            self.socketio.emit(event, data, to=room)
+
+    def enter_room(self, room, sid=None):
+        """ Adds the current client, or the client sid, to a Socket.IO
+        room """
+        if sid is None:
+            join_room(room)
+        else:
+            self.socketio.server.enter_room(sid, room, namespace='/')
+
+    @staticmethod
+    def leave_room(room):
+        """ Removes the current client from a Socket.IO room """
+        leave_room(room)
+
+    def close_room(self, room):
+        """ Removes every client from a Socket.IO room """
+        self.socketio.close_room(room)
+
+    @staticmethod
+    def sid():
+        """ Returns the Socket.IO session id of the current client """
+        return request.sid
+
+    def engineio(self):
+        """ Returns the Engine.IO server under Socket.IO """
+        return self.socketio.server.eio
+
+    def stats(self):
+        """ Returns the live room count and approximate bytes per room """
+        return jsonify(self.lifecycle.stats())
+
+    def lobby_page(self):
+        """ Returns the lobby page, the oldest rooms of every status """
+        games = []
+        for status in STATUSES:
+            games.extend(self.lobby.page(status, limit=LOBBY_PAGE)[0])
+        return render_template('lobby.html', games=games)
+
+    def lobby_json(self):
+        """ Returns a page of the lobby, see lobby_query() """
+        status, body = self.lobby_query(request.args.to_dict())
+        return Response(body, status=status, mimetype='application/json')
+
+    def lobby_query(self, query):
+        """ Runs /lobby.json, which takes the fields of a 'lobby' event
+        as query parameters. Returns (HTTP status, JSON body) """
+        values, error = SCHEMAS['lobby'].decode(query)
+        if error is not None:
+            return 400, json.dumps({'error': error[1], 'code': error[0]})
+        return 200, json.dumps(self.lobby_listing(values))
+
+    def lobby_listing(self, data):
+        """ A page of the lobby for a decoded 'lobby' payload """
+        status = data['status'] or OPEN
+        rooms, cursor = self.lobby.page(status, data['cursor'],
+                                        data['limit'] or LOBBY_PAGE)
+        return {'status': status, 'rooms': rooms, 'cursor': cursor}
+
+    def metrics_page(self):
+        """ Returns the metrics in the Prometheus text format """
+        return Response(self.metrics.render(), mimetype=PROMETHEUS_TYPE)
+
+    def profile_page(self, action='status'):
+        """ Starts or stops the sampling profiler, see profile() """
+        status, content_type, body = self.profile(action)
+        return Response(body, status=status, content_type=content_type)
+
+    def profile(self, action):
+        """ Runs /profile/<action>: 'start' samples stacks until 'stop',
+        which returns them folded for flamegraph.pl or speedscope. 'status'
+        reports on the current run. Returns (HTTP status, content type,
+        body) """
+        if self.profiler is None:
+            return 404, 'text/plain', 'Profiler disabled, set KINGME_PROFILER'
+        if action == 'start':
+            started = self.profiler.start()
+            return (200 if started else 409, 'application/json',
+                    json.dumps(self.profiler.status()))
+        if action == 'stop':
+            return 200, 'text/plain', self.profiler.stop()
+        if action == 'status':
+            return 200, 'application/json', json.dumps(self.profiler.status())
+        return 404, 'text/plain', 'Unknown profiler action'
+
+    def create(self, data=None):
+        """ Create a game lobby
+            Clients sending {'compact': True} get boards as Board.toCompact()
+            and {'ai': True} play against the computer right away.
+            {'mandatoryCapture': True} makes jumps compulsory
+            """
+        # Opportunistically drop expired rooms before making a new one
+        self.evict_rooms()
 
-    def create(self):
-        """ Create a game lobby """
         # Generate Player ID
         player1_id = self.player_handler.generate_id()
 
         # Initialize game
-        game = State(player1_id)
-
-        # Generate room ID
-        room_id = self.game_handler.generate_id()
+        game = State(player1_id, data['mandatoryCapture'])
+        if data['ai']:
+            game.joinComputer(self.player_handler.generate_id())
 
-        # Assign item in dictionary
-        self.rooms[room_id] = game
+        # Register the game under a new room ID
+        room_id = self.rooms.add(game)
 
         # Assign session id to room_id (in our case, unique integer identified)
         # Documentation: https://flask-socketio.readthedocs.io/en/latest/
-        join_room(room_id)
+        self.enter_room(self.channel(room_id, data['compact']))
 
         # Let client know what player_id and room_id ID were assigned
+        self.sessions[self.sid()] = (room_id, player1_id)
         self.emit_player_info(player1_id, room_id)
-        self.update(room_id)
+        with self.rooms.checkout(room_id) as game:
+            self.log.create(room_id, player1_id, game.mandatoryCapture)
+            if game.aiPlayer is not None:
+                self.log.join(room_id, game.aiPlayer, True)
+            self.lifecycle.touch(room_id, game)
+            self.update(room_id, game)
 
     def join(self, data):
         """ Join a game lobby and update participants """
-        try:
-            room_id = int(data['room_id'])
-        except ValueError:
-            emit('error', {'error': 'Room IDs must be integers'})
-            return
-
+        room_id = data['room_id']
         if room_id not in self.rooms:
-            emit('error', {'error': 'Room does not exist'})
+            self.emit_error(NO_SUCH_ROOM, 'Room does not exist')
             return
 
         # Generate player ID
         player2_id = self.player_handler.generate_id()
 
-        # Add player and then rebroadcast game object
-        self.rooms[room_id].join(player2_id)
-
-        # Assign user to session
-        join_room(room_id)
+        with self.rooms.checkout(room_id) as game:
+            if game.isFinished():
+                self.emit_error(GAME_OVER, 'Game is over')
+                return
+            if game.player2 is not None:
+                self.emit_error(ROOM_FULL, 'Room is full')
+                return
+
+            # Add player and then rebroadcast game object
+            game.join(player2_id)
+            self.log.join(room_id, player2_id, False)
+
+            # Assign user to session
+            self.enter_room(self.channel(room_id, data['compact']))
+
+            # Let client know what player_id and room_id ID were assigned
+            self.sessions[self.sid()] = (room_id, player2_id)
+            self.emit_player_info(player2_id, room_id)
+            self.lifecycle.touch(room_id, game)
+            self.update(room_id, game)
+
+    def watch(self, data):
+        """ Follow a game as a spectator. Spectators get the current state
+        right away, then coalesced 'update' snapshots, see SpectatorFeed """
+        room_id = data['room_id']
+        if room_id not in self.rooms:
+            self.emit_error(NO_SUCH_ROOM, 'Room does not exist')
+            return
 
-        # Let client know what player_id and room_id ID were assigned
-        self.emit_player_info(player2_id, room_id)
-        self.update(room_id)
+        self.enter_room(self.watch_channel(room_id, data['compact']))
+        self.emit('watch_room', {'room_id': room_id})
+        with self.rooms.checkout(room_id) as game:
+            # Counted on the game so that changes made on any worker
+            # sharing the store mark it for spectator frames
+            if self.spectators.watch(self.sid(), room_id):
+                game.watchers += 1
+            self.emit("update", game.toJSON(data['compact']))
+
+    def unwatch(self):
+        """ Stops counting the current client as a spectator """
+        for room_id in self.spectators.unwatch(self.sid()):
+            try:
+                with self.rooms.checkout(room_id) as game:
+                    game.watchers = max(0, game.watchers - 1)
+            except KeyError:
+                # The room was already evicted
+                pass
+
+    def list_rooms(self, data):
+        """ Sends a 'lobby' page of the rooms with 'status' (open rooms
+            unless given), oldest first. The 'cursor' it returns asks for the
+            next page. Clients sending {'subscribe': True} then get every
+            change to the listing as a 'lobby_change' until 'leaveLobby' """
+        if data['subscribe']:
+            self.enter_room(LOBBY)
+        self.emit('lobby', self.lobby_listing(data))
+
+    def leave_lobby(self, data=None):
+        """ Stops sending lobby changes to the current client """
+        self.leave_room(LOBBY)
+
+    def track_lobby(self, room_id, game):
+        """ Updates the lobby listing of a room and pushes the change """
+        change = self.lobby.track(room_id, game)
+        if change is not None:
+            self.emit('lobby_change', change, room=LOBBY)
+
+    def emit_player_info(self, player_id, room_id, sid=None):
+        """ Informs players of assigned information on joining a room,
+        the current client unless sid is given """
+        self.emit('join_room', {
+            'player_id': player_id,
+            'room_id': room_id,
+            'resume_token': self.tokens.sign(room_id, player_id)
+        }, room=sid)
+
+    def queue(self, data):
+        """ Waits for an opponent instead of sharing a room ID. Clients
+            may send their 'rating' to meet players of a similar one, see
+            MatchQueue. They get 'queued' now and, once paired by
+            match_players, 'join_room' and 'update' as if they had created
+            or joined the room themselves """
+        self.matchmaking.add(self.sid(), data['rating'],
+                             data['mandatoryCapture'],
+                             {'compact': data['compact'],
+                              'mandatoryCapture': data['mandatoryCapture']})
+        self.emit('queued', {'waiting': len(self.matchmaking)})
+
+    def unqueue(self, data=None):
+        """ Stops waiting for an opponent """
+        self.matchmaking.cancel(self.sid())
+        self.emit('unqueued', {})
+
+    def match_players(self):
+        """ Gives every pair of queued players a room of their own. The
+        player who queued first moves first """
+        for sid1, options1, sid2, options2 in self.matchmaking.match():
+            player1_id = self.player_handler.generate_id()
+            player2_id = self.player_handler.generate_id()
+            game = State(player1_id, options1['mandatoryCapture'])
+            game.join(player2_id)
+            room_id = self.rooms.add(game)
+
+            with self.rooms.checkout(room_id) as game:
+                self.log.create(room_id, player1_id, game.mandatoryCapture)
+                self.log.join(room_id, player2_id, False)
+                for sid, player_id, options in [(sid1, player1_id, options1),
+                                                (sid2, player2_id, options2)]:
+                    self.enter_room(self.channel(room_id, options['compact']),
+                                    sid)
+                    self.sessions[sid] = (room_id, player_id)
+                    self.emit_player_info(player_id, room_id, sid)
+                self.lifecycle.touch(room_id, game)
+                self.update(room_id, game)
+
+    def match_loop(self):
+        """ Background task pairing queued players every match_interval
+        seconds """
+        while True:
+            self.socketio.sleep(self.match_interval)
+            self.match_players()
+
+    def resume(self, data):
+        """ Reattaches a client to the seat of its resume token, e.g. after
+            its connection dropped. The client gets 'join_room' again, then
+            the deltas since the 'seq' it sends when the buffer still has
+            them all, or else one snapshot """
+        seat = self.tokens.verify(data['token'])
+        if seat is None:
+            self.emit_error(BAD_TOKEN, 'Resume token is not valid')
+            return
+        room_id, player_id = seat
+        if room_id not in self.rooms:
+            self.emit_error(NO_SUCH_ROOM, 'Room does not exist')
+            return
 
-    def emit_player_info(self, player_id, room_id):
-        """ Informs players of assigned information on joining a room """
-        emit('join_room', {'player_id': player_id, 'room_id': room_id})
+        with self.rooms.checkout(room_id) as game:
+            game.dropped.pop(player_id, None)
+            self.enter_room(self.channel(room_id, data['compact']))
+            self.sessions[self.sid()] = (room_id, player_id)
+            self.emit_player_info(player_id, room_id)
+
+            missed = None
+            if data['seq'] is not None and data['seq'] <= game.seq:
+                missed = self.deltas.missed(room_id, data['seq'],
+                                            data['compact'])
+            if missed is None:
+                self.emit("update", game.toJSON(data['compact']))
+            else:
+                for delta in missed:
+                    self.emit("update_delta", delta)
+            self.lifecycle.touch(room_id, game)
 
-    def disconnect(self, data):
-        """" Defines behavior for when a user disconnects from a room """
-        # room_id = data['room_id']
-        # player_id = data['player_id']
+    # pylint: disable=W0613
+    def disconnect(self, data=None):
+        """" Defines behavior for when a user disconnects from a room
+            The game ends with P1_DISCONNECT/P2_DISCONNECT and the other
+            player is told they won by forfeit. A room nobody joined yet is
+            removed right away """
+        self.limiter.forget(self.sid())
+        self.matchmaking.cancel(self.sid())
+        self.unwatch()
+        session = self.sessions.pop(self.sid(), None)
+        if session is None:
+            return
+        room_id, player_id = session
 
-        # Assign the room with id room_id as inactive
-        # and mark player_id player as disconnected
-        # pass
+        try:
+            with self.rooms.checkout(room_id) as game:
+                abandoned = game.player2 is None
+                game.disconnect(player_id)
+                self.log.disconnect(room_id, player_id)
+                self.lifecycle.touch(room_id, game)
+                self.update(room_id, game)
+        except KeyError:
+            # The room was already evicted
+            return
+        if abandoned:
+            self.remove_room(room_id)
+
+    def dropped(self, reason=None):
+        """ The connection of a client was lost. A player keeps their seat
+            for resume_grace seconds in case they resume, and forfeits
+            like on 'exit' if they do not """
+        if self.resume_grace <= 0:
+            self.disconnect()
+            return
+        self.limiter.forget(self.sid())
+        self.matchmaking.cancel(self.sid())
+        self.unwatch()
+        session = self.sessions.pop(self.sid(), None)
+        if session is None:
+            return
+        room_id, player_id = session
 
-    def update(self, room_id):
+        deadline = self.lifecycle.clock() + self.resume_grace
+        try:
+            with self.rooms.checkout(room_id) as game:
+                if game.isFinished():
+                    return
+                # Kept on the game so that resuming on another worker counts
+                game.dropped[player_id] = deadline
+        except KeyError:
+            return
+        with self.drops_lock:
+            heapq.heappush(self.drops, (deadline, room_id, player_id))
+
+    def forfeit_dropped(self):
+        """ Ends the games of dropped players who did not resume in time """
+        now = self.lifecycle.clock()
+        while True:
+            with self.drops_lock:
+                if not self.drops or self.drops[0][0] > now:
+                    return
+                deadline, room_id, player_id = heapq.heappop(self.drops)
+            try:
+                with self.rooms.checkout(room_id) as game:
+                    if game.dropped.get(player_id) != deadline:
+                        # Resumed in the meantime
+                        continue
+                    del game.dropped[player_id]
+                    abandoned = game.player2 is None
+                    game.disconnect(player_id)
+                    self.log.disconnect(room_id, player_id)
+                    self.lifecycle.touch(room_id, game)
+                    self.update(room_id, game)
+            except KeyError:
+                # The room was already evicted
+                continue
+            if abandoned:
+                self.remove_room(room_id)
+
+    def evict_rooms(self):
+        """ Forfeits players who dropped for good and drops finished and
+        idle rooms whose TTL has passed """
+        self.forfeit_dropped()
+        for room_id in self.lifecycle.evict():
+            self.forget_room(room_id)
+
+    def remove_room(self, room_id):
+        """ Drops a room without waiting for its TTL """
+        if self.rooms.remove(room_id) is None:
+            return
+        self.lifecycle.forget(room_id)
+        self.forget_room(room_id)
+
+    def forget_room(self, room_id):
+        """ Drops everything kept about a room removed from the store """
+        self.log.remove(room_id)
+        self.spectators.forget(room_id)
+        self.deltas.forget(room_id)
+        change = self.lobby.forget(room_id)
+        if change is not None:
+            self.emit('lobby_change', change, room=LOBBY)
+        for compact in [False, True]:
+            self.close_room(self.channel(room_id, compact))
+            self.close_room(self.watch_channel(room_id, compact))
+
+    def evict_loop(self, interval=10):
+        """ Background task evicting expired rooms every interval seconds """
+        while True:
+            self.socketio.sleep(interval)
+            self.evict_rooms()
+
+    @staticmethod
+    def channel(room_id, compact):
+        """ Socket.IO room used by the clients of a game that share a
+        board encoding """
+        if compact:
+            return '%d:compact' % room_id
+        return room_id
+
+    @staticmethod
+    def watch_channel(room_id, compact):
+        """ Socket.IO room used by the spectators of a game that share a
+        board encoding """
+        if compact:
+            return '%d:watch:compact' % room_id
+        return '%d:watch' % room_id
+
+    def update(self, room_id, game):
         """ Broadcasts a game state to players in a room
             You'll want to update the board before calling this function
             """
-        emit("update", self.rooms[room_id].toJSON(), room=room_id)
+        self.emit("update", game.toJSON(),
+                  room=self.channel(room_id, False))
+        self.emit("update", game.toJSON(True),
+                  room=self.channel(room_id, True))
+        self.deltas.reset(room_id, game.seq)
+        if game.watchers:
+            self.spectators.mark(room_id)
+        self.track_lobby(room_id, game)
+
+    def update_delta(self, room_id, game):
+        """ Broadcasts only what changed since the previous update.
+        Clients that notice a gap in 'seq' ask for a full snapshot
+        through request_snapshot """
+        game.publish()
+        delta = game.toDelta()
+        compact_delta = game.toDelta(True)
+        self.emit("update_delta", delta, room=self.channel(room_id, False))
+        self.emit("update_delta", compact_delta,
+                  room=self.channel(room_id, True))
+        self.deltas.record(room_id, game.seq, delta, compact_delta)
+        if game.watchers:
+            self.spectators.mark(room_id)
+        self.track_lobby(room_id, game)
+
+    def send_spectator_frames(self):
+        """ Broadcasts the latest state of every room whose spectator frame
+        is due. Each frame is serialized once per encoding and Socket.IO
+        encodes a room broadcast once for all of its members. Only rooms
+        with spectators are ever due, see update() """
+        for room_id in self.spectators.take():
+            try:
+                # Serializing may update the game, e.g. its move cache
+                with self.rooms.checkout(room_id) as game:
+                    for compact in [False, True]:
+                        self.emit("update", game.toJSON(compact),
+                                  room=self.watch_channel(room_id, compact))
+            except KeyError:
+                # The room was evicted since it changed
+                self.spectators.forget(room_id)
+
+    def spectator_loop(self):
+        """ Background task sending spectator frames as they become due """
+        while True:
+            self.socketio.sleep(self.spectators.interval / 2)
+            self.send_spectator_frames()
+
+    def request_snapshot(self, data):
+        """ Sends a full snapshot of a room to the requesting client only """
+        room_id = data['room_id']
+        if room_id not in self.rooms:
+            self.emit_error(NO_SUCH_ROOM, 'Room does not exist')
+            return
+
+        with self.rooms.checkout(room_id) as game:
+            self.emit("update", game.toJSON(data['compact']))
 
-    # pylint: disable=W0613
     def get_moves(self, data):
         """ Get valid moves for a board state """
-        piece = int(data['pieceToMove'])
+        piece = data['pieceToMove']
         room_id = data['room_id']
-        moves = self.rooms[room_id].getMoves(piece)
+        player_id = self.seated_player(room_id, data['player_id'])
+        if player_id is None:
+            return
+        with self.rooms.checkout(room_id) as game:
+            moves = game.getMoves(piece)
         get_moves = {
-            'player_id': data['player_id'],
+            'player_id': player_id,
             'pieces': moves,
-            'pieceBeingMoved': data['pieceToMove']
+            'pieceBeingMoved': piece
         }
 
-        emit("sendMoves", get_moves)
+        self.emit("sendMoves", get_moves)
 
     def make_move(self, data):
-        """ This is to handle make move functionality -- [make move schema] """
-        if not bool(data['makeMove']):
-            if self.rooms[data['room_id']].prevChainJmp is not None:
-                self.rooms[data['room_id']].cancelMove()
-        else:
-            self.rooms[data['room_id']].makeMove(
-                int(data['pieceToMove']),
-                int(data['moveToLocation'])
-            )
-        self.update(data['room_id'])
-        # Perform computation and update the board with new data
-
-
-class UniqueIDGenerator:
-    """ Class to handle IDs """
-
-    def __init__(self):
-        self.uid = 0
+        """ This is to handle make move functionality -- [make move schema]
+            Moves are checked against the legal moves of the turn, which
+            are cached per position, before anything changes """
+        room_id = data['room_id']
+        src = data['pieceToMove']
+        dest = data['moveToLocation']
+        if data['makeMove'] and (src is None or dest is None):
+            self.emit_error(BAD_SQUARE, 'Moves need a pieceToMove and a '
+                                        'moveToLocation')
+            return
+        player_id = self.seated_player(room_id, data['player_id'])
+        if player_id is None:
+            return
 
-    def generate_id(self):
-        """ Generates a unique id for a given object """
-        self.update_ids()
-        return self.uid
+        # Moves on the same room are applied and broadcast one at a time
+        with self.rooms.checkout(room_id) as game:
+            if game.state == WAITING:
+                self.emit_error(NOT_STARTED, 'Waiting for an opponent')
+                return
+            if game.playerTurn != player_id or game.isFinished():
+                self.emit_error(NOT_YOUR_TURN, 'It is not your turn')
+                return
+            if not data['makeMove']:
+                if (game.prevChainJmp is not None and
+                        not game.mandatoryCapture):
+                    game.cancelMove()
+                    self.log.cancel(room_id)
+            else:
+                if dest not in game.turnMoves().get(src, ()):
+                    self.emit_error(ILLEGAL_MOVE, 'Illegal move')
+                    return
+                game.makeMove(src, dest)
+                self.log.move(room_id, src, dest)
+            self.moved(room_id, game)
+
+    def make_move_sequence(self, data):
+        """ Plays a whole turn, e.g. every jump of a chain, from
+        {'room_id': ..., 'path': [src, landing, landing, ...]}. The path is
+        checked before anything moves and players get a single update """
+        room_id = data['room_id']
+        path = data['path']
+        player_id = self.seated_player(room_id)
+        if player_id is None:
+            return
 
-    def update_ids(self):
-        """ Updates the IDs. This implementation
-        increments the ids sequentially """
-        self.uid += 1
+        with self.rooms.checkout(room_id) as game:
+            if game.state == WAITING:
+                self.emit_error(NOT_STARTED, 'Waiting for an opponent')
+                return
+            if game.playerTurn != player_id or game.isFinished():
+                self.emit_error(NOT_YOUR_TURN, 'It is not your turn')
+                return
+            try:
+                game.makeMoveSequence(path)
+            except ValueError:
+                self.emit_error(ILLEGAL_MOVE, 'Illegal move sequence')
+                return
+            self.log.sequence(room_id, path)
+            self.moved(room_id, game)
+
+    def moved(self, room_id, game):
+        """ Broadcasts a move and hands the turn to the computer if it is
+        its move """
+        self.lifecycle.touch(room_id, game)
+        self.update_delta(room_id, game)
+        if game.isComputerTurn():
+            self.schedule_ai(room_id, game)
+
+    def ai_pool(self):
+        """ Worker processes searching computer moves, started on first use.
+        Spawned rather than forked, the server runs threads """
+        if self.ai_executor is None:
+            self.ai_executor = ProcessPoolExecutor(
+                max_workers=self.ai_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        return self.ai_executor
+
+    def schedule_ai(self, room_id, game):
+        """ Starts searching the computer's move in the worker pool, a
+        background task applies it once found """
+        future = self.ai_pool().submit(findMove, position(game), self.ai_time,
+                                       game.mandatoryCapture)
+        self.socketio.start_background_task(
+            self.wait_ai, room_id, game.positionHash(), future)
+
+    def resume_ai(self):
+        """ Searches the computer's move in recovered rooms where it was
+        its turn, call once the server is running """
+        room_ids, self.recovered_ai = self.recovered_ai, []
+        for room_id in room_ids:
+            try:
+                with self.rooms.checkout(room_id) as game:
+                    if game.isComputerTurn():
+                        self.schedule_ai(room_id, game)
+            except KeyError:
+                # The room was already evicted
+                pass
+
+    def wait_ai(self, room_id, expected, future):
+        """ Background task waiting for a computer move. Polls with
+        socketio.sleep, blocking on the future would stall eventlet's hub
+        and every other room with it """
+        while not future.done():
+            self.socketio.sleep(AI_POLL)
+        try:
+            move = future.result()
+        except Exception as error:  # pylint: disable=W0703
+            move = self.ai_failed(room_id, error)
+        self.apply_ai(room_id, expected, move)
+
+    def ai_failed(self, room_id, error):
+        """ Reports a search that raised, e.g. because a worker died, and
+        returns FALLBACK so that the computer still moves. A broken pool is
+        replaced on the next search """
+        LOGGER.error('AI search failed in room %d', room_id, exc_info=error)
+        if isinstance(error, BrokenProcessPool):
+            self.ai_executor = None
+        return FALLBACK
+
+    @staticmethod
+    def fallback_move(game):
+        """ A random legal move of the computer, or CANCEL to end a jump
+        chain that cannot go on """
+        moves = [(src, dest) for src, dests in sorted(game.turnMoves().items())
+                 for dest in dests]
+        if moves:
+            return random.choice(moves)
+        if game.prevChainJmp is not None:
+            return CANCEL
+        return None
+
+    def apply_ai(self, room_id, expected, move):
+        """ Plays a computer move searched from the position hashed as
+        expected, unless the game moved on in the meantime. FALLBACK plays
+        a random legal move instead """
+        try:
+            with self.rooms.checkout(room_id) as game:
+                if not game.isComputerTurn() or \
+                        game.positionHash() != expected:
+                    return
+                if move == FALLBACK:
+                    move = self.fallback_move(game)
+                if move is None:
+                    return
+                if move == CANCEL:
+                    game.cancelMove()
+                    self.log.cancel(room_id)
+                else:
+                    game.makeMove(*move)
+                    self.log.move(room_id, *move)
+                self.moved(room_id, game)
+        except KeyError:
+            # The room was evicted while searching
+            pass
+
+
+# Content type of the Prometheus text format
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
 
 def get_handler():
@@ -150,18 +898,30 @@ def get_handler():
 
     # URL Routes
     handler.app.add_url_rule('/', 'index', handler.index)
+    handler.app.add_url_rule('/stats', 'stats', handler.stats)
+    handler.app.add_url_rule('/assets/<path:path>', 'asset', handler.asset)
+    handler.app.add_url_rule('/lobby', 'lobby', handler.lobby_page)
+    handler.app.add_url_rule('/lobby.json', 'lobby_json', handler.lobby_json)
+    handler.app.add_url_rule('/metrics', 'metrics', handler.metrics_page)
+    handler.app.add_url_rule('/profile/<action>', 'profile',
+                             handler.profile_page)
 
     # Socket IO event handling
-    handler.socketio.on_event('create', handler.create)
-    handler.socketio.on_event('join', handler.join)
-    handler.socketio.on_event('exit', handler.disconnect)
-    handler.socketio.on_event('getMoves', handler.get_moves)
-    handler.socketio.on_event('makeMove', handler.make_move)
+    for event, name in EVENTS.items():
+        handler.socketio.on_event(event, getattr(handler, name))
+    handler.socketio.on_event('disconnect', handler.dropped)
 
     return handler
 
 
 if __name__ == '__main__':
     HANDLER = get_handler()
+    HANDLER.socketio.start_background_task(HANDLER.evict_loop)
+    HANDLER.socketio.start_background_task(HANDLER.spectator_loop)
+    HANDLER.socketio.start_background_task(HANDLER.match_loop)
+    HANDLER.log.start()
+    HANDLER.resume_ai()
     # App configs
-    HANDLER.socketio.run(HANDLER.app, host='0.0.0.0', port=5000, debug=True)
+    HANDLER.socketio.run(HANDLER.app, host='0.0.0.0',
+                         port=int(os.environ.get('KINGME_PORT', 5000)),
+                         debug=True)
@@ -0,0 +1,253 @@
+""" asgi.py
+    Production entry point: python-socketio's AsyncServer under an ASGI
+    server, reusing Handler for all of the game logic.
+
+    Run with:
+        uvicorn asgi:app --app-dir src/flask --host 0.0.0.0 --port 5000
+    or:
+        python src/flask/asgi.py
+
+    app.py keeps serving the Flask development server.
+"""
+import asyncio
+import contextvars
+import json
+import os
+from urllib.parse import parse_qsl
+
+import socketio
+from flask import render_template
+
+from app import EVENTS, Handler, PROMETHEUS_TYPE
+from assets import IMMUTABLE, PREFIX
+from Search import findMove, position
+
+# (sid, outbox) of the event being handled
+CURRENT = contextvars.ContextVar('current')
+
+
+class AsyncHandler(Handler):
+    """ Runs the Handler logic for an AsyncServer.
+        Handler methods stay synchronous: while one runs, everything it
+        sends is queued in an outbox, which dispatch() then flushes with the
+        AsyncServer coroutines. Game logic never awaits, so an event is
+        applied atomically with respect to the event loop.
+        """
+
+    def __init__(self, sio):
+        self.sio = sio
+        super().__init__()
+        # Pending computer moves, referenced until they are applied
+        self.ai_tasks = set()
+
+    async def dispatch(self, sid, method, *args):
+        """ Calls a Handler method on behalf of sid and sends its output """
+        outbox = []
+        token = CURRENT.set((sid, outbox))
+        try:
+            method(*args)
+        finally:
+            CURRENT.reset(token)
+
+        for operation, *params in outbox:
+            if operation == 'emit':
+                event, data, room = params
+                await self.sio.emit(event, data, to=room)
+            elif operation == 'enter':
+                await self.sio.enter_room(*params)
+            elif operation == 'leave':
+                await self.sio.leave_room(*params)
+            elif operation == 'close':
+                await self.sio.close_room(*params)
+
+    @staticmethod
+    def emit(event, data, room=None):
+        """ Queues an event for the current client, or everyone in room """
+        sid, outbox = CURRENT.get()
+        outbox.append(('emit', event, data, sid if room is None else room))
+
+    @staticmethod
+    def enter_room(room, sid=None):
+        """ Queues adding the current client, or the client sid, to a
+        Socket.IO room """
+        current, outbox = CURRENT.get()
+        outbox.append(('enter', current if sid is None else sid, room))
+
+    @staticmethod
+    def leave_room(room):
+        """ Queues removing the current client from a Socket.IO room """
+        sid, outbox = CURRENT.get()
+        outbox.append(('leave', sid, room))
+
+    def close_room(self, room):
+        """ Queues removing every client from a Socket.IO room """
+        CURRENT.get()[1].append(('close', room))
+
+    @staticmethod
+    def sid():
+        """ Returns the Socket.IO session id of the current client """
+        return CURRENT.get()[0]
+
+    def engineio(self):
+        """ Returns the Engine.IO server under the AsyncServer """
+        return self.sio.eio
+
+    def schedule_ai(self, room_id, game):
+        """ Searches the computer's move in the worker pool without blocking
+        the event loop """
+        future = asyncio.get_running_loop().run_in_executor(
+            self.ai_pool(), findMove, position(game), self.ai_time,
+            game.mandatoryCapture)
+        task = asyncio.ensure_future(
+            self.finish_ai(room_id, game.positionHash(), future))
+        self.ai_tasks.add(task)
+        task.add_done_callback(self.ai_tasks.discard)
+
+    async def finish_ai(self, room_id, expected, future):
+        """ Applies a computer move once its search is done """
+        try:
+            move = await future
+        except Exception as error:  # pylint: disable=W0703
+            move = self.ai_failed(room_id, error)
+        await self.dispatch(None, self.apply_ai, room_id, expected, move)
+
+    async def evict_loop(self, interval=10):
+        """ Background task evicting expired rooms every interval seconds """
+        while True:
+            await asyncio.sleep(interval)
+            await self.dispatch(None, self.evict_rooms)
+
+    async def spectator_loop(self):
+        """ Background task sending spectator frames as they become due """
+        while True:
+            await asyncio.sleep(self.spectators.interval / 2)
+            await self.dispatch(None, self.send_spectator_frames)
+
+    async def match_loop(self):
+        """ Background task pairing queued players every match_interval
+        seconds """
+        while True:
+            await asyncio.sleep(self.match_interval)
+            await self.dispatch(None, self.match_players)
+
+
+def create_app():
+    """ Builds the AsyncServer, registers the Handler events on it and wraps
+    it in an ASGI application """
+    sio = socketio.AsyncServer(
+        async_mode='asgi',
+        client_manager=message_queue(os.environ.get('KINGME_MESSAGE_QUEUE')))
+    handler = AsyncHandler(sio)
+
+    # Same events as get_handler() registers on the Flask server
+    for event, name in EVENTS.items():
+        sio.on(event, make_event_handler(handler, getattr(handler, name)))
+
+    async def disconnect(sid, *_):
+        await handler.dispatch(sid, handler.dropped)
+    sio.on('disconnect', disconnect)
+
+    # Templates are static once rendered, so render the index page once
+    with Handler.app.app_context():
+        index_html = render_template('index.html').encode()
+
+    async def http_app(scope, _receive, send):
+        """ Serves the index page, built assets, the lobby, /stats,
+        /metrics and /profile, plain static files are served by ASGIApp """
+        path = scope['path']
+        if path == '/':
+            await respond(send, 200, 'text/html; charset=utf-8', index_html)
+        elif path.startswith(PREFIX) and handler.assets is not None:
+            found = handler.assets.lookup(path[len(PREFIX):], header(
+                scope, b'accept-encoding'))
+            if found is None:
+                await respond(send, 404, 'text/plain', b'Not Found')
+                return
+            content_type, encoding, body = found
+            headers = [(b'cache-control', IMMUTABLE.encode()),
+                       (b'vary', b'Accept-Encoding')]
+            if encoding != 'identity':
+                headers.append((b'content-encoding', encoding.encode()))
+            await respond(send, 200, content_type, body, headers)
+        elif path == '/lobby':
+            with Handler.app.app_context():
+                body = handler.lobby_page().encode()
+            await respond(send, 200, 'text/html; charset=utf-8', body)
+        elif path == '/lobby.json':
+            status, body = handler.lobby_query(
+                dict(parse_qsl(scope['query_string'].decode())))
+            await respond(send, status, 'application/json', body.encode())
+        elif path == '/stats':
+            body = json.dumps(handler.lifecycle.stats()).encode()
+            await respond(send, 200, 'application/json', body)
+        elif path == '/metrics':
+            await respond(send, 200, PROMETHEUS_TYPE,
+                          handler.metrics.render().encode())
+        elif path.startswith('/profile/'):
+            status, content_type, body = handler.profile(
+                path[len('/profile/'):])
+            await respond(send, status, content_type, body.encode())
+        else:
+            await respond(send, 404, 'text/plain', b'Not Found')
+
+    async def on_startup():
+        sio.start_background_task(handler.evict_loop)
+        sio.start_background_task(handler.spectator_loop)
+        sio.start_background_task(handler.match_loop)
+        handler.log.start()
+        handler.resume_ai()
+
+    static_dir = Handler.static_dir
+    static_files = {
+        '/' + name: os.path.join(static_dir, name)
+        for name in os.listdir(static_dir)
+        if os.path.isdir(os.path.join(static_dir, name))
+    }
+    return socketio.ASGIApp(sio, other_asgi_app=http_app,
+                            static_files=static_files,
+                            on_startup=on_startup), handler
+
+
+def make_event_handler(handler, method):
+    """ Wraps a Handler method as an AsyncServer event handler """
+    async def on_event(sid, data=None):
+        if data is None:
+            await handler.dispatch(sid, method)
+        else:
+            await handler.dispatch(sid, method, data)
+    return on_event
+
+
+def message_queue(url):
+    """ Async client manager for the KINGME_MESSAGE_QUEUE url, if any """
+    if not url:
+        return None
+    if url.startswith('redis://'):
+        return socketio.AsyncRedisManager(url)
+    return socketio.AsyncAioPikaManager(url)
+
+
+def header(scope, name):
+    """ Value of a request header, '' when missing """
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+async def respond(send, status, content_type, body, headers=()):
+    """ Sends a complete HTTP response """
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode()),
+                            (b'content-length', str(len(body)).encode())] +
+                           list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+app, HANDLER = create_app()
+
+
+if __name__ == '__main__':
+    import uvicorn  # pylint: disable=C0415
+    uvicorn.run(app, host='0.0.0.0',
+                port=int(os.environ.get('KINGME_PORT', 5000)))
@@ -0,0 +1,214 @@
+""" assets.py
+    Build step and server side of the static assets.
+
+    Running this file minifies the scripts and stylesheets of src/static,
+    names every file after a hash of its content and stores gzip and, when
+    the brotli package is installed, brotli versions next to it. A manifest
+    maps the original names to the hashed ones:
+
+        python src/flask/assets.py [static dir] [output dir]
+
+    The servers load the build into memory with AssetStore and serve it
+    under /assets/ as immutable, the hash changing whenever the content
+    does. Templates link assets with asset_url('js/board.js'), which falls
+    back to the plain files of src/static when there is no build.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# URL prefix of the built assets
+PREFIX = '/assets/'
+MANIFEST = 'manifest.json'
+# Cache-Control of the built assets, whose URLs change with their content
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Files worth compressing, the others (images, fonts) already are
+COMPRESSIBLE = ('.js', '.css', '.map', '.txt', '.svg', '.html', '.json')
+# Precompressed encodings, preferred first, and their file suffix
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def minify_css(text):
+    """ Drops comments and collapses whitespace """
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip() + '\n'
+
+
+def minify_js(text):
+    """ Drops comments and indentation. Conservative: lines are kept apart,
+    so automatic semicolon insertion still sees the same code, and comments
+    are only recognised at the start of a line, where they cannot be part
+    of a string or a regular expression. Code after the end of a block
+    comment is kept """
+    lines = []
+    in_comment = False
+    for line in text.splitlines():
+        line = line.strip()
+        while line:
+            if in_comment:
+                end = line.find('*/')
+                if end < 0:
+                    break
+                in_comment = False
+                line = line[end + 2:].strip()
+            elif line.startswith('/*'):
+                in_comment = True
+                line = line[2:]
+            else:
+                if not line.startswith('//'):
+                    lines.append(line)
+                break
+    return '\n'.join(lines) + '\n'
+
+
+def minify(name, content):
+    """ Minified content of a file, unchanged for files already minified
+    and anything but scripts and stylesheets """
+    if '.min.' in name:
+        return content
+    if name.endswith('.css'):
+        return minify_css(content.decode('utf-8')).encode('utf-8')
+    if name.endswith('.js'):
+        return minify_js(content.decode('utf-8')).encode('utf-8')
+    return content
+
+
+def hashed_name(name, content):
+    """ name with a hash of content before its extension. Source maps keep
+    their name, the files they belong to refer to them by it """
+    if name.endswith('.map'):
+        return name
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def compress(content):
+    """ (encoding, suffix, compressed content) of every precompressed
+    encoding that makes content smaller """
+    versions = []
+    for encoding, suffix in ENCODINGS:
+        if encoding == 'br':
+            if brotli is None:
+                continue
+            packed = brotli.compress(content, quality=11)
+        else:
+            packed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(packed) < len(content):
+            versions.append((encoding, suffix, packed))
+    return versions
+
+
+def build(static_dir, out_dir):
+    """ Builds every file of static_dir into out_dir, returns the manifest """
+    manifest = {}
+    for root, _, files in os.walk(static_dir):
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as source:
+                content = minify(name, source.read())
+            built = hashed_name(name, content)
+            manifest[name] = built
+
+            target = os.path.join(out_dir, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as output:
+                output.write(content)
+            if name.endswith(COMPRESSIBLE):
+                for _, suffix, packed in compress(content):
+                    with open(target + suffix, 'wb') as output:
+                        output.write(packed)
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as output:
+        json.dump(manifest, output, indent=1, sort_keys=True)
+    return manifest
+
+
+class AssetStore:
+    """ A build held in memory, every encoding of every file """
+
+    def __init__(self, out_dir):
+        with open(os.path.join(out_dir, MANIFEST)) as source:
+            self.manifest = json.load(source)
+        # Built name -> (content type, {encoding: content})
+        self.files = {}
+        for built in self.manifest.values():
+            path = os.path.join(out_dir, built)
+            versions = {}
+            with open(path, 'rb') as source:
+                versions['identity'] = source.read()
+            for encoding, suffix in ENCODINGS:
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, 'rb') as source:
+                        versions[encoding] = source.read()
+            content_type = mimetypes.guess_type(built)[0] or \
+                'application/octet-stream'
+            if content_type.startswith('text/') or \
+                    content_type == 'application/javascript':
+                content_type += '; charset=utf-8'
+            self.files[built] = (content_type, versions)
+
+    def url(self, name):
+        """ URL of the built version of a file of src/static """
+        return PREFIX + self.manifest[name]
+
+    def lookup(self, path, accept_encoding=''):
+        """ Returns (content type, encoding, content) of the file at path
+        below PREFIX in the best encoding the client accepts, or None """
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+        content_type, versions = entry
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, _ in ENCODINGS:
+            if encoding in versions and encoding in accepted:
+                return content_type, encoding, versions[encoding]
+        return content_type, 'identity', versions['identity']
+
+
+def accepted_encodings(header):
+    """ Encodings named in an Accept-Encoding header, except those refused
+    with q=0 """
+    accepted = set()
+    for item in header.split(','):
+        encoding, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if encoding and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def open_assets(out_dir):
+    """ The AssetStore of out_dir, None when nothing was built there """
+    if not out_dir or not os.path.exists(os.path.join(out_dir, MANIFEST)):
+        return None
+    return AssetStore(out_dir)
+
+
+def asset_url_function(assets):
+    """ The asset_url() of the templates for a store, or for the plain
+    files of src/static when assets is None """
+    if assets is None:
+        return lambda name: '/' + name
+    return assets.url
+
+
+if __name__ == '__main__':
+    STATIC_DIR = sys.argv[1] if len(sys.argv) > 1 else 'src/static'
+    OUT_DIR = sys.argv[2] if len(sys.argv) > 2 else \
+        os.environ.get('KINGME_ASSETS', 'src/dist')
+    BUILT = build(STATIC_DIR, OUT_DIR)
+    print('Built %d assets into %s%s' % (
+        len(BUILT), OUT_DIR, '' if brotli else ' (no brotli)'))
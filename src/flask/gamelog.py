@@ -0,0 +1,363 @@
+""" gamelog.py
+    Write-ahead log of every game change, so that the games of the in
+    memory room store survive a restart.
+
+    The log directory holds numbered segments of binary records plus a
+    snapshot of every live game. Records are buffered and written with an
+    fsync every fsync_interval seconds, so a crash loses at most that much.
+    On startup the snapshot is loaded and the newer records are replayed
+    through State. Compaction periodically writes a new snapshot and drops
+    the segments it covers, which keeps replay time bounded.
+"""
+import os
+import logging
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from State import State
+from rooms import RoomRegistry
+
+LOGGER = logging.getLogger('kingme.gamelog')
+
+# Record kinds and their payloads
+CREATE = 1      # player1 ID, flags (FLAG_MANDATORY_CAPTURE)
+JOIN = 2        # player2 ID, flags (FLAG_COMPUTER)
+MOVE = 3        # src, dest
+CANCEL = 4      # nothing
+SEQUENCE = 5    # one byte per position of the path
+DISCONNECT = 6  # player ID
+REMOVE = 7      # nothing
+
+FLAG_MANDATORY_CAPTURE = 1
+FLAG_COMPUTER = 1
+
+# crc32 of the rest of the record, kind, room ID, record number within the
+# room, payload length
+HEADER = struct.Struct('<IBIIH')
+PLAYER = struct.Struct('<IB')
+PLAYER_ID = struct.Struct('<I')
+HOP = struct.Struct('<BB')
+
+SNAPSHOT = 'snapshot'
+SEGMENT = 'log.%08d'
+
+
+class GameLog:
+    """ Interface of the game logs, recording nothing. Handlers call these
+        with the room checked out, right after changing its game.
+        """
+
+    def recover(self):
+        """ Rebuilds the logged games into the store, returns their IDs """
+        return []
+
+    def start(self):
+        """ Starts writing records out in the background """
+
+    def create(self, room_id, player1_id, mandatory_capture):
+        """ Records a new game """
+
+    def join(self, room_id, player2_id, computer):
+        """ Records the second player joining """
+
+    def move(self, room_id, src, dest):
+        """ Records State.makeMove """
+
+    def cancel(self, room_id):
+        """ Records State.cancelMove """
+
+    def sequence(self, room_id, path):
+        """ Records State.makeMoveSequence """
+
+    def disconnect(self, room_id, player_id):
+        """ Records State.disconnect """
+
+    def remove(self, room_id):
+        """ Records a room leaving the store """
+
+    def close(self):
+        """ Writes out everything recorded so far """
+
+
+class FileGameLog(GameLog):
+    """ GameLog kept in a directory on local disk """
+
+    def __init__(self, path, store, fsync_interval=1.0,
+                 compact_interval=300):
+        self.path = path
+        self.store = store
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        os.makedirs(path, exist_ok=True)
+
+        # Guards the buffer, the segment number and the counters below.
+        # Only held briefly, the file is written under write_lock so that
+        # recording never waits for an fsync
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.buffer = bytearray()
+        # Number of records written for each room, snapshots remember it so
+        # that replay can skip what they already contain
+        self.counts = {}
+        # Highest IDs handed out, so that none is reused after a restart
+        self.max_room = 0
+        self.max_player = 0
+        self.records_since_compact = 0
+        self.segment = max(self.segments(), default=0) + 1
+        self.file = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def segments(self):
+        """ Numbers of the segments in the directory, in order """
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.startswith('log.') and name[4:].isdigit():
+                numbers.append(int(name[4:]))
+        return sorted(numbers)
+
+    def segment_path(self, number):
+        """ File name of a segment """
+        return os.path.join(self.path, SEGMENT % number)
+
+    def start(self):
+        """ Starts the background thread flushing and compacting the log """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """ Flushes every fsync_interval and compacts every
+        compact_interval seconds """
+        last_compact = time.monotonic()
+        while not self.stopping.wait(self.fsync_interval):
+            self.flush()
+            if (self.compact_interval and self.records_since_compact and
+                    time.monotonic() - last_compact >= self.compact_interval):
+                self.compact()
+                last_compact = time.monotonic()
+
+    def append(self, kind, room_id, payload=b'', player_id=0):
+        """ Buffers one record, player_id is a player ID it hands out """
+        with self.lock:
+            number = self.counts.get(room_id, 0) + 1
+            self.counts[room_id] = number
+            body = HEADER.pack(0, kind, room_id, number, len(payload))[4:] + \
+                payload
+            self.buffer += struct.pack('<I', zlib.crc32(body)) + body
+            self.max_room = max(self.max_room, room_id)
+            self.max_player = max(self.max_player, player_id)
+            self.records_since_compact += 1
+            if kind == REMOVE:
+                del self.counts[room_id]
+
+    def create(self, room_id, player1_id, mandatory_capture):
+        """ Records a new game """
+        flags = FLAG_MANDATORY_CAPTURE if mandatory_capture else 0
+        self.append(CREATE, room_id, PLAYER.pack(player1_id, flags),
+                    player1_id)
+
+    def join(self, room_id, player2_id, computer):
+        """ Records the second player joining """
+        flags = FLAG_COMPUTER if computer else 0
+        self.append(JOIN, room_id, PLAYER.pack(player2_id, flags), player2_id)
+
+    def move(self, room_id, src, dest):
+        """ Records State.makeMove """
+        self.append(MOVE, room_id, HOP.pack(src, dest))
+
+    def cancel(self, room_id):
+        """ Records State.cancelMove """
+        self.append(CANCEL, room_id)
+
+    def sequence(self, room_id, path):
+        """ Records State.makeMoveSequence """
+        self.append(SEQUENCE, room_id, bytes(path))
+
+    def disconnect(self, room_id, player_id):
+        """ Records State.disconnect """
+        self.append(DISCONNECT, room_id, PLAYER_ID.pack(player_id))
+
+    def remove(self, room_id):
+        """ Records a room leaving the store """
+        self.append(REMOVE, room_id)
+
+    def flush(self, rotate=False):
+        """ Writes the buffered records to the current segment and fsyncs.
+        With rotate, records buffered from now on go to a new segment.
+        Returns the number of the segment records now go to """
+        with self.write_lock:
+            with self.lock:
+                data = self.buffer
+                self.buffer = bytearray()
+                segment = self.segment
+                if rotate:
+                    self.segment += 1
+                    self.records_since_compact = 0
+
+            if data:
+                if self.file is None:
+                    self.file = open(self.segment_path(segment), 'ab')
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            if rotate and self.file is not None:
+                self.file.close()
+                self.file = None
+            return segment + 1 if rotate else segment
+
+    def compact(self):
+        """ Snapshots every live game and deletes the segments the snapshot
+        makes redundant. Rooms are snapshotted one at a time while the log
+        keeps taking records, the per room record numbers tell replay which
+        records a room's snapshot already includes """
+        first = self.flush(rotate=True)
+        rooms = {}
+        for room_id in self.store.ids():
+            try:
+                with self.store.checkout(room_id) as game:
+                    with self.lock:
+                        count = self.counts.get(room_id, 0)
+                    rooms[room_id] = (count, pickle.dumps(game))
+            except KeyError:
+                # Removed meanwhile
+                continue
+        with self.lock:
+            snapshot = {'segment': first, 'rooms': rooms,
+                        'max_room': self.max_room,
+                        'max_player': self.max_player}
+
+        temporary = os.path.join(self.path, SNAPSHOT + '.tmp')
+        with open(temporary, 'wb') as output:
+            pickle.dump(snapshot, output, pickle.HIGHEST_PROTOCOL)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temporary, os.path.join(self.path, SNAPSHOT))
+        sync_directory(self.path)
+
+        for number in self.segments():
+            if number < first:
+                os.remove(self.segment_path(number))
+
+    def recover(self):
+        """ Loads the snapshot, replays the segments written after it and
+        registers the games in the store. Returns the recovered room IDs """
+        games = {}
+        first = 0
+        try:
+            with open(os.path.join(self.path, SNAPSHOT), 'rb') as snapshot:
+                data = pickle.load(snapshot)
+        except FileNotFoundError:
+            data = None
+        if data is not None:
+            first = data['segment']
+            self.max_room = data['max_room']
+            self.max_player = data['max_player']
+            for room_id, (count, game) in data['rooms'].items():
+                games[room_id] = pickle.loads(game)
+                self.counts[room_id] = count
+
+        for number in self.segments():
+            if number < first:
+                continue
+            with open(self.segment_path(number), 'rb') as segment:
+                for kind, room_id, count, payload in read_records(segment):
+                    if count <= self.counts.get(room_id, 0):
+                        continue
+                    self.counts[room_id] = count
+                    self.max_room = max(self.max_room, room_id)
+                    try:
+                        self.replay(games, kind, room_id, payload)
+                    except ValueError as error:
+                        LOGGER.error('Skipping record %d of room %d: %s',
+                                     count, room_id, error)
+                    if kind == REMOVE:
+                        self.counts.pop(room_id, None)
+
+        self.store.player_ids.advance(self.max_player)
+        self.store.room_ids.advance(self.max_room)
+        for room_id, game in games.items():
+            self.store.restore(room_id, game)
+        return sorted(games)
+
+    def replay(self, games, kind, room_id, payload):
+        """ Applies one record to the games being recovered """
+        if kind == CREATE:
+            player1_id, flags = PLAYER.unpack(payload)
+            self.max_player = max(self.max_player, player1_id)
+            games[room_id] = State(player1_id,
+                                   bool(flags & FLAG_MANDATORY_CAPTURE))
+            return
+        game = games.get(room_id)
+        if game is None:
+            return
+        if kind == JOIN:
+            player2_id, flags = PLAYER.unpack(payload)
+            self.max_player = max(self.max_player, player2_id)
+            if flags & FLAG_COMPUTER:
+                game.joinComputer(player2_id)
+            else:
+                game.join(player2_id)
+        elif kind == MOVE:
+            game.makeMove(*HOP.unpack(payload))
+        elif kind == CANCEL:
+            game.cancelMove()
+        elif kind == SEQUENCE:
+            game.makeMoveSequence(list(payload))
+        elif kind == DISCONNECT:
+            game.disconnect(PLAYER_ID.unpack(payload)[0])
+        elif kind == REMOVE:
+            del games[room_id]
+
+    def close(self):
+        """ Stops the background thread and writes out every record """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush(rotate=True)
+
+
+def read_records(stream):
+    """ Yields (kind, room ID, record number, payload) for every record of
+    a segment. Stops at a torn or corrupt record, which can only be the
+    last one written before a crash, and logs what it drops """
+    data = stream.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        crc, kind, room_id, count, length = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+            break
+        yield kind, room_id, count, data[offset + HEADER.size:end]
+        offset = end
+    if offset < len(data):
+        LOGGER.warning('Dropping a torn or corrupt record at byte %d of %s, '
+                       '%d bytes', offset,
+                       getattr(stream, 'name', 'a segment'),
+                       len(data) - offset)
+
+
+def sync_directory(path):
+    """ fsyncs a directory so that renames in it are durable """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_game_log(path, store, fsync_interval=1.0, compact_interval=300):
+    """ Opens the game log in directory path, or a GameLog recording nothing
+    when path is empty. Logged games are meant for the in memory store,
+    other stores are durable on their own and get no log """
+    if not path:
+        return GameLog()
+    if not isinstance(store, RoomRegistry):
+        LOGGER.warning('%s is durable on its own, not logging to %s',
+                       type(store).__name__, path)
+        return GameLog()
+    return FileGameLog(path, store, fsync_interval, compact_interval)
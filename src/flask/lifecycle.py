@@ -0,0 +1,112 @@
+""" lifecycle.py
+    Tracks room activity and evicts finished and idle rooms from the store
+"""
+import heapq
+import sys
+import time
+
+
+class RoomLifecycle:
+    """ Schedules every room for eviction.
+        Each room has one deadline: its last activity plus the idle TTL, or
+        plus the (shorter) finished TTL once its game is over. Deadlines live
+        in a heap, so evict() only looks at rooms that are actually due.
+        Activity only pushes a heap entry when it brings the deadline
+        forward; an entry that surfaces before the room's last activity
+        plus its TTL is pushed again from there, so a room has at most a
+        couple of entries however often it is touched.
+        """
+
+    def __init__(self, store, idle_ttl=3600, finished_ttl=300, clock=time.time):
+        self.store = store
+        self.idle_ttl = idle_ttl
+        self.finished_ttl = finished_ttl
+        self.clock = clock
+        self.deadlines = {}
+        self.heap = []
+
+    def touch(self, room_id, game):
+        """ Records activity on a room, call with the room checked out.
+        The time is also kept on the game so that every worker sharing a
+        store sees it """
+        now = self.clock()
+        game.lastActivity = now
+        ttl = self.finished_ttl if game.isFinished() else self.idle_ttl
+        queued = self.deadlines.get(room_id)
+        if queued is None or now + ttl < queued:
+            self.schedule(room_id, now + ttl)
+
+    def schedule(self, room_id, deadline):
+        """ Sets the time at which a room becomes due for eviction """
+        self.deadlines[room_id] = deadline
+        heapq.heappush(self.heap, (deadline, room_id))
+
+    def forget(self, room_id):
+        """ Stops tracking a room """
+        self.deadlines.pop(room_id, None)
+
+    def evict(self):
+        """ Removes every room whose deadline has passed from the store.
+        Returns the IDs of the evicted rooms """
+        now = self.clock()
+        evicted = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, room_id = heapq.heappop(self.heap)
+            if self.deadlines.get(room_id) != deadline:
+                continue
+
+            game = self.store.get(room_id)
+            if game is None:
+                self.forget(room_id)
+                continue
+
+            # Another worker sharing the store may have seen newer activity
+            ttl = self.finished_ttl if game.isFinished() else self.idle_ttl
+            last = getattr(game, 'lastActivity', None) or 0
+            if last + ttl > now:
+                self.schedule(room_id, last + ttl)
+                continue
+
+            self.store.remove(room_id)
+            self.forget(room_id)
+            evicted.append(room_id)
+        return evicted
+
+    def stats(self, sample=32):
+        """ Returns the live room count and the approximate memory used by
+        one room, averaged over up to sample rooms """
+        room_ids = self.store.ids()
+        sizes = []
+        for room_id in room_ids[:sample]:
+            game = self.store.get(room_id)
+            if game is not None:
+                sizes.append(approx_size(game))
+        return {
+            'rooms': len(room_ids),
+            'bytes_per_room': sum(sizes) // len(sizes) if sizes else 0,
+        }
+
+
+def approx_size(obj, seen=None):
+    """ Approximate number of bytes used by obj and everything it refers to
+    through attributes and containers """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += approx_size(key, seen) + approx_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += approx_size(item, seen)
+    elif not isinstance(obj, (str, bytes, bytearray, int, float, bool)):
+        if hasattr(obj, '__dict__'):
+            size += approx_size(vars(obj), seen)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                size += approx_size(getattr(obj, slot), seen)
+    return size
@@ -0,0 +1,115 @@
+""" lobby.py
+    Index of the rooms players can join or watch.
+
+    Rooms are indexed by status, open (waiting for a second player) or
+    playing, and within a status by creation time. Listing a page is then a
+    binary search and a slice rather than a scan of the room store. The
+    handlers update the index whenever they broadcast a change to a room,
+    and push the changes it reports to clients subscribed to the lobby.
+    A worker only lists the rooms it has seen change.
+"""
+import bisect
+import threading
+import time
+
+OPEN = 'open'
+PLAYING = 'playing'
+STATUSES = (OPEN, PLAYING)
+
+
+def status_of(game):
+    """ Lobby status of a game, None once it is over """
+    if game.isFinished():
+        return None
+    if game.state == 'WAITING':
+        return OPEN
+    return PLAYING
+
+
+def summarize(room_id, game, status):
+    """ What the lobby shows of a room. Turns are left out so that moves do
+    not change the listing """
+    return {
+        'room_id': room_id,
+        'status': status,
+        'created': game.created,
+        'mandatoryCapture': game.mandatoryCapture,
+        'ai': game.aiPlayer is not None,
+    }
+
+
+class LobbyIndex:
+    """ Rooms by status, oldest first. Pages are addressed by an opaque
+        cursor, the position after the last room of the previous page, so
+        paging stays consistent while rooms come and go """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # room_id -> (status, index key, summary) of every listed room
+        self.rooms = {}
+        # status -> sorted (creation time in microseconds, room_id)
+        self.keys = {status: [] for status in STATUSES}
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def track(self, room_id, game):
+        """ Lists a room as it is now, call with the room checked out.
+        Returns the change to push to lobby clients, None if the listing of
+        the room did not change """
+        if game.created is None:
+            game.created = self.clock()
+        status = status_of(game)
+        summary = None if status is None else \
+            summarize(room_id, game, status)
+        with self.lock:
+            listed = self.rooms.get(room_id)
+            if listed is None and status is None or \
+                    listed is not None and listed[2] == summary:
+                return None
+            self.unlist(room_id)
+            if status is not None:
+                key = (int(game.created * 1e6), room_id)
+                bisect.insort(self.keys[status], key)
+                self.rooms[room_id] = (status, key, summary)
+        return {'room_id': room_id, 'status': status, 'room': summary}
+
+    def forget(self, room_id):
+        """ Drops an evicted room, returns the change to push or None """
+        with self.lock:
+            if not self.unlist(room_id):
+                return None
+        return {'room_id': room_id, 'status': None, 'room': None}
+
+    def unlist(self, room_id):
+        """ Takes a room out of the index, call with the lock held """
+        listed = self.rooms.pop(room_id, None)
+        if listed is None:
+            return False
+        status, key, _ = listed
+        keys = self.keys[status]
+        del keys[bisect.bisect_left(keys, key)]
+        return True
+
+    def page(self, status, cursor=None, limit=20):
+        """ Returns up to limit summaries of rooms with status, after cursor,
+        and the cursor of the next page or None on the last one """
+        with self.lock:
+            keys = self.keys[status]
+            start = 0 if cursor is None else bisect.bisect_right(keys, cursor)
+            chunk = keys[start:start + limit]
+            rooms = [self.rooms[key[1]][2] for key in chunk]
+            more = start + limit < len(keys)
+        return rooms, encode_cursor(chunk[-1]) if more else None
+
+    def counts(self):
+        """ Number of rooms listed under each status """
+        with self.lock:
+            return {status: len(keys) for status, keys in self.keys.items()}
+
+
+def encode_cursor(key):
+    """ Cursor of a page starting after the room at key, see
+    validation.decode_cursor """
+    return '%d.%d' % key
@@ -0,0 +1,105 @@
+""" matchmaking.py
+    Queue of players waiting for an opponent.
+
+    Waiting players are kept in one heap per bucket, oldest first, so that
+    joining the queue is O(log n). Leaving it only drops the player from an
+    index: their heap entry is skipped when it surfaces. Pairing runs in
+    batches, see MatchQueue.match.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+class MatchQueue:
+    """ Players waiting for an opponent.
+        Players are bucketed by rule set and rating (rating // bucket_width,
+        players without a rating share a bucket) and paired within their
+        bucket. A player left alone in theirs for widen_after seconds is
+        paired with the closest lonely player of another bucket instead.
+        """
+
+    def __init__(self, bucket_width=200, widen_after=10.0,
+                 clock=time.monotonic):
+        self.bucket_width = bucket_width
+        self.widen_after = widen_after
+        self.clock = clock
+        self.lock = threading.Lock()
+        # bucket -> heap of (time queued, ticket, sid)
+        self.buckets = {}
+        # sid -> (bucket, ticket, options) of every live entry
+        self.waiting = {}
+        self.tickets = itertools.count()
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def bucket(self, rating, mandatory_capture):
+        """ Bucket of a player, only players of one rule set can meet """
+        level = -1 if rating is None else rating // self.bucket_width
+        return (bool(mandatory_capture), level)
+
+    def add(self, sid, rating=None, mandatory_capture=False, options=None):
+        """ Queues a client, replacing its previous entry if any. options
+        are handed back with the pair """
+        bucket = self.bucket(rating, mandatory_capture)
+        ticket = next(self.tickets)
+        with self.lock:
+            self.waiting[sid] = (bucket, ticket, options)
+            heapq.heappush(self.buckets.setdefault(bucket, []),
+                           (self.clock(), ticket, sid))
+
+    def cancel(self, sid):
+        """ Takes a client out of the queue, returns whether it was in """
+        with self.lock:
+            return self.waiting.pop(sid, None) is not None
+
+    def live(self, item):
+        """ Whether a heap entry is still the current entry of its client """
+        entry = self.waiting.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def match(self):
+        """ Pairs as many waiting players as possible and takes them out of
+        the queue. Returns a list of (sid, options, sid, options), the
+        player queued first comes first """
+        now = self.clock()
+        pairs = []
+        lonely = []
+        with self.lock:
+            for bucket in list(self.buckets):
+                heap = self.buckets[bucket]
+                first = None
+                while heap:
+                    item = heapq.heappop(heap)
+                    if not self.live(item):
+                        continue
+                    if first is None:
+                        first = item
+                    else:
+                        pairs.append((first, item))
+                        first = None
+                if first is None:
+                    del self.buckets[bucket]
+                    continue
+                heap.append(first)
+                if now - first[0] >= self.widen_after:
+                    lonely.append((bucket, first))
+
+            # Neighbouring buckets of one rule set are adjacent once sorted
+            lonely.sort()
+            index = 0
+            while index + 1 < len(lonely):
+                (bucket, first), (other, second) = lonely[index:index + 2]
+                if bucket[0] != other[0]:
+                    index += 1
+                    continue
+                pairs.append(tuple(sorted([first, second])))
+                del self.buckets[bucket]
+                del self.buckets[other]
+                index += 2
+
+            return [(first[2], self.waiting.pop(first[2])[2],
+                     second[2], self.waiting.pop(second[2])[2])
+                    for first, second in pairs]
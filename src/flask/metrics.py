@@ -0,0 +1,194 @@
+""" metrics.py
+    In-process metrics, exposed on /metrics in the Prometheus text format.
+
+    Timings go to histograms with fixed exponential buckets: observing a
+    value is a bisect and two additions, and percentiles are left to
+    Prometheus. Counters only ever grow, so rates are computed by the
+    scraper. Gauges are callbacks evaluated when the metrics are rendered.
+"""
+import asyncio
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets in seconds, 10us to about 10s
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(21))
+
+# name -> (type, help text) of every metric family
+FAMILIES = {
+    'kingme_handler_seconds':
+        ('histogram', 'Time spent in Socket.IO handlers'),
+    'kingme_board_seconds':
+        ('histogram', 'Time spent in Board methods, see instrument_board'),
+    'kingme_sent_messages_total':
+        ('counter', 'Engine.IO packets sent to clients'),
+    'kingme_sent_bytes_total':
+        ('counter', 'Bytes of the Engine.IO packets sent to clients'),
+    'kingme_rooms': ('gauge', 'Rooms in the store'),
+    'kingme_connected_sockets': ('gauge', 'Connected Engine.IO clients'),
+}
+
+
+class Histogram:
+    """ Counts of observed values per bucket """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One more count than buckets, for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """ Records one value """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """ Returns (cumulative count per bucket bound, sum, count) """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total, running + counts[-1]
+
+
+class Metrics:
+    """ Registry of the histograms, counters and gauges of a process """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (family, label name, label value) -> Histogram
+        self.histograms = {}
+        # family -> value
+        self.counters = {}
+        # family -> callback returning the current value
+        self.gauges = {}
+
+    def histogram(self, family, label, value):
+        """ Returns the histogram of family for one label value """
+        key = (family, label, value)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def timed(self, family, label, value, function):
+        """ Wraps function to record its duration in a histogram """
+        histogram = self.histogram(family, label, value)
+        clock = self.clock
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(clock() - start)
+        return wrapper
+
+    def inc(self, family, amount=1):
+        """ Adds amount to a counter """
+        with self.lock:
+            self.counters[family] = self.counters.get(family, 0) + amount
+
+    def gauge(self, family, callback):
+        """ Registers the callback reporting a gauge """
+        self.gauges[family] = callback
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format """
+        lines = []
+        for family, (kind, text) in FAMILIES.items():
+            samples = self.samples(family, kind)
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (family, text))
+            lines.append('# TYPE %s %s' % (family, kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def samples(self, family, kind):
+        """ Sample lines of one family """
+        if kind == 'counter':
+            if family not in self.counters:
+                return []
+            return ['%s %s' % (family, format_value(self.counters[family]))]
+        if kind == 'gauge':
+            if family not in self.gauges:
+                return []
+            return ['%s %s' % (family, format_value(self.gauges[family]()))]
+
+        lines = []
+        for (name, label, value), histogram in sorted(
+                self.histograms.items()):
+            if name != family:
+                continue
+            cumulative, total, count = histogram.snapshot()
+            labels = '%s="%s"' % (label, value)
+            for bound, below in cumulative:
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    family, labels, format_value(bound), below))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (family, labels,
+                                                        count))
+            lines.append('%s_sum{%s} %s' % (family, labels,
+                                            format_value(total)))
+            lines.append('%s_count{%s} %d' % (family, labels, count))
+        return lines
+
+
+def format_value(value):
+    """ Number as Prometheus expects it """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metrics of this process
+REGISTRY = Metrics()
+
+
+def instrument_board(metrics=REGISTRY):
+    """ Times Board.getMoves, movablePieces and toJSON for every board of
+    the process. Off by default: these run on every move and the timer
+    roughly doubles the cost of a cached lookup """
+    from Board import Board  # pylint: disable=C0415
+    if getattr(Board, 'instrumented', False):
+        return
+    for name in ['getMoves', 'movablePieces', 'toJSON']:
+        setattr(Board, name, metrics.timed('kingme_board_seconds', 'method',
+                                           name, getattr(Board, name)))
+    Board.instrumented = True
+
+
+def count_sent(eio, metrics=REGISTRY):
+    """ Wraps send_packet of an Engine.IO server, sync or async, to count
+    the packets and bytes sent. Room broadcasts reach this once per
+    recipient """
+    send = eio.send_packet
+    if getattr(send, 'counted', False):
+        return
+
+    def record(packet):
+        metrics.inc('kingme_sent_messages_total')
+        # Socket.IO sends ASCII JSON, so characters are bytes
+        if isinstance(packet.data, (str, bytes)):
+            metrics.inc('kingme_sent_bytes_total', len(packet.data))
+
+    if asyncio.iscoroutinefunction(send):
+        async def counted(sid, packet):
+            record(packet)
+            await send(sid, packet)
+    else:
+        def counted(sid, packet):
+            record(packet)
+            send(sid, packet)
+    counted.counted = True
+    eio.send_packet = counted
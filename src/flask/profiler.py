@@ -0,0 +1,99 @@
+""" profiler.py
+    Sampling profiler that can be switched on in a live server.
+
+    A background thread looks at the stack of every other thread at a fixed
+    interval and counts each distinct stack. The result is in the folded
+    format, one 'outer;...;inner count' line per stack, which flamegraph.pl
+    and speedscope turn into a flame graph. The profiled threads are never
+    interrupted, so the overhead is only the sampling thread itself.
+"""
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """ Samples the stacks of the running threads while started """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Folded stack -> number of samples
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.stopping = None
+        self.thread = None
+
+    def running(self):
+        """ Whether samples are being taken """
+        return self.thread is not None
+
+    def start(self):
+        """ Drops previous samples and starts sampling, returns False if
+        already running """
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = {}
+            self.samples = 0
+            self.started = time.monotonic()
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self.run,
+                                           args=(self.stopping,), daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """ Stops sampling, returns the folded stacks collected """
+        with self.lock:
+            thread = self.thread
+            stopping = self.stopping
+            self.thread = None
+        if thread is not None:
+            stopping.set()
+            thread.join()
+        return self.folded()
+
+    def run(self, stopping):
+        """ Sampling loop """
+        own = threading.get_ident()
+        while not stopping.wait(self.interval):
+            frames = sys._current_frames()  # pylint: disable=W0212
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    stack = fold(frame)
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def folded(self):
+        """ Collected stacks in the folded format, most frequent first """
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return ''.join('%s %d\n' % item for item in stacks)
+
+    def status(self):
+        """ Summary of the current or last run """
+        with self.lock:
+            return {
+                'running': self.thread is not None,
+                'samples': self.samples,
+                'seconds': round(time.monotonic() - self.started, 3)
+                           if self.started is not None else 0,
+            }
+
+
+def fold(frame):
+    """ One stack as 'outer;...;inner', frames as function (file:line) with
+    the line the function starts on, so that samples of a function merge """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
@@ -0,0 +1,86 @@
+""" resume.py
+    Lets players whose connection dropped take their seat back.
+
+    Every player gets a resume token when they join a room: the room and
+    player IDs signed with an HMAC, so that the server can trust them
+    without storing anything. Sending it in a 'resume' event from a new
+    connection reattaches that connection to the game. The last deltas of
+    every room are kept in a small ring buffer so that a client that was
+    only briefly away is caught up with what it missed rather than a full
+    snapshot.
+"""
+import base64
+import collections
+import hashlib
+import hmac
+import os
+
+# Bytes of the HMAC kept in tokens
+MAC_SIZE = 16
+
+
+class ResumeTokens:
+    """ Signs and checks resume tokens. Workers sharing rooms have to share
+        the secret, a random one only works within a process """
+
+    def __init__(self, secret=None):
+        self.secret = secret.encode() if secret else os.urandom(32)
+
+    def mac(self, room_id, player_id):
+        """ Signature of a seat """
+        digest = hmac.new(self.secret, b'%d.%d' % (room_id, player_id),
+                          hashlib.sha256).digest()[:MAC_SIZE]
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def sign(self, room_id, player_id):
+        """ Token for player_id's seat in room_id """
+        return '%d.%d.%s' % (room_id, player_id, self.mac(room_id, player_id))
+
+    def verify(self, token):
+        """ Returns (room_id, player_id) of a token, None if it was not
+        signed by us """
+        parts = token.split('.')
+        if len(parts) != 3 or not all(part.isascii() for part in parts) or \
+                not parts[0].isdigit() or not parts[1].isdigit():
+            return None
+        room_id, player_id = int(parts[0]), int(parts[1])
+        if not hmac.compare_digest(parts[2], self.mac(room_id, player_id)):
+            return None
+        return room_id, player_id
+
+
+class DeltaBuffer:
+    """ The last size deltas broadcast in every room, in both encodings """
+
+    def __init__(self, size=32):
+        self.size = size
+        # room_id -> [lowest seq a client can be caught up from,
+        #             deque of (seq, delta, compact delta)]
+        self.rooms = {}
+
+    def record(self, room_id, seq, delta, compact_delta):
+        """ Keeps a delta, call with the room checked out """
+        entry = self.rooms.get(room_id)
+        if entry is None:
+            # Whatever came before this delta is unknown here
+            entry = self.rooms[room_id] = [seq, collections.deque(
+                maxlen=self.size)]
+        entry[1].append((seq, delta, compact_delta))
+        entry[0] = max(entry[0], entry[1][0][0] - 1)
+
+    def reset(self, room_id, seq):
+        """ A full update was broadcast at seq, deltas cannot replace it """
+        self.rooms[room_id] = [seq + 1, collections.deque(maxlen=self.size)]
+
+    def missed(self, room_id, seq, compact=False):
+        """ Deltas after seq, oldest first, or None when the buffer does not
+        cover everything since seq """
+        entry = self.rooms.get(room_id)
+        if entry is None or seq < entry[0]:
+            return None
+        index = 2 if compact else 1
+        return [item[index] for item in entry[1] if item[0] > seq]
+
+    def forget(self, room_id):
+        """ Drops the deltas of a room """
+        self.rooms.pop(room_id, None)
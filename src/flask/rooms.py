@@ -0,0 +1,184 @@
+""" rooms.py
+    Room stores: where the games served by the handlers live.
+
+    RoomRegistry keeps games in process memory. SQLiteRoomStore (in
+    sqlite_store.py) keeps them in a database file shared by several worker
+    processes, so any worker can serve any room.
+"""
+import threading
+from contextlib import contextmanager
+
+
+class UniqueIDGenerator:
+    """ Class to handle IDs """
+
+    def __init__(self):
+        self.uid = 0
+        self.lock = threading.Lock()
+
+    def generate_id(self):
+        """ Generates a unique id for a given object.
+        Safe to call from several workers at once """
+        with self.lock:
+            self.update_ids()
+            return self.uid
+
+    def update_ids(self):
+        """ Updates the IDs. This implementation
+        increments the ids sequentially """
+        self.uid += 1
+
+    def advance(self, uid):
+        """ Makes sure IDs generated from now on are above uid """
+        with self.lock:
+            self.uid = max(self.uid, uid)
+
+
+class Room:
+    """ A game and the lock serialising changes to it """
+    __slots__ = ('game', 'lock')
+
+    def __init__(self, game):
+        self.game = game
+        self.lock = threading.RLock()
+
+
+class RoomShard:
+    """ One slice of the registry, guarded by its own lock """
+    __slots__ = ('rooms', 'lock')
+
+    def __init__(self):
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+
+class RoomStore:
+    """ Interface shared by the room stores.
+        Games must only be changed inside checkout(); games returned by get()
+        or [] may be copies and are meant for reading.
+        """
+    # Allocates player IDs that are unique across everything sharing the
+    # store. Has a generate_id() method like UniqueIDGenerator.
+    player_ids = None
+
+    def add(self, game):
+        """ Registers a game under a newly allocated room ID """
+        raise NotImplementedError
+
+    def remove(self, room_id):
+        """ Drops a room, returns its game or None if it did not exist """
+        raise NotImplementedError
+
+    def restore(self, room_id, game):
+        """ Registers a game under a room ID allocated earlier, e.g. by a
+        previous run of the server """
+        raise NotImplementedError
+
+    def get(self, room_id, default=None):
+        """ Returns the game in room_id, or default """
+        raise NotImplementedError
+
+    def ids(self):
+        """ Returns the IDs of every room currently stored """
+        raise NotImplementedError
+
+    def checkout(self, room_id):
+        """ Context manager that locks a room and yields its game. Changes
+        made to the game are kept when the block exits.
+        Raises KeyError if the room does not exist """
+        raise NotImplementedError
+
+    def __getitem__(self, room_id):
+        game = self.get(room_id)
+        if game is None:
+            raise KeyError(room_id)
+        return game
+
+    def __contains__(self, room_id):
+        return self.get(room_id) is not None
+
+    def __len__(self):
+        return len(self.ids())
+
+
+class RoomRegistry(RoomStore):
+    """ Maps room IDs to games held in process memory.
+        Rooms are spread over shards so that adding and removing rooms only
+        locks a fraction of the registry, and every room has its own lock so
+        that handlers for different rooms never wait on each other.
+        """
+
+    def __init__(self, shards=16):
+        self.shards = [RoomShard() for _ in range(shards)]
+        self.room_ids = UniqueIDGenerator()
+        self.player_ids = UniqueIDGenerator()
+
+    def shard(self, room_id):
+        """ Returns the shard holding room_id """
+        return self.shards[hash(room_id) % len(self.shards)]
+
+    def add(self, game):
+        """ Registers a game under a newly allocated room ID """
+        room_id = self.room_ids.generate_id()
+        shard = self.shard(room_id)
+        with shard.lock:
+            shard.rooms[room_id] = Room(game)
+        return room_id
+
+    def restore(self, room_id, game):
+        """ Registers a game under a room ID allocated earlier """
+        self.room_ids.advance(room_id)
+        shard = self.shard(room_id)
+        with shard.lock:
+            shard.rooms[room_id] = Room(game)
+
+    def remove(self, room_id):
+        """ Drops a room, returns its game or None if it did not exist """
+        shard = self.shard(room_id)
+        with shard.lock:
+            room = shard.rooms.pop(room_id, None)
+        return room.game if room is not None else None
+
+    def get(self, room_id, default=None):
+        """ Returns the game in room_id without locking it """
+        room = self.shard(room_id).rooms.get(room_id)
+        return room.game if room is not None else default
+
+    def __getitem__(self, room_id):
+        return self.shard(room_id).rooms[room_id].game
+
+    def __contains__(self, room_id):
+        return room_id in self.shard(room_id).rooms
+
+    def __len__(self):
+        return sum(len(shard.rooms) for shard in self.shards)
+
+    def ids(self):
+        """ Returns the IDs of every room currently registered """
+        result = []
+        for shard in self.shards:
+            with shard.lock:
+                result.extend(shard.rooms)
+        return result
+
+    @contextmanager
+    def checkout(self, room_id):
+        """ Locks a room for the duration of a with block and yields its game.
+        Raises KeyError if the room does not exist """
+        room = self.shard(room_id).rooms[room_id]
+        with room.lock:
+            yield room.game
+
+
+def open_room_store(url):
+    """ Opens the room store described by url:
+            memory                  - RoomRegistry, this process only
+            sqlite:///path/to/db    - SQLiteRoomStore shared through a file
+        """
+    if not url or url == 'memory':
+        return RoomRegistry()
+    if url.startswith('sqlite:///'):
+        # pylint: disable=C0415
+        from sqlite_store import SQLiteRoomStore
+        return SQLiteRoomStore(url[len('sqlite:///'):])
+    raise ValueError('Unknown room store: ' + url)
@@ -0,0 +1,68 @@
+""" spectators.py
+    Decides when the spectators of a room get a new frame.
+
+    Players get every update as it happens. Spectators only get full
+    snapshots, at most fps per room: changes made between two frames are
+    coalesced into the next one, so a busy room costs its watchers one
+    broadcast per frame however fast the players move, and broadcasting to
+    watchers happens outside of the players' event handlers. Rooms nobody
+    watches are never marked, so they cost nothing here.
+"""
+import threading
+import time
+
+
+class SpectatorFeed:
+    """ Rooms changed since their last spectator frame """
+
+    def __init__(self, fps=4.0, clock=time.monotonic):
+        self.interval = 1.0 / fps
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Rooms with changes not yet sent to their spectators
+        self.pending = set()
+        # room_id -> time its last frame was sent
+        self.sent = {}
+        # sid -> rooms a connected spectator follows
+        self.watching = {}
+
+    def mark(self, room_id):
+        """ Records that a room changed, cheap enough for every move """
+        with self.lock:
+            self.pending.add(room_id)
+
+    def take(self):
+        """ Returns the rooms whose next frame is due: changed since their
+        last frame, which went out at least interval ago. They are expected
+        to be sent right away """
+        now = self.clock()
+        with self.lock:
+            due = [room_id for room_id in self.pending
+                   if now - self.sent.get(room_id, now - self.interval) >=
+                   self.interval]
+            for room_id in due:
+                self.pending.discard(room_id)
+                self.sent[room_id] = now
+        return due
+
+    def watch(self, sid, room_id):
+        """ Records a spectator, returns False if sid already watches the
+        room so that it is counted once """
+        with self.lock:
+            rooms = self.watching.setdefault(sid, set())
+            if room_id in rooms:
+                return False
+            rooms.add(room_id)
+            return True
+
+    def unwatch(self, sid):
+        """ Forgets a disconnected spectator, returns the rooms it
+        watched """
+        with self.lock:
+            return self.watching.pop(sid, set())
+
+    def forget(self, room_id):
+        """ Stops tracking a room """
+        with self.lock:
+            self.pending.discard(room_id)
+            self.sent.pop(room_id, None)
@@ -0,0 +1,121 @@
+""" sqlite_store.py
+    Room store kept in an SQLite database so that several worker processes,
+    each running its own Handler, can serve the same rooms.
+"""
+import pickle
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from rooms import RoomStore
+
+
+class SQLiteIDGenerator:
+    """ Sequential IDs kept in the counters table of the store """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def generate_id(self):
+        """ Generates an ID unique across every process using the store """
+        conn = self.store.connection()
+        with self.store.transaction(conn):
+            conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?',
+                         (self.name,))
+            return conn.execute('SELECT value FROM counters WHERE name = ?',
+                                (self.name,)).fetchone()[0]
+
+
+class SQLiteRoomStore(RoomStore):
+    """ Games are pickled into one row per room. checkout() holds the
+        database write lock for the whole block, which serialises changes
+        to rooms across every process sharing the file.
+        """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        # sqlite3 connections cannot be shared between threads
+        self.local = threading.local()
+        self.player_ids = SQLiteIDGenerator(self, 'player')
+
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with self.transaction(conn):
+            conn.execute('CREATE TABLE IF NOT EXISTS rooms ('
+                         'room_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'game BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters ('
+                         'name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)',
+                         ('player',))
+
+    def connection(self):
+        """ Returns this thread's connection to the database """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    @contextmanager
+    def transaction(conn):
+        """ Runs a with block inside a write transaction """
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def add(self, game):
+        """ Registers a game under a newly allocated room ID """
+        conn = self.connection()
+        with self.transaction(conn):
+            cursor = conn.execute('INSERT INTO rooms (game) VALUES (?)',
+                                  (pickle.dumps(game),))
+            return cursor.lastrowid
+
+    def remove(self, room_id):
+        """ Drops a room, returns its game or None if it did not exist """
+        conn = self.connection()
+        with self.transaction(conn):
+            row = conn.execute('SELECT game FROM rooms WHERE room_id = ?',
+                               (room_id,)).fetchone()
+            conn.execute('DELETE FROM rooms WHERE room_id = ?', (room_id,))
+        return pickle.loads(row[0]) if row is not None else None
+
+    def get(self, room_id, default=None):
+        """ Returns a copy of the game in room_id, or default """
+        row = self.connection().execute(
+            'SELECT game FROM rooms WHERE room_id = ?', (room_id,)).fetchone()
+        return pickle.loads(row[0]) if row is not None else default
+
+    def __contains__(self, room_id):
+        return self.connection().execute(
+            'SELECT 1 FROM rooms WHERE room_id = ?',
+            (room_id,)).fetchone() is not None
+
+    def ids(self):
+        """ Returns the IDs of every room currently stored """
+        return [row[0] for row in
+                self.connection().execute('SELECT room_id FROM rooms')]
+
+    @contextmanager
+    def checkout(self, room_id):
+        """ Loads a game, yields it and writes it back when the block exits.
+        Raises KeyError if the room does not exist """
+        conn = self.connection()
+        with self.transaction(conn):
+            row = conn.execute('SELECT game FROM rooms WHERE room_id = ?',
+                               (room_id,)).fetchone()
+            if row is None:
+                raise KeyError(room_id)
+            game = pickle.loads(row[0])
+            yield game
+            conn.execute('UPDATE rooms SET game = ? WHERE room_id = ?',
+                         (pickle.dumps(game), room_id))
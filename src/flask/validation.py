@@ -0,0 +1,243 @@
+""" validation.py
+    Decodes the payload of every client event before a handler sees it.
+
+    Each event has a Schema, compiled once into a list of field decoders.
+    Decoding never raises: a decoder returns INVALID for anything it does
+    not accept, and the handler gets either a dict of clean values or an
+    (error code, message) pair to send back. Room IDs and squares are
+    range checked here, so handlers only do lookups before touching a game.
+"""
+import threading
+import time
+
+# Error codes, sent as 'code' next to the human readable 'error'
+BAD_REQUEST = 'BAD_REQUEST'
+BAD_ROOM_ID = 'BAD_ROOM_ID'
+BAD_SQUARE = 'BAD_SQUARE'
+NO_SUCH_ROOM = 'NO_SUCH_ROOM'
+NOT_IN_ROOM = 'NOT_IN_ROOM'
+WRONG_PLAYER = 'WRONG_PLAYER'
+NOT_YOUR_TURN = 'NOT_YOUR_TURN'
+ILLEGAL_MOVE = 'ILLEGAL_MOVE'
+ROOM_FULL = 'ROOM_FULL'
+NOT_STARTED = 'NOT_STARTED'
+GAME_OVER = 'GAME_OVER'
+BAD_TOKEN = 'BAD_TOKEN'
+RATE_LIMITED = 'RATE_LIMITED'
+
+# Largest room and player ID. IDs are counters starting at 1, 0 is let
+# through to be reported as a room that does not exist
+MAX_ID = 2 ** 31 - 1
+SQUARES = 64
+# A piece and the landing squares of the longest possible jump chain
+MAX_PATH = 13
+# Longest resume token, see resume.ResumeTokens
+MAX_TOKEN = 64
+# Lobby listings, see lobby.LobbyIndex
+LOBBY_STATUSES = ('open', 'playing')
+MAX_PAGE = 100
+
+# Returned by decoders for values they reject
+INVALID = object()
+
+
+def is_int(value):
+    """ Whether value is an int, booleans excluded """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_id(value):
+    """ Room or player ID, sent as a number or a string of digits """
+    if isinstance(value, str) and 0 < len(value) <= 10 and \
+            value.isascii() and value.isdigit():
+        value = int(value)
+    if not is_int(value) or not 0 <= value <= MAX_ID:
+        return INVALID
+    return value
+
+
+def decode_square(value):
+    """ Board square 0-63, sent as a number or a string of digits """
+    if isinstance(value, str) and 0 < len(value) <= 2 and \
+            value.isascii() and value.isdigit():
+        value = int(value)
+    if not is_int(value) or not 0 <= value < SQUARES:
+        return INVALID
+    return value
+
+
+def decode_token(value):
+    """ Resume token, a short ASCII string """
+    if not isinstance(value, str) or not 0 < len(value) <= MAX_TOKEN or \
+            not value.isascii():
+        return INVALID
+    return value
+
+
+def decode_status(value):
+    """ Lobby status """
+    if not isinstance(value, str) or value not in LOBBY_STATUSES:
+        return INVALID
+    return value
+
+
+def decode_cursor(value):
+    """ Lobby page cursor, 'creation time.room_id' as made by
+    lobby.encode_cursor """
+    if not isinstance(value, str) or not value.isascii():
+        return INVALID
+    parts = value.split('.')
+    if len(parts) != 2 or not all(0 < len(part) <= 20 and part.isdigit()
+                                  for part in parts):
+        return INVALID
+    return int(parts[0]), int(parts[1])
+
+
+def decode_limit(value):
+    """ Lobby page size, 1 to MAX_PAGE """
+    value = decode_id(value)
+    if value is INVALID or not 0 < value <= MAX_PAGE:
+        return INVALID
+    return value
+
+
+def decode_flag(value):
+    """ Anything, by truthiness """
+    return bool(value)
+
+
+def decode_path(value):
+    """ List of squares, a piece and its landing squares """
+    if not isinstance(value, list) or not 2 <= len(value) <= MAX_PATH:
+        return INVALID
+    path = [decode_square(pos) for pos in value]
+    if INVALID in path:
+        return INVALID
+    return path
+
+
+# Field kind -> (decoder, error when invalid)
+KINDS = {
+    'room': (decode_id, (BAD_ROOM_ID, 'Room IDs must be integers')),
+    'player': (decode_id, (WRONG_PLAYER, 'Player IDs must be integers')),
+    'square': (decode_square,
+               (BAD_SQUARE, 'Squares must be integers from 0 to 63')),
+    'seq': (decode_id, (BAD_REQUEST, 'Sequence numbers must be integers')),
+    'rating': (decode_id, (BAD_REQUEST, 'Ratings must be positive integers')),
+    'token': (decode_token, (BAD_TOKEN, 'Resume token is not valid')),
+    'flag': (decode_flag, None),
+    'status': (decode_status,
+               (BAD_REQUEST, 'Lobby status must be one of: %s' %
+                ', '.join(LOBBY_STATUSES))),
+    'cursor': (decode_cursor, (BAD_REQUEST, 'Lobby cursor is not valid')),
+    'limit': (decode_limit,
+              (BAD_REQUEST, 'Lobby pages hold 1 to %d rooms' % MAX_PAGE)),
+    'path': (decode_path,
+             (BAD_REQUEST, 'Paths must be lists of 2 to %d squares' %
+              MAX_PATH)),
+}
+
+
+class Schema:
+    """ Fields of one event payload. fields maps a key to (kind, required),
+        keys that are not required decode to None, or False for flags, when
+        missing. error replaces the error of every field when given.
+        limited tells whether the event counts against the rate limit
+        """
+
+    def __init__(self, fields, error=None, limited=True):
+        self.limited = limited
+        self.fields = []
+        for key, (kind, required) in fields.items():
+            decoder, field_error = KINDS[kind]
+            default = False if kind == 'flag' else None
+            self.fields.append((key, decoder, required, default,
+                                error or field_error))
+
+    def decode(self, data):
+        """ Returns (values by key, None), or (None, (code, message)).
+        Events without fields ignore their payload """
+        if data is None or not self.fields:
+            data = {}
+        elif not isinstance(data, dict):
+            return None, (BAD_REQUEST, 'Event payloads must be objects')
+        values = {}
+        for key, decoder, required, default, error in self.fields:
+            value = data.get(key)
+            if value is None:
+                if required:
+                    return None, error
+                values[key] = default
+                continue
+            value = decoder(value)
+            if value is INVALID:
+                return None, error
+            values[key] = value
+        return values, None
+
+
+ROOM = ('room', True)
+FLAG = ('flag', False)
+
+# Event name -> Schema
+SCHEMAS = {
+    'create': Schema({'compact': FLAG, 'ai': FLAG, 'mandatoryCapture': FLAG}),
+    'join': Schema({'room_id': ROOM, 'compact': FLAG}),
+    'watch': Schema({'room_id': ROOM, 'compact': FLAG}),
+    'requestSnapshot': Schema({'room_id': ROOM, 'compact': FLAG}),
+    'resume': Schema({'token': ('token', True), 'seq': ('seq', False),
+                      'compact': FLAG}),
+    'queue': Schema({'rating': ('rating', False), 'compact': FLAG,
+                     'mandatoryCapture': FLAG}),
+    'unqueue': Schema({}),
+    # Also the query of /lobby.json
+    'lobby': Schema({'status': ('status', False), 'cursor': ('cursor', False),
+                     'limit': ('limit', False), 'subscribe': FLAG}),
+    'leaveLobby': Schema({}),
+    # Also the transport disconnect, which passes a reason and must never be
+    # dropped
+    'exit': Schema({}, limited=False),
+    'getMoves': Schema({'room_id': ROOM, 'pieceToMove': ('square', True),
+                        'player_id': ('player', False)}),
+    # Squares are required when makeMove is true, see Handler.make_move
+    'makeMove': Schema({'room_id': ROOM, 'makeMove': ('flag', True),
+                        'pieceToMove': ('square', False),
+                        'moveToLocation': ('square', False),
+                        'player_id': ('player', False)}),
+    'makeMoveSequence': Schema(
+        {'room_id': ROOM, 'path': ('path', True)},
+        error=(BAD_REQUEST,
+               'Move sequences need a room_id and a path of positions')),
+}
+
+
+class RateLimiter:
+    """ Token bucket per connection: rate events a second on average, in
+        bursts of up to burst events. A rate of 0 disables the limit """
+
+    def __init__(self, rate=20.0, burst=40, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.lock = threading.Lock()
+        # sid -> (tokens left, time they were counted)
+        self.buckets = {}
+
+    def allow(self, sid):
+        """ Takes a token from sid's bucket, False if it is empty """
+        if not self.rate:
+            return True
+        now = self.clock()
+        with self.lock:
+            tokens, last = self.buckets.get(sid, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[sid] = (tokens, now)
+                return False
+            self.buckets[sid] = (tokens - 1, now)
+            return True
+
+    def forget(self, sid):
+        """ Drops the bucket of a disconnected client """
+        with self.lock:
+            self.buckets.pop(sid, None)
@@ -10,6 +10,15 @@
 var saveCurrentState = null;
 var previousCells = [];
 
+// Square labels of the compact board encoding (see Board.toCompact)
+var COMPACT_LABELS = {
+    '.': 'BLANK',
+    'a': 'P1',
+    'A': 'P1_KING',
+    'b': 'P2',
+    'B': 'P2_KING'
+};
+
 $(document).ready(function () {
     // Make sure the enter key works on our input field
     var input = document.getElementById("joinInput");
@@ -27,15 +36,35 @@ function setupGamePage() {
 }
 
 // createGame onclick - emit a message on the 'create' channel to
-// create a new game with default parameters
-function createGame() {
-    socket.emit('create');
+// create a new game with default parameters, against the computer when ai
+// is set
+function createGame(ai) {
+    socket.emit('create', {
+        'compact': true,
+        'ai': !!ai
+    });
+}
+
+// Wait in the matchmaking queue until the server pairs us with someone
+function findOpponent() {
+    socket.emit('queue', {
+        'compact': true
+    });
 }
 
 // Join existing game
 function joinGame(roomID) {
     socket.emit('join', {
-        'room_id': $('#joinInput').val()
+        'room_id': $('#joinInput').val(),
+        'compact': true
+    });
+}
+
+// Follow an existing game as a spectator
+function watchGame() {
+    socket.emit('watch', {
+        'room_id': $('#joinInput').val(),
+        'compact': true
     });
 }
 
@@ -66,6 +95,40 @@ function genBoard(data) {
 }
 
 
+function expandBoard(compact) {
+    // Expands a compact board, one character per dark square, into the
+    // 64 square label array
+    var board = [];
+    for (var i = 0; i < 64; i++) {
+        board.push('BLANK');
+    }
+    for (var idx = 0; idx < compact.length; idx++) {
+        var row = idx >> 2;
+        var pos = row * 8 + 2 * (idx & 3) + (1 - (row & 1));
+        board[pos] = COMPACT_LABELS[compact[idx]];
+    }
+    return board;
+}
+
+function applyDelta(state, delta) {
+    // Builds the next board state from the last one and an update_delta
+    var board = state.board.slice();
+    for (var i = 0; i < delta.squares.length; i++) {
+        var label = delta.squares[i][1];
+        board[delta.squares[i][0]] = COMPACT_LABELS[label] || label;
+    }
+    return {
+        'v': delta.v,
+        'seq': delta.seq,
+        'playerTurn': delta.playerTurn,
+        'secondMove': delta.secondMove,
+        'players': state.players,
+        'board': board,
+        'movablePieces': delta.movablePieces,
+        'state': delta.state
+    };
+}
+
 function highlightBoard(data) {
     /**
     * Highlights the board if it is the current active player's turn
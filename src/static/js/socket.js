@@ -6,16 +6,55 @@
 var socket = io.connect('http://' + document.domain + ':' + location.port);
 var player_id = null;
 var room_id = null;
+// Sequence number of the last update applied to the board
+var seq = null;
+// Token taking our seat back after a reconnect or a reload of the page
+var resume_token = sessionStorage.getItem('resume_token');
+var resuming = false;
 
 // Assigns global client variables and sets up game page when joining a room
 socket.on('join_room', function(msg) {
     player_id = msg.player_id;
     room_id = msg.room_id;
+    resume_token = msg.resume_token;
+    resuming = false;
+    sessionStorage.setItem('resume_token', resume_token);
     setupGamePage();
 });
 
+// Socket.IO reconnects on its own, the server then needs to know who we are
+socket.on('connect', function() {
+    if (resume_token === null) {
+        return;
+    }
+    resuming = true;
+    socket.emit('resume', {
+        'token': resume_token,
+        'seq': seq,
+        'compact': true
+    });
+});
+
+// Spectators only get 'update' snapshots and never have a turn
+socket.on('watch_room', function(msg) {
+    room_id = msg.room_id;
+    setupGamePage();
+});
+
+// We get 'join_room' once the matchmaking queue found an opponent
+socket.on('queued', function(msg) {
+    $('#user_message_header').text('Waiting for an opponent...').show();
+});
+
 // message handler for 'error'
 socket.on('error', function(msg) {
+    if (resuming) {
+        // The game is gone, start over from the menu
+        resuming = false;
+        resume_token = null;
+        sessionStorage.removeItem('resume_token');
+        return;
+    }
     alert(msg.error);
 });
 
@@ -24,9 +63,28 @@ socket.on('error', function(msg) {
 
 // Creating a new board on top of the existing one.
 socket.on('update', function(data) {
+    if (typeof data.board === 'string') {
+        data.board = expandBoard(data.board);
+    }
+    seq = data.seq;
     genBoard(data);
 });
 
+// Handler for delta updates, only carries the squares that changed.
+// A gap in the sequence numbers means an update was missed, so fall back
+// to a full snapshot.
+socket.on('update_delta', function(data) {
+    if (saveCurrentState === null || data.seq != seq + 1) {
+        socket.emit('requestSnapshot', {
+            'room_id': room_id,
+            'compact': true
+        });
+        return;
+    }
+    seq = data.seq;
+    genBoard(applyDelta(saveCurrentState, data));
+});
+
 socket.on('sendMoves', function(data){
     highlightSendMoves(data);
 });
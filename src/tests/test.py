@@ -5,14 +5,40 @@
 
     C0413 is disabled because we require the sys.path.insert before importing
 """
+import asyncio
+import concurrent.futures
+import gzip
+import os
+import random
 import sys
+import tempfile
+import threading
+import time
 import unittest
+sys.path.insert(0, 'src/bench')
 sys.path.insert(0, 'src/flask')
 sys.path.insert(0, 'src/')
 
 try:
-    from app import get_handler
+    import engineio
+    from app import Handler, get_handler
+    from rooms import RoomRegistry, UniqueIDGenerator
+    from sqlite_store import SQLiteRoomStore
+    from lifecycle import RoomLifecycle
+    from gamelog import FileGameLog, GameLog
+    from spectators import SpectatorFeed
+    from metrics import Metrics
+    from profiler import SamplingProfiler
+    from validation import RateLimiter, SCHEMAS, decode_cursor
+    from matchmaking import MatchQueue
+    from lobby import LobbyIndex
+    import assets
+    from asgi import AsyncHandler
     from State import State
+    from Board import Board
+    import Bitboard
+    import perft
+    import Search
 except ImportError:
     print("Failed to import")
     sys.exit(1)
@@ -168,6 +194,49 @@ class TestSocketIo(unittest.TestCase):
 
         play_game(moves, room_id)
 
+    def test_join_finished_room(self):
+        """ Rooms whose creator left cannot be joined """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        player1.emit('create')
+        room_id = player1.get_received()[0]['args'][0]['room_id']
+        player1.emit('exit')
+        self.assertNotIn(room_id, self.HANDLER.rooms)
+        self.assertNotIn(room_id, self.HANDLER.lobby.rooms)
+        player2.emit('join', {'room_id': room_id})
+        self.assertEqual(player2.get_received()[0]['args'][0]['code'],
+                         'NO_SUCH_ROOM')
+
+        # Still listed, e.g. by another worker sharing the store
+        game = State(self.HANDLER.player_handler.generate_id())
+        game.disconnect(game.player1)
+        room_id = self.HANDLER.rooms.add(game)
+        player2.emit('join', {'room_id': room_id})
+        self.assertEqual(player2.get_received()[0]['args'][0]['code'],
+                         'GAME_OVER')
+        self.assertIsNone(self.HANDLER.rooms[room_id].player2)
+
+    def test_move_while_waiting(self):
+        """ Nobody moves before the second player joins """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        player1.emit('create')
+        info = player1.get_received()[0]['args'][0]
+        room_id = info['room_id']
+
+        make_move((40, 33, player1), room_id)
+        player1.emit('makeMoveSequence', {'room_id': room_id,
+                                          'path': [40, 33]})
+        errors = player1.get_received()
+        self.assertEqual([error['args'][0]['code'] for error in errors],
+                         ['NOT_STARTED', 'NOT_STARTED'])
+
+        player2.emit('join', {'room_id': room_id})
+        update = player1.get_received()[0]['args'][0]
+        self.assertEqual(update['state'], 'P1_TURN')
+        self.assertEqual(self.HANDLER.rooms[room_id].playerTurn,
+                         info['player_id'])
+
     def test_make_move_2(self):
         """ p_1 win by no moves left for p_2 """
         player1 = self.create_test_client()
@@ -227,6 +296,458 @@ class TestSocketIo(unittest.TestCase):
         self.assertEqual(data['pieces'], [33])
         self.assertEqual(data['pieceBeingMoved'], 40)
 
+    def test_update_delta(self):
+        """ Moves are broadcast as deltas, snapshots are sent on request """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+
+        player1.emit('create')
+        room_id = player1.get_received()[0]['args'][0]['room_id']
+        player2.emit('join', {'room_id': room_id})
+        received = player2.get_received()
+        player2_id = received[0]['args'][0]['player_id']
+        snapshot = received[-1]
+        self.assertEqual(snapshot['name'], 'update')
+        self.assertEqual(snapshot['args'][0]['seq'], 0)
+        player1.get_received()
+
+        make_move((40, 33, player1), room_id)
+        received = player2.get_received()
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]['name'], 'update_delta')
+        delta = received[0]['args'][0]
+        self.assertEqual(delta['seq'], 1)
+        self.assertEqual(delta['squares'], [[33, 'P1'], [40, 'BLANK']])
+        self.assertEqual(delta['captured'], [])
+        self.assertEqual(delta['playerTurn'], player2_id)
+        self.assertEqual(delta['movablePieces'], [17, 19, 21, 23])
+
+        player2.emit('requestSnapshot', {'room_id': room_id})
+        received = player2.get_received()
+        self.assertEqual(len(received), 1)
+        snapshot = received[0]['args'][0]
+        self.assertEqual(snapshot['seq'], 1)
+        self.assertEqual(snapshot['board'][33], 'P1')
+        # Only the requesting client gets the snapshot
+        self.assertEqual(player1.get_received()[-1]['name'], 'update_delta')
+
+    def test_resume(self):
+        """ A player whose connection dropped takes their seat back with
+        their resume token, and forfeits if they do not come back """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        player1.emit('create', {'compact': True})
+        info = player1.get_received()[0]['args'][0]
+        room_id = info['room_id']
+        token = info['resume_token']
+        player2.emit('join', {'room_id': room_id})
+        player2.get_received()
+        late = self.create_test_client()
+        late.emit('join', {'room_id': room_id})
+        self.assertEqual(late.get_received()[0]['args'][0]['code'],
+                         'ROOM_FULL')
+        make_move((40, 33, player1), room_id)
+        player1.get_received()
+        player1.disconnect()
+
+        # The game goes on while player 1 is away
+        make_move((17, 26, player2), room_id)
+        self.assertFalse(self.HANDLER.rooms[room_id].isFinished())
+
+        # Caught up with the deltas missed since seq 1
+        resumed = self.create_test_client()
+        resumed.emit('resume', {'token': token, 'seq': 1, 'compact': True})
+        received = resumed.get_received()
+        self.assertEqual(received[0]['args'][0]['player_id'],
+                         info['player_id'])
+        self.assertEqual([item['name'] for item in received[1:]],
+                         ['update_delta'])
+        self.assertEqual(received[1]['args'][0]['seq'], 2)
+        self.assertEqual(received[1]['args'][0]['squares'],
+                         [[17, '.'], [26, 'b']])
+        make_move((33, 42, resumed), room_id)
+        self.assertEqual(resumed.get_received()[0]['args'][0]['code'],
+                         'ILLEGAL_MOVE')
+        make_move((44, 37, resumed), room_id)
+        self.assertEqual(player2.get_received()[-1]['args'][0]['seq'], 3)
+
+        # Without a seq, or too far behind, a single snapshot
+        other = self.create_test_client()
+        other.emit('resume', {'token': token})
+        received = other.get_received()
+        self.assertEqual([item['name'] for item in received],
+                         ['join_room', 'update'])
+        self.assertEqual(received[1]['args'][0]['seq'], 3)
+        other.emit('resume', {'token': token[:-1] + 'x', 'seq': 3})
+        self.assertEqual(other.get_received()[0]['args'][0]['code'],
+                         'BAD_TOKEN')
+
+        # Players who stay away forfeit once the grace period is over
+        player2.disconnect()
+        self.assertFalse(self.HANDLER.rooms[room_id].isFinished())
+        self.HANDLER.forfeit_dropped()
+        self.assertFalse(self.HANDLER.rooms[room_id].isFinished())
+        clock = self.HANDLER.lifecycle.clock
+        self.HANDLER.lifecycle.clock = \
+            lambda: clock() + self.HANDLER.resume_grace
+        try:
+            self.HANDLER.forfeit_dropped()
+        finally:
+            self.HANDLER.lifecycle.clock = clock
+        self.assertEqual(self.HANDLER.rooms[room_id].state, 'P2_DISCONNECT')
+        self.assertEqual(resumed.get_received()[-1]['args'][0]['state'],
+                         'P2_DISCONNECT')
+
+    def test_update_compact_board(self):
+        """ Clients asking for the compact encoding get 32 character boards """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+
+        player1.emit('create', {'compact': True})
+        received = player1.get_received()
+        room_id = received[0]['args'][0]['room_id']
+        self.assertEqual(received[1]['args'][0]['board'],
+                         'b' * 12 + '.' * 8 + 'a' * 12)
+
+        player2.emit('join', {'room_id': room_id})
+        self.assertEqual(len(player2.get_received()[-1]['args'][0]['board']),
+                         64)
+        player1.get_received()
+
+        make_move((40, 33, player1), room_id)
+        delta = player1.get_received()[0]['args'][0]
+        self.assertEqual(delta['squares'], [[33, 'a'], [40, '.']])
+        delta = player2.get_received()[0]['args'][0]
+        self.assertEqual(delta['squares'], [[33, 'P1'], [40, 'BLANK']])
+
+    def test_disconnect(self):
+        """ The remaining player wins by forfeit when the other one leaves """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+
+        player1.emit('create')
+        room_id = player1.get_received()[0]['args'][0]['room_id']
+        player2.emit('join', {'room_id': room_id})
+        player2.get_received()
+
+        # Without a grace period for resuming, see test_resume
+        grace = self.HANDLER.resume_grace
+        self.HANDLER.resume_grace = 0
+        try:
+            player1.disconnect()
+        finally:
+            self.HANDLER.resume_grace = grace
+        update = player2.get_received()[-1]
+        self.assertEqual(update['name'], 'update')
+        self.assertEqual(update['args'][0]['state'], 'P1_DISCONNECT')
+        self.assertTrue(self.HANDLER.rooms[room_id].isFinished())
+
+        stats = self.APP.test_client().get('/stats').get_json()
+        self.assertGreater(stats['rooms'], 0)
+        self.assertGreater(stats['bytes_per_room'], 0)
+
+    def test_validation(self):
+        """ Bad events get an error code before any board work """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        stranger = self.create_test_client()
+        player1.emit('create')
+        info = player1.get_received()[0]['args'][0]
+        room_id = info['room_id']
+        player2.emit('join', {'room_id': str(room_id)})
+        player2_id = player2.get_received()[0]['args'][0]['player_id']
+        player1.get_received()
+
+        def error(client, event, data):
+            client.emit(event, data)
+            received = client.get_received()
+            self.assertEqual(received[-1]['name'], 'error')
+            return received[-1]['args'][0]['code']
+
+        move = {'makeMove': True, 'room_id': room_id, 'pieceToMove': 40,
+                'moveToLocation': 33}
+        self.assertEqual(error(player1, 'makeMove', dict(
+            move, pieceToMove=64)), 'BAD_SQUARE')
+        self.assertEqual(error(player1, 'makeMove', dict(
+            move, room_id=[1])), 'BAD_ROOM_ID')
+        self.assertEqual(error(player1, 'makeMove', 'move'), 'BAD_REQUEST')
+        self.assertEqual(error(stranger, 'makeMove', move), 'NOT_IN_ROOM')
+        self.assertEqual(error(player1, 'getMoves', {
+            'room_id': room_id, 'pieceToMove': 40,
+            'player_id': player2_id}), 'WRONG_PLAYER')
+        self.assertEqual(error(player2, 'makeMove', dict(
+            move, pieceToMove=17, moveToLocation=26)), 'NOT_YOUR_TURN')
+        self.assertEqual(error(player1, 'makeMove', dict(
+            move, moveToLocation=32)), 'ILLEGAL_MOVE')
+        self.assertEqual(player2.get_received(), [])
+
+        # Squares sent as strings, like the web client does, still work
+        player1.emit('makeMove', dict(move, pieceToMove='40',
+                                      moveToLocation='33'))
+        self.assertEqual(player2.get_received()[0]['name'], 'update_delta')
+
+        limiter = self.HANDLER.limiter
+        self.HANDLER.limiter = RateLimiter(rate=1, burst=2)
+        try:
+            self.assertEqual(error(stranger, 'requestSnapshot', {}),
+                             'BAD_ROOM_ID')
+            self.assertEqual(error(stranger, 'requestSnapshot', {}),
+                             'BAD_ROOM_ID')
+            self.assertEqual(error(stranger, 'requestSnapshot', {}),
+                             'RATE_LIMITED')
+        finally:
+            self.HANDLER.limiter = limiter
+
+    def test_watch(self):
+        """ Spectators get coalesced snapshots at most fps times a second """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        spectator = self.create_test_client()
+        now = [0.0]
+        spectators = self.HANDLER.spectators
+        self.HANDLER.spectators = SpectatorFeed(fps=4, clock=lambda: now[0])
+        try:
+            player1.emit('create')
+            room_id = player1.get_received()[0]['args'][0]['room_id']
+            player2.emit('join', {'room_id': room_id})
+            player1.get_received()
+            player2.get_received()
+            self.HANDLER.send_spectator_frames()
+
+            spectator.emit('watch', {'room_id': room_id, 'compact': True})
+            received = spectator.get_received()
+            self.assertEqual(received[0]['name'], 'watch_room')
+            self.assertEqual(received[1]['args'][0]['board'],
+                             'b' * 12 + '.' * 8 + 'a' * 12)
+
+            # Players get every move, spectators nothing until a frame
+            make_move((40, 33, player1), room_id)
+            make_move((17, 26, player2), room_id)
+            self.assertEqual(len(player1.get_received()), 2)
+            self.assertEqual(spectator.get_received(), [])
+
+            # Both moves arrive in one frame
+            now[0] += 0.25
+            self.HANDLER.send_spectator_frames()
+            received = spectator.get_received()
+            self.assertEqual(len(received), 1)
+            self.assertEqual(received[0]['name'], 'update')
+            self.assertEqual(received[0]['args'][0]['seq'], 2)
+            self.assertEqual(received[0]['args'][0],
+                             self.HANDLER.rooms[room_id].toJSON(True))
+
+            # The next frame waits for the interval
+            make_move((33, 24, player1), room_id)
+            now[0] += 0.1
+            self.HANDLER.send_spectator_frames()
+            self.assertEqual(spectator.get_received(), [])
+            now[0] += 0.15
+            self.HANDLER.send_spectator_frames()
+            self.assertEqual(spectator.get_received()[0]['args'][0]['seq'],
+                             3)
+
+            # Rooms without spectators are never marked
+            spectator.emit('watch', {'room_id': room_id})
+            spectator.get_received()
+            self.assertEqual(self.HANDLER.rooms[room_id].watchers, 1)
+            spectator.disconnect()
+            self.assertEqual(self.HANDLER.rooms[room_id].watchers, 0)
+            make_move((24, 10, player1), room_id)
+            self.assertEqual(self.HANDLER.spectators.pending, set())
+        finally:
+            self.HANDLER.spectators = spectators
+
+    def test_metrics(self):
+        """ Handler timings and gauges are served on /metrics, the profiler
+        on /profile when enabled """
+        client = self.create_test_client()
+        client.emit('create')
+        tester = self.APP.test_client()
+        response = tester.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('# TYPE kingme_handler_seconds histogram', text)
+        self.assertRegex(text, r'kingme_handler_seconds_count'
+                               r'\{handler="create"\} [1-9]')
+        self.assertRegex(text, r'kingme_rooms [1-9]')
+        self.assertIn('kingme_connected_sockets', text)
+
+        self.assertEqual(tester.get('/profile/start').status_code, 404)
+        self.HANDLER.profiler = SamplingProfiler(interval=0.001)
+        try:
+            self.assertEqual(tester.get('/profile/start').status_code, 200)
+            self.assertEqual(tester.get('/profile/start').status_code, 409)
+            time.sleep(0.05)
+            folded = tester.get('/profile/stop').get_data(as_text=True)
+            self.assertIn('test_metrics (test.py:', folded)
+            self.assertFalse(tester.get('/profile/status').get_json()
+                             ['running'])
+        finally:
+            self.HANDLER.profiler.stop()
+            self.HANDLER.profiler = None
+
+    def test_queue(self):
+        """ Queued players are paired into rooms of their own """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        leaving = self.create_test_client()
+        exiting = self.create_test_client()
+        player1.emit('queue', {'compact': True, 'rating': 1450})
+        leaving.emit('queue', {'rating': 1420})
+        exiting.emit('queue', {'rating': 1430})
+        exiting.emit('exit')
+        self.assertEqual(player1.get_received()[0]['args'][0],
+                         {'waiting': 1})
+        leaving.disconnect()
+        player2.emit('queue', {'rating': 1500})
+        self.assertEqual(player2.get_received()[0]['name'], 'queued')
+        self.HANDLER.match_players()
+
+        info = player1.get_received()
+        self.assertEqual(info[0]['name'], 'join_room')
+        room_id = info[0]['args'][0]['room_id']
+        self.assertEqual(info[1]['args'][0]['board'],
+                         'b' * 12 + '.' * 8 + 'a' * 12)
+        info = player2.get_received()
+        self.assertEqual(info[0]['args'][0]['room_id'], room_id)
+        self.assertEqual(info[1]['args'][0]['state'], 'P1_TURN')
+        self.assertEqual(len(self.HANDLER.matchmaking), 0)
+
+        # The room works as if created and joined
+        make_move((40, 33, player1), room_id)
+        self.assertEqual(player2.get_received()[0]['name'], 'update_delta')
+
+    def test_lobby(self):
+        """ Lobby clients page through rooms and follow their changes """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+        visitor = self.create_test_client()
+        player1.emit('create')
+        room_id = player1.get_received()[0]['args'][0]['room_id']
+
+        visitor.emit('lobby', {'subscribe': True, 'limit': 1})
+        listing = visitor.get_received()[0]['args'][0]
+        rooms = listing['rooms']
+        while listing['cursor'] is not None:
+            visitor.emit('lobby', {'cursor': listing['cursor'], 'limit': 1})
+            listing = visitor.get_received()[0]['args'][0]
+            rooms.extend(listing['rooms'])
+        self.assertEqual([room['room_id'] for room in rooms],
+                         [key[1] for key in self.HANDLER.lobby.keys['open']])
+        self.assertIn(room_id, [room['room_id'] for room in rooms])
+
+        player2.emit('join', {'room_id': room_id})
+        change = visitor.get_received()[0]
+        self.assertEqual(change['name'], 'lobby_change')
+        self.assertEqual(change['args'][0]['status'], 'playing')
+        make_move((40, 33, player1), room_id)
+        self.assertEqual(visitor.get_received(), [])
+
+        visitor.emit('leaveLobby')
+        player2.emit('exit')
+        self.assertEqual(visitor.get_received(), [])
+        self.assertNotIn(room_id, self.HANDLER.lobby.rooms)
+
+        client = self.APP.test_client()
+        response = client.get('/lobby.json?status=playing&limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(response.get_json()['rooms']), 2)
+        self.assertEqual(client.get('/lobby.json?cursor=x').status_code, 400)
+        self.assertEqual(client.get('/lobby').status_code, 200)
+
+    def test_assets(self):
+        """ Built assets are served precompressed and immutable """
+        with tempfile.TemporaryDirectory() as out_dir:
+            manifest = assets.build(self.HANDLER.static_dir, out_dir)
+            store = self.HANDLER.assets
+            self.HANDLER.assets = assets.AssetStore(out_dir)
+            try:
+                client = self.APP.test_client()
+                url = self.HANDLER.assets.url('js/board.js')
+                response = client.get(url, headers={
+                    'Accept-Encoding': 'gzip, br;q=0'})
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(response.headers['Cache-Control'],
+                                 assets.IMMUTABLE)
+                with open(os.path.join(out_dir, manifest['js/board.js']),
+                          'rb') as built:
+                    self.assertEqual(gzip.decompress(response.data),
+                                     built.read())
+                response = client.get(url)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertEqual(client.get('/assets/js/board.js').status_code,
+                                 404)
+            finally:
+                self.HANDLER.assets = store
+
+    def test_create_ai(self):
+        """ A game against the computer starts right away and the computer
+        answers moves """
+        client = self.create_test_client()
+        self.HANDLER.ai_time = 0.05
+        client.emit('create', {'ai': True})
+        received = client.get_received()
+        player_id = received[0]['args'][0]['player_id']
+        room_id = received[0]['args'][0]['room_id']
+        self.assertEqual(received[1]['args'][0]['state'], 'P1_TURN')
+
+        make_move((40, 33, client), room_id)
+        deadline = time.time() + 30
+        deltas = []
+        while len(deltas) < 2 and time.time() < deadline:
+            deltas += [item['args'][0] for item in client.get_received()
+                       if item['name'] == 'update_delta']
+            time.sleep(0.05)
+        self.assertEqual(len(deltas), 2)
+        self.assertEqual(deltas[1]['playerTurn'], player_id)
+        self.assertTrue(deltas[1]['squares'])
+
+    def test_search_failure(self):
+        """ The computer still moves when its search fails """
+        player_id = self.HANDLER.player_handler.generate_id()
+        game = State(player_id)
+        game.joinComputer(self.HANDLER.player_handler.generate_id())
+        game.makeMove(40, 33)
+        room_id = self.HANDLER.rooms.add(game)
+        future = concurrent.futures.Future()
+        future.set_exception(RuntimeError('worker died'))
+
+        with self.assertLogs('kingme.app', 'ERROR') as logs:
+            self.HANDLER.wait_ai(room_id,
+                                 self.HANDLER.rooms[room_id].positionHash(),
+                                 future)
+        self.assertIn('worker died', logs.output[0])
+        game = self.HANDLER.rooms[room_id]
+        self.assertEqual(game.playerTurn, player_id)
+        self.assertEqual(len(game.history), 2)
+
+    def test_make_move_sequence(self):
+        """ A whole jump chain is applied at once with a single update """
+        player1 = self.create_test_client()
+        player2 = self.create_test_client()
+
+        player1.emit('create')
+        room_id = player1.get_received()[0]['args'][0]['room_id']
+        player2.emit('join', {'room_id': room_id})
+        player2_id = player2.get_received()[0]['args'][0]['player_id']
+        player1.get_received()
+        with self.HANDLER.rooms.checkout(room_id) as game:
+            game.board.loadCompact('.bb.....b........b........b.aa.a')
+
+        player1.emit('makeMoveSequence', {'room_id': room_id,
+                                          'path': [62, 44, 8]})
+        self.assertEqual(player1.get_received()[0]['name'], 'error')
+        self.assertEqual(player2.get_received(), [])
+
+        player1.emit('makeMoveSequence', {'room_id': room_id,
+                                          'path': [62, 44, 26, 8]})
+        received = player2.get_received()
+        self.assertEqual(len(received), 1)
+        delta = received[0]['args'][0]
+        self.assertEqual(sorted(delta['captured']), [17, 35, 53])
+        self.assertEqual(delta['playerTurn'], player2_id)
+        self.assertEqual(delta['secondMove'], None)
+
 
 def play_game(moves, room_id):
     """ Simulate a game by executing a set of moves """
@@ -275,6 +796,748 @@ class TestBoard(unittest.TestCase):
         state.join(self.player2)
         state.end("force end")
 
+    def test_board_encoding(self):
+        """ Squares are seeded consistently and moves do not copy pieces """
+        board = Board(self.player1, self.player2)
+        for pos in [53, 55, 58]:
+            piece = board.piece(pos)
+            self.assertEqual(piece.pos, pos)
+            self.assertEqual(piece.player, self.player1)
+        self.assertIsNone(board.piece(0))
+        self.assertEqual(board.makeMove(40, 33, None), board.MOVE_NO_JUMP)
+        self.assertIsNone(board.player(40))
+        self.assertEqual(board.player(33), self.player1)
+        self.assertEqual(board.toJSON()[33], "P1")
+
+    def test_move_cache(self):
+        """ The incremental move cache survives a game in debug mode """
+        state = State(self.player1)
+        state.join(self.player2)
+        state.board.debugMoveCache = True
+        for src, dest in [(40, 33), (17, 26), (33, 24), (10, 17), (24, 10),
+                          (3, 17), (44, 37), (26, 35), (46, 39), (21, 30),
+                          (39, 21)]:
+            state.makeMove(src, dest)
+        self.assertEqual(state.getMovablePieces(), [21])
+        self.assertEqual(state.getMoves(21), [3])
+
+        state.board.moveCache[1].clear()
+        with self.assertRaises(ValueError):
+            state.board.checkMoveCache()
+
+    def test_serialization_cache(self):
+        """ Serialized boards are reused until a move changes them """
+        board = Board(self.player1, self.player2)
+        self.assertIs(board.toJSON(), board.toJSON())
+        self.assertIs(board.toCompact(), board.toCompact())
+        before = board.toJSON()
+        board.makeMove(40, 33, None)
+        self.assertIsNot(board.toJSON(), before)
+        self.assertEqual(board.toJSON()[33], "P1")
+        self.assertEqual(board.toCompact()[16], "a")
+
+    def test_bitboard_tables(self):
+        """ Dark square indices round trip and neighbours match the
+        board offsets """
+        for idx in range(32):
+            pos = Bitboard.toPos(idx)
+            self.assertEqual(Bitboard.toIndex(pos), idx)
+            self.assertEqual((pos // 8 + pos % 8) % 2, 1)
+            for direction in Bitboard.DIRECTIONS:
+                over = Bitboard.NEIGHBOUR[direction][idx]
+                if over != Bitboard.NO_SQUARE:
+                    self.assertEqual(Bitboard.toPos(over) - pos,
+                                     Bitboard.OFFSETS[direction])
+
+    def test_movable_pieces_opening(self):
+        """ Bulk move generation agrees with per piece generation """
+        board = Board(self.player1, self.player2)
+        self.assertEqual(board.movablePieces(self.player1, None),
+                         [40, 42, 44, 46])
+        self.assertEqual(board.movablePieces(self.player2, None),
+                         [17, 19, 21, 23])
+        self.assertEqual(board.getMoves(40, None), [33])
+        self.assertEqual(board.getMoves(42, None), [33, 35])
+        self.assertEqual(board.getMoves(0, None), [])
+        for player in [self.player1, self.player2]:
+            movable = [pos for pos in range(64)
+                       if board.player(pos) == player and
+                       board.canMove(pos, None)]
+            self.assertEqual(board.movablePieces(player, None), movable)
+
+    def test_load_compact(self):
+        """ Positions round trip through the compact form """
+        board = Board(self.player1, self.player2)
+        board.makeMove(40, 33, None)
+        other = Board(self.player1, self.player2)
+        other.loadCompact(board.toCompact())
+        self.assertEqual(other.toJSON(), board.toJSON())
+        self.assertEqual(other.player1_count, 12)
+
+        other.loadCompact('.bb.....b........b........b.aa.a')
+        self.assertEqual(other.player2_count, 5)
+        self.assertEqual(other.movablePieces(self.player1, None),
+                         [56, 58, 62])
+        self.assertEqual(other.getMoves(62, None), [44, 55])
+        self.assertTrue(other.isJump(62, 44))
+        with self.assertRaises(ValueError):
+            other.loadCompact('.b')
+
+    def test_position_hash(self):
+        """ Transposed move orders reach the same hash, which matches a
+        full recompute """
+        first = State(self.player1)
+        first.join(self.player2)
+        second = State(self.player1)
+        second.join(self.player2)
+        start = first.positionHash()
+        for src, dest in [(40, 33), (17, 24), (42, 35), (19, 28)]:
+            first.makeMove(src, dest)
+        self.assertNotEqual(first.positionHash(), start)
+        for src, dest in [(42, 35), (19, 28), (40, 33), (17, 24)]:
+            second.makeMove(src, dest)
+        self.assertEqual(first.positionHash(), second.positionHash())
+        self.assertEqual(first.board.hash, first.board.computeHash())
+
+        second.makeMove(46, 39)
+        self.assertNotEqual(second.board.hash, first.board.hash)
+        self.assertEqual(second.board.hash, second.board.computeHash())
+        # Same pieces, other side to move
+        second.board.hash = first.board.hash
+        self.assertNotEqual(first.positionHash(), second.positionHash())
+
+    def test_undo(self):
+        """ Every move of a game, jumps and crownings included, can be
+        taken back """
+        state = State(self.player1)
+        state.join(self.player2)
+        state.board.debugMoveCache = True
+        start = state.board.toJSON()
+        for src, dest in [(40, 33), (17, 26), (33, 24), (10, 17), (24, 10),
+                          (3, 17), (44, 37), (26, 35), (46, 39), (21, 30),
+                          (39, 21), (21, 3)]:
+            state.makeMove(src, dest)
+        self.assertTrue(state.board.king(3))
+        self.assertEqual(state.board.player2_count, 9)
+        state.board.takeChanges()
+
+        state.undo()
+        self.assertEqual(state.prevChainJmp, 21)
+        self.assertEqual(state.playerTurn, self.player1)
+        self.assertEqual(state.board.player(21), self.player1)
+        self.assertFalse(state.board.king(21))
+        self.assertEqual(state.board.player(12), self.player2)
+        self.assertEqual(state.board.takeChanges(), ([3, 12, 21], []))
+
+        while state.history:
+            state.undo()
+        self.assertEqual(state.board.toJSON(), start)
+        self.assertEqual(state.board.hash, state.board.computeHash())
+        self.assertEqual(state.playerTurn, self.player1)
+        with self.assertRaises(ValueError):
+            state.undo()
+
+    def test_move_sequences(self):
+        """ Whole turns, including every way through a jump chain """
+        chain = '.bb.....b........b........b.aa.a'
+        state = perft.start_state(chain)
+        self.assertEqual(state.moveSequences(), [
+            (56, 49), (58, 49), (58, 51), (62, 44), (62, 44, 26),
+            (62, 44, 26, 8), (62, 55)])
+        self.assertEqual(state.getMovablePieces(), [56, 58, 62])
+        self.assertEqual(state.getMoves(62), [44, 55])
+        state.makeMove(62, 44)
+        self.assertEqual(state.moveSequences(), [(44, 26), (44, 26, 8)])
+        state.undo()
+        self.assertEqual(state.getMoves(56), [49])
+        # A sequence stopping a chain early ends the turn
+        state.makeMoveSequence([62, 44])
+        self.assertIsNone(state.prevChainJmp)
+        self.assertEqual(state.playerTurn, perft.PLAYER2)
+
+        # Jumps are compulsory and chains have to be finished
+        state = State(self.player1, mandatoryCapture=True)
+        state.join(self.player2)
+        state.board.loadCompact(chain)
+        self.assertEqual(state.moveSequences(), [(62, 44, 26, 8)])
+        self.assertEqual(state.getMovablePieces(), [62])
+        self.assertEqual(state.getMoves(62), [44])
+        with self.assertRaises(ValueError):
+            state.makeMove(56, 49)
+        state.makeMove(62, 44)
+        with self.assertRaises(ValueError):
+            state.cancelMove()
+        self.assertEqual(state.playerTurn, self.player1)
+
+    def test_perft(self):
+        """ Move tree counts from the initial board, with and without the
+        transposition cache """
+        state = perft.start_state()
+        self.assertEqual([perft.perft(state, depth)[0]
+                          for depth in range(4)], [1, 7, 49, 379])
+        self.assertEqual(perft.perft(state, 4, {})[0],
+                         perft.perft(state, 4)[0])
+
+        # A chain can be continued or stopped
+        state = perft.start_state('.bb.....b........b........b.aa.a')
+        state.makeMove(62, 44)
+        self.assertEqual(state.prevChainJmp, 44)
+        moves = [move for move, _ in perft.children(state)]
+        self.assertEqual(moves, [(44, 26), perft.CANCEL])
+
+
+class TestSearch(unittest.TestCase):
+    """ Computer opponent """
+
+    def test_search_captures(self):
+        """ The search takes a triple jump and keeps the chain going """
+        state = perft.start_state('.bb.....b........b........b.aa.a')
+        search = Search.Search(timeBudget=0.2)
+        self.assertEqual(search.bestMove(Search.position(state)), (62, 44))
+        self.assertGreater(search.depth, 1)
+        state.makeMove(62, 44)
+        self.assertEqual(search.bestMove(Search.position(state)), (44, 26))
+
+    def test_search_moves_match_state(self):
+        """ Searched hops and positions agree with State along a game the
+        computer plays against itself. Timed searches do not always pick the
+        same moves and there is no draw rule, so the game is cut short """
+        state = perft.start_state()
+        for ply in range(150):
+            if not state.getMovablePieces():
+                break
+            pos = Search.position(state)
+            jumps, steps = Search.generate(*pos)
+            hops = {(Bitboard.toPos(hop[0]), Bitboard.toPos(hop[1])): hop
+                    for hop in jumps + steps}
+            self.assertEqual(sorted(hops), sorted(
+                (src, dest) for src in state.getMovablePieces()
+                for dest in state.getMoves(src)))
+
+            move = Search.findMove(pos, 0.01)
+            if move == Search.CANCEL:
+                self.assertIsNotNone(state.prevChainJmp)
+                child = Search.play(*pos[:4], state.board.hash, move)
+                state.cancelMove()
+            else:
+                child = Search.play(*pos[:4], state.board.hash, hops[move])
+                state.makeMove(*move)
+            if not state.isFinished():
+                self.assertEqual(child[:5], Search.position(state))
+                self.assertEqual(child[5], state.board.hash)
+        # Either someone won or the game went the full 150 plies
+        self.assertTrue(state.isFinished() or ply == 149)
+
+
+class TestRooms(unittest.TestCase):
+    """ Room registry used by the handler """
+
+    def test_concurrent_ids(self):
+        """ IDs stay unique when generated from several threads """
+        generator = UniqueIDGenerator()
+        ids = []
+
+        def worker():
+            for _ in range(1000):
+                ids.append(generator.generate_id())
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(ids), list(range(1, 8001)))
+
+    def test_checkout(self):
+        """ Rooms are spread over shards and locked one at a time """
+        registry = RoomRegistry(shards=4)
+        room_ids = [registry.add(State(player)) for player in range(10)]
+        self.assertEqual(room_ids, list(range(1, 11)))
+        self.assertEqual(len(registry), 10)
+        self.assertEqual(sorted(registry.ids()), room_ids)
+        self.assertTrue(5 in registry)
+
+        with registry.checkout(5) as game:
+            self.assertIs(game, registry[5])
+            self.assertEqual(game.player1, 4)
+
+        self.assertIs(registry.remove(5), game)
+        self.assertFalse(5 in registry)
+        with self.assertRaises(KeyError):
+            with registry.checkout(5):
+                pass
+
+    def test_sqlite_store(self):
+        """ Games changed through one store are seen by another one
+        opened on the same file """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rooms.db')
+            first = SQLiteRoomStore(path)
+            second = SQLiteRoomStore(path)
+
+            room_id = first.add(State(first.player_ids.generate_id()))
+            self.assertEqual(second.player_ids.generate_id(), 2)
+            self.assertTrue(room_id in second)
+
+            with second.checkout(room_id) as game:
+                game.join(2)
+                game.makeMove(40, 33)
+            self.assertEqual(first[room_id].board.toJSON()[33], 'P1')
+
+            # Changes are dropped when the block fails
+            with self.assertRaises(ValueError):
+                with first.checkout(room_id) as game:
+                    game.makeMove(17, 26)
+                    raise ValueError('abort')
+            self.assertEqual(second[room_id].board.toJSON()[26], 'BLANK')
+
+            self.assertEqual(first.ids(), [room_id])
+            first.remove(room_id)
+            self.assertEqual(len(second), 0)
+            with self.assertRaises(KeyError):
+                with second.checkout(room_id):
+                    pass
+
+
+class TestGameLog(unittest.TestCase):
+    """ Write-ahead log of the in memory rooms """
+
+    def play(self, registry, log, room_id, plies, seed):
+        """ Plays random moves, sequences and cancels in a room, recording
+        them like the handler does """
+        rnd = random.Random(seed)
+        for _ in range(plies):
+            with registry.checkout(room_id) as game:
+                if game.isFinished():
+                    return
+                if (game.prevChainJmp is not None and
+                        not game.mandatoryCapture and rnd.random() < 0.3):
+                    game.cancelMove()
+                    log.cancel(room_id)
+                elif rnd.random() < 0.5:
+                    path = list(rnd.choice(game.moveSequences()))
+                    game.makeMoveSequence(path)
+                    log.sequence(room_id, path)
+                else:
+                    src = rnd.choice(game.getMovablePieces())
+                    dest = rnd.choice(game.getMoves(src))
+                    game.makeMove(src, dest)
+                    log.move(room_id, src, dest)
+
+    def create(self, registry, log, mandatory_capture=False):
+        """ Adds a game between two new players """
+        player1_id = registry.player_ids.generate_id()
+        player2_id = registry.player_ids.generate_id()
+        room_id = registry.add(State(player1_id, mandatory_capture))
+        log.create(room_id, player1_id, mandatory_capture)
+        with registry.checkout(room_id) as game:
+            game.join(player2_id)
+        log.join(room_id, player2_id, False)
+        return room_id
+
+    def assertRecovered(self, registry, path):
+        """ A new registry recovered from path holds the same games """
+        recovered = RoomRegistry()
+        log = FileGameLog(path, recovered)
+        self.assertEqual(log.recover(), sorted(registry.ids()))
+        for room_id in registry.ids():
+            game = registry[room_id]
+            copy = recovered[room_id]
+            self.assertEqual(copy.toJSON(), game.toJSON())
+            self.assertEqual(copy.positionHash(), game.positionHash())
+            self.assertEqual(copy.mandatoryCapture, game.mandatoryCapture)
+        # IDs handed out before the restart are not reused
+        self.assertGreater(recovered.room_ids.generate_id(),
+                           max(registry.ids()))
+        self.assertGreater(recovered.player_ids.generate_id(),
+                           max(max(recovered[room_id].player1,
+                                   recovered[room_id].player2)
+                               for room_id in recovered.ids()))
+        return recovered, log
+
+    def test_replay(self):
+        """ Games are rebuilt from the records of a closed log """
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = RoomRegistry()
+            log = FileGameLog(tmp, registry)
+            first = self.create(registry, log)
+            second = self.create(registry, log, mandatory_capture=True)
+            removed = self.create(registry, log)
+            self.play(registry, log, first, 60, 1)
+            self.play(registry, log, second, 60, 2)
+            registry.remove(removed)
+            log.remove(removed)
+            log.close()
+            self.assertRecovered(registry, tmp)
+
+    def test_compact(self):
+        """ Recovery combines the snapshot with the records written after
+        it, and compaction drops the segments it covers """
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = RoomRegistry()
+            log = FileGameLog(tmp, registry)
+            room_id = self.create(registry, log)
+            self.play(registry, log, room_id, 20, 3)
+            log.flush()
+            log.compact()
+            self.assertEqual(log.segments(), [])
+            self.play(registry, log, room_id, 20, 4)
+            self.create(registry, log)
+            log.close()
+            _, recovered_log = self.assertRecovered(registry, tmp)
+
+            # The recovered log keeps counting where the old one stopped
+            self.play(registry, recovered_log, room_id, 20, 5)
+            recovered_log.close()
+            self.assertRecovered(registry, tmp)
+
+    def test_torn_tail(self):
+        """ A record cut short by a crash is ignored with everything after
+        it """
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = RoomRegistry()
+            log = FileGameLog(tmp, registry)
+            room_id = self.create(registry, log)
+            self.play(registry, log, room_id, 10, 6)
+            segment = log.flush()
+            log.close()
+            with open(log.segment_path(segment), 'ab') as output:
+                output.write(b'\x00\x01\x02')
+            with self.assertLogs('kingme.gamelog', 'WARNING') as logs:
+                self.assertRecovered(registry, tmp)
+            self.assertIn('3 bytes', logs.output[0])
+
+    def test_durable_store(self):
+        """ A handler on the SQLite store starts without a game log even
+        when one is configured """
+        environ = dict(os.environ)
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ['KINGME_ROOM_STORE'] = 'sqlite:///' + \
+                os.path.join(tmp, 'rooms.db')
+            os.environ['KINGME_GAME_LOG'] = os.path.join(tmp, 'log')
+            try:
+                with self.assertLogs('kingme.gamelog', 'WARNING') as logs:
+                    handler = Handler()
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            self.assertIs(type(handler.log), GameLog)
+            self.assertIn('not logging', logs.output[0])
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'log')))
+
+
+class TestMetrics(unittest.TestCase):
+    """ Prometheus metrics """
+
+    def test_histogram(self):
+        """ Timings land in cumulative buckets """
+        now = [0.0]
+        metrics = Metrics(clock=lambda: now[0])
+
+        def work(seconds):
+            now[0] += seconds
+            return seconds
+
+        timed = metrics.timed('kingme_handler_seconds', 'handler', 'work',
+                              work)
+        self.assertEqual(timed(0.00001), 0.00001)
+        timed(0.001)
+        timed(100)
+        metrics.inc('kingme_sent_bytes_total', 10)
+        metrics.inc('kingme_sent_bytes_total', 5)
+        lines = metrics.render().splitlines()
+
+        def sample(prefix):
+            return [line.split()[-1] for line in lines
+                    if line.startswith(prefix)][0]
+        labels = 'kingme_handler_seconds_bucket{handler="work",le='
+        self.assertEqual(sample(labels + '"1e-05"}'), '1')
+        self.assertEqual(sample(labels + '"0.00128"}'), '2')
+        self.assertEqual(sample(labels + '"+Inf"}'), '3')
+        self.assertEqual(sample('kingme_handler_seconds_count'), '3')
+        self.assertEqual(sample('kingme_sent_bytes_total'), '15')
+        self.assertNotIn('kingme_rooms', metrics.render())
+
+
+class TestValidation(unittest.TestCase):
+    """ Event schemas and rate limits """
+
+    def test_schema(self):
+        """ Payloads decode to clean values or an error, without raising """
+        schema = SCHEMAS['makeMoveSequence']
+        self.assertEqual(schema.decode({'room_id': '7', 'path': [62, '44']}),
+                         ({'room_id': 7, 'path': [62, 44]}, None))
+        for data in [None, [], {'room_id': 7}, {'room_id': 7, 'path': [62]},
+                     {'room_id': 7, 'path': [62, True]},
+                     {'room_id': 7, 'path': [62, '4²']},
+                     {'room_id': -1, 'path': [62, 44]},
+                     {'room_id': 2 ** 40, 'path': [62, 44]}]:
+            values, error = schema.decode(data)
+            self.assertIsNone(values)
+            self.assertEqual(error[0], 'BAD_REQUEST')
+        self.assertEqual(SCHEMAS['create'].decode(None), (
+            {'compact': False, 'ai': False, 'mandatoryCapture': False},
+            None))
+
+    def test_rate_limit(self):
+        """ Clients get burst events at once, then rate a second """
+        now = [0.0]
+        limiter = RateLimiter(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual([limiter.allow('a') for _ in range(4)],
+                         [True, True, True, False])
+        self.assertTrue(limiter.allow('b'))
+        now[0] += 0.5
+        self.assertEqual([limiter.allow('a') for _ in range(2)],
+                         [True, False])
+        limiter.forget('a')
+        self.assertTrue(limiter.allow('a'))
+
+
+class TestMatchmaking(unittest.TestCase):
+    """ Matchmaking queue """
+
+    def test_buckets(self):
+        """ Players meet in their bucket, oldest first, then across
+        buckets once they waited long enough """
+        now = [0.0]
+        queue = MatchQueue(bucket_width=100, widen_after=5,
+                           clock=lambda: now[0])
+        for sid, rating in [('a', 1210), ('b', 1020), ('c', 1290),
+                            ('d', 1250), ('e', 1470), ('f', None)]:
+            queue.add(sid, rating, options=sid)
+            now[0] += 1
+        queue.add('g', 1230, True)
+        queue.cancel('d')
+        queue.add('b', 1050)
+        self.assertEqual(queue.match(), [('a', 'a', 'c', 'c')])
+        self.assertEqual(len(queue), 4)
+
+        now[0] += 5
+        # Unrated players sort below every rating
+        self.assertEqual(queue.match(), [('f', 'f', 'b', None)])
+        self.assertEqual(queue.match(), [])
+        self.assertEqual(len(queue), 2)
+
+
+class TestLobby(unittest.TestCase):
+    """ Lobby index """
+
+    def test_pages(self):
+        """ Pages follow creation order and stay consistent while rooms
+        come and go """
+        now = [100.0]
+        lobby = LobbyIndex(clock=lambda: now[0])
+        games = {}
+        for room_id in range(1, 6):
+            games[room_id] = State(room_id)
+            self.assertEqual(lobby.track(room_id, games[room_id])['status'],
+                             'open')
+            now[0] += 1
+        self.assertIsNone(lobby.track(1, games[1]))
+
+        rooms, cursor = lobby.page('open', limit=2)
+        self.assertEqual([room['room_id'] for room in rooms], [1, 2])
+        games[3].join(30)
+        self.assertEqual(lobby.track(3, games[3])['status'], 'playing')
+        self.assertEqual(lobby.forget(2)['status'], None)
+        self.assertIsNone(lobby.forget(2))
+        rooms, cursor = lobby.page('open', decode_cursor(cursor), limit=2)
+        self.assertEqual([room['room_id'] for room in rooms], [4, 5])
+        self.assertIsNone(cursor)
+
+        games[3].disconnect(30)
+        self.assertEqual(lobby.track(3, games[3])['room'], None)
+        self.assertEqual(lobby.counts(), {'open': 3, 'playing': 0})
+
+
+class TestAssets(unittest.TestCase):
+    """ Static asset build """
+
+    def test_minify(self):
+        """ Minifying drops comments and whitespace, never code """
+        script = '''/**
+            header
+        **/
+        // comment
+        var url = 'http://' + host; // trailing
+
+        function f() {
+            return 1;
+        }
+        '''
+        self.assertEqual(assets.minify_js(script),
+                         "var url = 'http://' + host; // trailing\n"
+                         "function f() {\nreturn 1;\n}\n")
+        self.assertEqual(assets.minify_js('/* x */ var c = 3;\n'
+                                          '/* a\n b */ c++; /* kept */\n'
+                                          '/**/ /* y */\n'),
+                         'var c = 3;\nc++; /* kept */\n')
+        self.assertEqual(assets.minify_css('/* x */\n#a td:nth-child(2n) {\n'
+                                           '  margin: 0 auto;\n}\n'),
+                         '#a td:nth-child(2n){margin: 0 auto}\n')
+        self.assertEqual(assets.hashed_name('js/a.js', b'x'),
+                         'js/a.2d711642b726.js')
+        self.assertEqual(assets.accepted_encodings('gzip;q=0, br'), {'br'})
+
+
+class TestLifecycle(unittest.TestCase):
+    """ Room eviction """
+
+    def setUp(self):
+        """ A registry with a lifecycle driven by a fake clock """
+        self.now = 1000.0
+        self.rooms = RoomRegistry()
+        self.lifecycle = RoomLifecycle(self.rooms, idle_ttl=60,
+                                       finished_ttl=10,
+                                       clock=lambda: self.now)
+
+    def add_room(self):
+        """ Registers and touches a new game """
+        room_id = self.rooms.add(State(1))
+        with self.rooms.checkout(room_id) as game:
+            self.lifecycle.touch(room_id, game)
+        return room_id
+
+    def test_idle_and_finished(self):
+        """ Finished rooms go after their TTL, idle ones after theirs """
+        idle = self.add_room()
+        active = self.add_room()
+        finished = self.add_room()
+        with self.rooms.checkout(finished) as game:
+            game.disconnect(1)
+            self.lifecycle.touch(finished, game)
+
+        self.now += 11
+        self.assertEqual(self.lifecycle.evict(), [finished])
+
+        self.now += 40
+        with self.rooms.checkout(active) as game:
+            self.lifecycle.touch(active, game)
+        self.now += 20
+        self.assertEqual(self.lifecycle.evict(), [idle])
+        self.assertEqual(self.rooms.ids(), [active])
+
+        self.now += 60
+        self.assertEqual(self.lifecycle.evict(), [active])
+        self.assertEqual(len(self.rooms), 0)
+        self.assertEqual(self.lifecycle.stats(),
+                         {'rooms': 0, 'bytes_per_room': 0})
+
+    def test_heap_bounded(self):
+        """ Frequent activity does not grow the heap, finishing the game
+        brings the deadline forward """
+        room_id = self.add_room()
+        for _ in range(1000):
+            self.now += 1
+            with self.rooms.checkout(room_id) as game:
+                self.lifecycle.touch(room_id, game)
+        self.assertEqual(len(self.lifecycle.heap), 1)
+
+        self.now += 59
+        self.assertEqual(self.lifecycle.evict(), [])
+        self.assertEqual(len(self.lifecycle.heap), 1)
+        with self.rooms.checkout(room_id) as game:
+            game.disconnect(1)
+            self.lifecycle.touch(room_id, game)
+        self.now += 11
+        self.assertEqual(self.lifecycle.evict(), [room_id])
+
+    def test_activity_from_other_workers(self):
+        """ Activity recorded on the game itself postpones eviction """
+        room_id = self.add_room()
+        self.rooms[room_id].lastActivity = self.now + 30
+        self.now += 61
+        self.assertEqual(self.lifecycle.evict(), [])
+        self.now += 30
+        self.assertEqual(self.lifecycle.evict(), [room_id])
+
+
+class RecordingServer:
+    """ Stands in for socketio.AsyncServer and records what is sent """
+
+    def __init__(self):
+        self.sent = []
+        self.eio = engineio.AsyncServer()
+
+    async def emit(self, event, data, to=None):
+        """ Records an emitted event """
+        self.sent.append((event, to, data))
+
+    async def enter_room(self, sid, room):
+        """ Records a client entering a room """
+        self.sent.append(('enter_room', sid, room))
+
+
+class TestAsyncHandler(unittest.TestCase):
+    """ The AsyncServer entry point reuses the Handler logic """
+
+    def test_recover_ai_turn(self):
+        """ A game recovered on the computer's turn gets its move """
+        environ = dict(os.environ)
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = RoomRegistry()
+            log = FileGameLog(tmp, registry)
+            room_id = registry.add(State(1))
+            log.create(room_id, 1, False)
+            with registry.checkout(room_id) as game:
+                game.joinComputer(2)
+                game.makeMove(40, 33)
+            log.join(room_id, 2, True)
+            log.move(room_id, 40, 33)
+            log.close()
+
+            os.environ['KINGME_GAME_LOG'] = tmp
+            try:
+                server = RecordingServer()
+                handler = AsyncHandler(server)
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            handler.ai_time = 0.05
+
+            async def recover():
+                handler.resume_ai()
+                await asyncio.gather(*list(handler.ai_tasks))
+
+            try:
+                asyncio.run(recover())
+            finally:
+                handler.log.close()
+                if handler.ai_executor is not None:
+                    handler.ai_executor.shutdown()
+            deltas = [sent for sent in server.sent
+                      if sent[0] == 'update_delta']
+            self.assertEqual(deltas[0][1], room_id)
+            self.assertEqual(deltas[0][2]['playerTurn'], 1)
+
+    def test_dispatch(self):
+        """ Output of the sync handlers is flushed to the AsyncServer """
+        server = RecordingServer()
+        handler = AsyncHandler(server)
+
+        async def play():
+            await handler.dispatch('sid1', handler.create)
+            await handler.dispatch('sid2', handler.join, {'room_id': 1})
+            await handler.dispatch('sid1', handler.make_move, {
+                'makeMove': True, 'room_id': 1,
+                'pieceToMove': 40, 'moveToLocation': 33})
+            await handler.dispatch('sid1', handler.join, {'room_id': 'x'})
+
+        asyncio.run(play())
+        self.assertEqual(server.sent[0], ('enter_room', 'sid1', 1))
+        self.assertEqual(server.sent[1],
+                         ('join_room', 'sid1', {
+                             'player_id': 1, 'room_id': 1,
+                             'resume_token': handler.tokens.sign(1, 1)}))
+        self.assertEqual(server.sent[2][:2], ('update', 1))
+        self.assertEqual(handler.sessions, {'sid1': (1, 1), 'sid2': (1, 2)})
+        deltas = [sent for sent in server.sent if sent[0] == 'update_delta']
+        self.assertEqual(deltas[0][1], 1)
+        self.assertEqual(deltas[0][2]['squares'], [[33, 'P1'], [40, 'BLANK']])
+        self.assertEqual(server.sent[-1],
+                         ('error', 'sid1', {'error': 'Room IDs must be integers',
+                                            'code': 'BAD_ROOM_ID'}))
+
 
 if __name__ == "__main__":
     unittest.main()
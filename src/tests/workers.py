@@ -0,0 +1,172 @@
+""" Multi-worker harness
+    Starts several server processes sharing one SQLite room store and
+    checks that a game created on one worker can be played through others.
+
+    Usage:
+        python src/tests/workers.py [--workers N] [--port FIRST_PORT]
+
+    Set KINGME_MESSAGE_QUEUE (e.g. redis://localhost:6379/0) to also check
+    that broadcasts reach players connected to other workers.
+
+    C0413 is disabled because we require the sys.path.insert before importing
+"""
+# pylint: disable=C0413
+import argparse
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, 'src/flask')
+sys.path.insert(0, 'src/')
+
+import socketio
+
+from State import State
+
+# A short game through a double jump, player 2 wins (see test_make_move_3)
+MOVES = [
+    (40, 33, 0), (17, 26, 1), (33, 24, 0), (10, 17, 1), (24, 10, 0),
+    (3, 17, 1), (44, 37, 0), (26, 35, 1), (46, 39, 0), (21, 30, 1),
+    (39, 21, 0), (21, 3, 0), (23, 30, 1), (3, 10, 0), (30, 44, 1)]
+
+
+def serve(port):
+    """ Runs one worker """
+    from app import get_handler  # pylint: disable=C0415
+    handler = get_handler()
+    handler.socketio.run(handler.app, host='127.0.0.1', port=port,
+                         allow_unsafe_werkzeug=True)
+
+
+def start_workers(count, first_port, store):
+    """ Starts count worker processes, returns them with their URLs """
+    env = dict(os.environ, KINGME_ROOM_STORE=store)
+    workers = []
+    urls = []
+    for i in range(count):
+        port = first_port + i
+        workers.append(subprocess.Popen(
+            [sys.executable, __file__, '--serve', str(port)], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append('http://127.0.0.1:%d' % port)
+
+    for port in range(first_port, first_port + count):
+        wait_for_port(port)
+    return workers, urls
+
+
+def wait_for_port(port, timeout=15):
+    """ Blocks until something listens on port """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Worker on port %d did not start' % port)
+
+
+class Player:
+    """ A Socket.IO client that records everything it receives """
+
+    def __init__(self, url):
+        self.received = queue.Queue()
+        self.client = socketio.Client()
+        self.client.on('*', self.record)
+        self.client.connect(url)
+
+    def record(self, event, data=None):
+        """ Stores one received event """
+        self.received.put((event, data))
+
+    def wait_for(self, event, timeout=5):
+        """ Returns the data of the next event with the given name """
+        deadline = time.time() + timeout
+        while True:
+            name, data = self.received.get(timeout=max(0, deadline - time.time()))
+            if name == 'error':
+                raise RuntimeError(data['error'])
+            if name == event:
+                return data
+
+    def close(self):
+        """ Disconnects the client """
+        self.client.disconnect()
+
+
+def check_game(urls, shared_broadcasts):
+    """ Creates a game on the first worker, joins and plays it through the
+    others, then compares the final board with a local replay """
+    player1 = Player(urls[0])
+    player2 = Player(urls[1 % len(urls)])
+    try:
+        player1.client.emit('create')
+        room_id = player1.wait_for('join_room')['room_id']
+        player2.client.emit('join', {'room_id': room_id})
+        player2.wait_for('join_room')
+
+        expected = State(1)
+        expected.join(2)
+        players = [player1, player2]
+        for src, dest, mover in MOVES:
+            players[mover].client.emit('makeMove', {
+                'makeMove': True,
+                'room_id': room_id,
+                'pieceToMove': src,
+                'moveToLocation': dest
+            })
+            delta = players[mover].wait_for('update_delta')
+            if [dest, 'BLANK'] in delta['squares'] or \
+                    [src, 'BLANK'] not in delta['squares']:
+                raise AssertionError('Move %d -> %d was not applied' %
+                                     (src, dest))
+            if shared_broadcasts:
+                players[1 - mover].wait_for('update_delta')
+            expected.makeMove(src, dest)
+
+        # Anyone, on any worker, sees the same final position
+        observer = Player(urls[-1])
+        observer.client.emit('requestSnapshot', {'room_id': room_id})
+        snapshot = observer.wait_for('update')
+        observer.close()
+        if snapshot['board'] != expected.board.toJSON():
+            raise AssertionError('Final board differs from local replay')
+        if snapshot['state'] != expected.state:
+            raise AssertionError('Final state %s, expected %s' %
+                                 (snapshot['state'], expected.state))
+    finally:
+        player1.close()
+        player2.close()
+
+
+def main():
+    """ Parses arguments and runs the harness """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = 'sqlite:///' + os.path.join(tmp, 'rooms.db')
+        workers, urls = start_workers(args.workers, args.port, store)
+        try:
+            check_game(urls, bool(os.environ.get('KINGME_MESSAGE_QUEUE')))
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+    print('OK: game created on %s was played through %d workers' %
+          (urls[0], len(urls)))
+
+
+if __name__ == '__main__':
+    main()